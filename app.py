@@ -1,9 +1,32 @@
 import os
 import json
 import csv
-from flask import Flask, render_template, request, jsonify, send_file
-from shapely.geometry import Point, Polygon
+import hmac
+import io
+import logging
+import time
+import uuid
+from itertools import chain
+from flask import (Flask, Response, g, redirect, render_template, request, jsonify, send_file, stream_with_context,
+                   url_for)
 from werkzeug.utils import secure_filename
+from csv_stream import iter_batches, iter_multipart_file, iter_request_chunks, iter_text
+from boundary_layers import BoundaryLayers, default_layers, load_layer_config
+from boundary_tiles import BoundaryTiles
+from job_queue import JobRunner, JobStore
+from log_config import RequestSummary, configure_logging
+from profiling import DEFAULT_INTERVAL, RequestProfiler
+from micromarket_index import feature_parts
+from micromarket_lookup import (DATA_FILE_PATH, MAX_BATCH_SIZE, NEAREST_MAX_DISTANCE, RELOAD_INTERVAL, ROUTES,
+                                UPLOAD_BATCH_ROWS, bind_index, boundaries, classify_batch_points, enrich_rows,
+                                enrich_table, finite_coordinates, get_micromarket_info, lookup_cache, match_results,
+                                metrics, request_seconds, responses, run_upload_job, stage_seconds, upload_columns,
+                                upload_layout, validate_batch_points)
+from property_index import Inventories
+from table_formats import FORMAT_EXTENSIONS, MIMETYPES, check_format, format_for
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # Flask App Setup
 app = Flask(__name__)
@@ -13,143 +36,63 @@ UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# GeoJSON File Path
-DATA_FILE_PATH = os.path.join(os.path.dirname(__file__), 'Data', 'new.geojson')
-
-# Load GeoJSON File
-try:
-    with open(DATA_FILE_PATH, encoding='utf-8') as f:
-        micromarket_data = json.load(f)
-        print(f"Successfully loaded GeoJSON from {DATA_FILE_PATH}")
-except FileNotFoundError:
-    print(f"ERROR: GeoJSON file not found at {DATA_FILE_PATH}")
-    micromarket_data = {"features": []}
-except json.JSONDecodeError as e:
-    print(f"ERROR: Invalid JSON in GeoJSON file: {e}")
-    micromarket_data = {"features": []}
-except Exception as e:
-    print(f"ERROR: Unexpected error loading GeoJSON: {e}")
-    micromarket_data = {"features": []}
-
-# Define known areas with bounding boxes for fallback
-KNOWN_AREAS = {
-    "BTM Layout": [77.60, 12.90, 77.63, 12.94],
-    "Koramangala": [77.61, 12.93, 77.65, 12.98],
-    "Hebbal": [77.58, 13.04, 77.62, 13.06],
-    "Yelahanka": [77.57, 13.09, 77.62, 13.14],
-}
-
-def clean_coordinates(coordinates):
-    """Clean coordinate data to handle 3D coordinates (with elevation)."""
-    if not coordinates:
-        return coordinates
-        
-    # Handle different coordinate structures
-    if isinstance(coordinates, list) and len(coordinates) > 0:
-        if isinstance(coordinates[0], list):
-            # This is a ring of coordinates
-            if len(coordinates[0]) > 0 and isinstance(coordinates[0][0], list):
-                # This is a polygon with multiple rings
-                return [[(point[0], point[1]) for point in ring if len(point) >= 2] for ring in coordinates]
-            else:
-                # This is a single ring
-                return [(point[0], point[1]) for point in coordinates if len(point) >= 2]
-    
-    return coordinates
-
-def point_in_polygon_check(point, geometry):
-    """Check if a point is inside a polygon or multipolygon."""
-    try:
-        if geometry['type'] == 'Polygon':
-            coordinates = geometry['coordinates']
-            if not coordinates:
-                return False
-                
-            # Clean coordinates to 2D
-            cleaned_coords = clean_coordinates(coordinates)
-            if not cleaned_coords or len(cleaned_coords) == 0:
-                return False
-                
-            # Create polygon from exterior ring (first ring)
-            exterior_ring = cleaned_coords[0] if isinstance(cleaned_coords[0], list) else cleaned_coords
-            if len(exterior_ring) < 3:  # Need at least 3 points for a polygon
-                return False
-                
-            polygon = Polygon(exterior_ring)
-            if not polygon.is_valid:
-                polygon = polygon.buffer(0)
-            return polygon.contains(point)
-                
-        elif geometry['type'] == 'MultiPolygon':
-            for poly_coords in geometry['coordinates']:
-                if not poly_coords:
-                    continue
-                    
-                cleaned_coords = clean_coordinates(poly_coords)
-                if not cleaned_coords or len(cleaned_coords) == 0:
-                    continue
-                    
-                try:
-                    exterior_ring = cleaned_coords[0] if isinstance(cleaned_coords[0], list) else cleaned_coords
-                    if len(exterior_ring) < 3:
-                        continue
-                        
-                    polygon = Polygon(exterior_ring)
-                    if not polygon.is_valid:
-                        polygon = polygon.buffer(0)
-                    if polygon.contains(point):
-                        return True
-                except Exception as inner_e:
-                    print(f"Error with individual polygon in MultiPolygon: {inner_e}")
-                    continue
-            return False
-            
-    except Exception as e:
-        print(f"Error in point_in_polygon_check: {e}")
-        return False
+# Streaming uploads read the body in chunks and classify rows in batches
+app.config['STREAM_CHUNK_SIZE'] = 64 * 1024
+app.config['STREAM_BATCH_ROWS'] = UPLOAD_BATCH_ROWS
 
-def point_in_bounding_box(lon, lat, bbox):
-    """Check if a point is inside a bounding box."""
-    try:
-        min_lon, min_lat, max_lon, max_lat = bbox
-        return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
-    except Exception as e:
-        print(f"Error in bounding box check: {e}")
-        return False
+# Largest number of points accepted by /find_micromarket/batch
+app.config['MAX_BATCH_SIZE'] = MAX_BATCH_SIZE
 
-def get_micromarket_info(lat, lon):
-    """Determine the micromarket and zone for given coordinates."""
-    try:
-        point = Point(lon, lat)  # Important: longitude first, latitude second
-        print(f"Searching for point: ({lat}, {lon})")
-        # First try the GeoJSON polygon approach
-        for i, feature in enumerate(micromarket_data.get('features', [])):
-            try:
-                properties = feature.get('properties', {})
-                micromarket_name = properties.get('Micromarket', '')
-                zone_name = properties.get('Zone', '')
-                if not micromarket_name:
-                    continue
-                geometry = feature.get('geometry', {})
-                if not geometry:
-                    continue
-                if point_in_polygon_check(point, geometry):
-                    print(f"MATCH FOUND: Micromarket: {micromarket_name}, Zone: {zone_name}")
-                    return micromarket_name, zone_name
-            except Exception as e:
-                print(f"Error processing feature {i+1}: {e}")
-                continue
-        # If polygon check fails, try the bounding box approach for known areas
-        print("No polygon match found, trying bounding box approach...")
-        for area_name, bbox in KNOWN_AREAS.items():
-            if point_in_bounding_box(lon, lat, bbox):
-                print(f"BOUNDING BOX MATCH: {area_name}")
-                return area_name, ""
-        print("No match found in any polygon or bounding box")
-        return "Unknown", ""
-    except Exception as e:
-        print(f"Error in get_micromarket_info: {e}")
-        return "Unknown", ""
+# Uploads posted with ?async=1 are saved here and enriched by background jobs
+JOB_FOLDER = os.path.abspath(os.path.join(UPLOAD_FOLDER, 'jobs'))
+os.makedirs(JOB_FOLDER, exist_ok=True)
+
+# Requests to PROFILED_ROUTES are sampled into MICROMARKET_PROFILE_DIR when an admin sends
+# X-Profile: 1, or while profiling is switched on with POST /admin/profiling
+PROFILED_ROUTES = ('find_micromarket', 'upload_csv')
+profiler = RequestProfiler(
+    os.environ.get('MICROMARKET_PROFILE_DIR', os.path.abspath(os.path.join(UPLOAD_FOLDER, 'profiles'))),
+    interval=float(os.environ.get('MICROMARKET_PROFILE_INTERVAL', DEFAULT_INTERVAL)),
+    max_profiles=int(os.environ.get('MICROMARKET_MAX_PROFILES', 500))
+)
+
+# Simplified boundary tiles for the map, rendered on first request and kept until the boundaries change
+boundary_tiles = BoundaryTiles()
+TILE_MAX_AGE = 365 * 24 * 3600
+
+def on_boundaries_swap(index):
+    bind_index(index)
+    boundary_tiles.bind(index)
+
+# The micromarket index is loaded by micromarket_lookup. Each worker polls the boundary
+# files every MICROMARKET_RELOAD_INTERVAL seconds and swaps in a rebuilt index without
+# a restart.
+boundaries.on_swap = on_boundaries_swap
+on_boundaries_swap(boundaries.index)
+boundaries.watch(RELOAD_INTERVAL)
+
+# Layers answered together by /find_layers, each compiled and loaded on first use.
+# MICROMARKET_LAYERS names a JSON file listing them (see boundary_layers).
+LAYERS_CONFIG = os.environ.get('MICROMARKET_LAYERS')
+boundary_layers = BoundaryLayers(
+    load_layer_config(LAYERS_CONFIG) if LAYERS_CONFIG else default_layers(os.path.dirname(DATA_FILE_PATH))
+)
+
+# Properties listed by the reverse query routes come from MICROMARKET_INVENTORY, or from
+# a CSV in the upload folder named by ?inventory=; each is indexed on first use
+INVENTORY_PATH = os.environ.get('MICROMARKET_INVENTORY', os.path.join(os.path.dirname(__file__), 'data.csv'))
+inventories = Inventories()
+
+# Admin routes are disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+@app.after_request
+def add_boundary_version(response):
+    response.headers['X-Boundary-Version'] = boundaries.index.version or ''
+    return response
+
+def is_admin_request():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
 
 @app.route('/')
 def home():
@@ -158,52 +101,489 @@ def home():
 @app.route('/find_micromarket', methods=['POST'])
 def find_micromarket():
     try:
-        lat = float(request.form.get('latitude', ''))
-        lon = float(request.form.get('longitude', ''))
-        micromarket_name, zone_name = get_micromarket_info(lat, lon)
+        with stage_seconds.time('parse'):
+            lat, lon = finite_coordinates(request.form.get('latitude', ''), request.form.get('longitude', ''))
+        micromarket_name, zone_name, match, distance = get_micromarket_info(lat, lon)
+        match_results.inc(match)
         return jsonify({
             "latitude": lat,
             "longitude": lon,
             "micromarket_name": micromarket_name,
-            "zone_name": zone_name
+            "zone_name": zone_name,
+            "match": match,
+            "distance_m": distance
+        })
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid coordinates: {e}"}), 400
+    except Exception as e:
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+
+@app.route('/find_layers', methods=['POST'])
+def find_layers():
+    """Return the feature of every layer containing a point, in one index query.
+
+    An optional comma-separated ``layers`` field limits the layers searched.
+    """
+    try:
+        lat, lon = finite_coordinates(request.form.get('latitude', ''), request.form.get('longitude', ''))
+        names = [name.strip() for name in request.form.get('layers', '').split(',') if name.strip()]
+        return jsonify({
+            "latitude": lat,
+            "longitude": lon,
+            "layers": boundary_layers.lookup(lat, lon, names)
         })
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 400
     except (ValueError, TypeError) as e:
         return jsonify({"error": f"Invalid coordinates: {e}"}), 400
     except Exception as e:
         return jsonify({"error": f"An error occurred: {e}"}), 500
 
+@app.route('/layers')
+def layers_info():
+    return jsonify(boundary_layers.info())
+
+@app.route('/version')
+def boundary_version():
+    return jsonify(boundaries.info())
+
+@app.route('/tiles.json')
+def tiles_info():
+    """Describe the boundary tiles in TileJSON; the tile URLs change with the boundaries."""
+    response = jsonify({
+        "tilejson": "3.0.0",
+        "name": "micromarkets",
+        "version": boundary_tiles.version,
+        "tiles": [f"{request.url_root}tiles/{boundary_tiles.version}/{{z}}/{{x}}/{{y}}.geojson"],
+        "minzoom": boundary_tiles.min_zoom,
+        "maxzoom": boundary_tiles.max_zoom,
+        "bounds": boundary_tiles.bounds(),
+    })
+    response.set_etag(boundary_tiles.version)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/tiles/<version>/<int:z>/<int:x>/<int:y>.geojson')
+def boundary_tile(version, z, x, y):
+    """Serve a boundary tile; its URL names the boundaries, so it can be cached for good."""
+    try:
+        tile = boundary_tiles.tile(z, x, y, version)
+    except KeyError:
+        # Tiles of replaced boundaries are gone; send clients to the current ones
+        return redirect(url_for('boundary_tile', version=boundary_tiles.version, z=z, x=x, y=y))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    gzipped = request.accept_encodings['gzip'] > 0
+    response = Response(tile.gzipped if gzipped else tile.body, mimetype='application/geo+json')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{tile.etag}-gzip" if gzipped else tile.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Rebuild this worker's index in the background; other workers follow via their file watchers."""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    boundaries.reload_async()
+    return jsonify({"status": "reloading", "serving": boundaries.info()}), 202
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """Show, or with POST set, the window in which every profiled route is sampled.
+
+    POST takes ``seconds`` (default 300); 0 switches profiling off.
+    """
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    if request.method == 'POST':
+        try:
+            profiler.enable(float(request.values.get('seconds', 300)))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid seconds: {e}"}), 400
+    enabled_until = profiler.enabled_until()
+    return jsonify({"enabled": bool(enabled_until), "enabled_until": enabled_until or None,
+                    "routes": list(PROFILED_ROUTES)})
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    profiles = profiler.list()
+    for info in profiles:
+        info['url'] = url_for('admin_profile', name=info['name'])
+    return jsonify({"profiles": profiles})
+
+@app.route('/admin/profiles/<name>')
+def admin_profile(name):
+    """Download a profile as collapsed stacks, for flamegraph.pl or speedscope."""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    path = profiler.path_of(name)
+    if path is None:
+        return jsonify({"error": "Unknown profile"}), 404
+    return send_file(path, mimetype='text/plain', as_attachment=True, download_name=f"{name}.collapsed")
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(lookup_cache.stats())
+
+def read_batch_points():
+    """Return the list of points posted to the batch route.
+
+    Accepts a JSON array, a JSON object with a ``points`` array, or NDJSON
+    with one point per line. Raises ValueError for a malformed body and
+    OverflowError when the batch is larger than MAX_BATCH_SIZE.
+    """
+    max_size = app.config['MAX_BATCH_SIZE']
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        points = []
+        for line in iter_text(iter_request_chunks(request.stream, app.config['STREAM_CHUNK_SIZE'])):
+            if not line.strip():
+                continue
+            if len(points) >= max_size:
+                raise OverflowError(f"Batch exceeds the maximum of {max_size} points")
+            points.append(json.loads(line))
+        return points
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('points')
+    if not isinstance(body, list):
+        raise ValueError("Expected a JSON array of points")
+    if len(body) > max_size:
+        raise OverflowError(f"Batch exceeds the maximum of {max_size} points")
+    return body
+
+@app.route('/find_micromarket/batch', methods=['POST'])
+def find_micromarket_batch():
+    """Look up many points in one request with a single vectorized pass."""
+    parse_started = time.perf_counter()
+    try:
+        points = read_batch_points()
+    except OverflowError as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": f"Invalid batch: {e}"}), 400
+
+    results, valid, coordinates = validate_batch_points(points)
+    stage_seconds.observe(time.perf_counter() - parse_started, 'parse')
+
+    summary = RequestSummary(logger, "find_micromarket/batch")
+    try:
+        classify_batch_points(results, valid, coordinates, summary)
+    except Exception as e:
+        logger.exception("Batch lookup failed")
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+    summary.log()
+
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        body = ''.join(json.dumps(result) + '\n' for result in results)
+        return Response(body, mimetype='application/x-ndjson')
+    return jsonify({"results": results})
+
+def stream_enriched_csv(chunks, summary):
+    """Yield the enriched CSV for a stream of uploaded bytes, one batch at a time."""
+    reader = csv.reader(iter_text(chunks))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    header = next(reader, [])
+    columns, layout = upload_columns(header), None
+    writer.writerow(columns.header)
+    yield buffer.getvalue()
+
+    batches = iter_batches(reader, app.config['STREAM_BATCH_ROWS'])
+    while True:
+        with stage_seconds.time('csv_read'):
+            rows = next(batches, None)
+        if rows is None:
+            break
+        if layout is None:
+            layout = upload_layout(header, rows)
+        enriched = enrich_rows(rows, columns, layout, summary)
+        with stage_seconds.time('csv_write'):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(enriched)
+        yield buffer.getvalue()
+    summary.log()
+
+def upload_formats(filename):
+    """Return the (input, output) formats of an upload: its extension's, and ?format= or the same.
+
+    Raises ValueError for a format that is unknown or needs pyarrow when it is missing.
+    """
+    input_format = format_for(filename)
+    output_format = request.args.get('format', '').lower() or input_format
+    check_format(input_format)
+    check_format(output_format)
+    return input_format, output_format
+
+def updated_name(filename, input_format, output_format):
+    """Return the download name of an enriched upload."""
+    name = secure_filename(filename) or 'upload.csv'
+    if output_format != input_format:
+        name = os.path.splitext(name)[0] + FORMAT_EXTENSIONS[output_format]
+    return f"updated_{name}"
+
+def upload_chunks():
+    """Return (filename, chunks) for the uploaded CSV without buffering it.
+
+    Accepts either the usual multipart form with a ``file`` field or a raw
+    CSV request body (named by the ``filename`` query parameter). filename
+    is None when no file was posted.
+    """
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    if request.mimetype == 'multipart/form-data':
+        boundary = request.mimetype_params.get('boundary', '').encode()
+        if not boundary:
+            return None, iter(())
+        upload = {}
+        chunks = iter_multipart_file(request.stream, boundary, 'file', chunk_size,
+                                     on_file=lambda name: upload.setdefault('filename', name))
+        # Read up to the first chunk of the file so its name is known before responding
+        first_chunk = next(chunks, b'')
+        if not upload.get('filename'):
+            return None, iter(())
+        return upload['filename'], chain([first_chunk], chunks)
+    return request.args.get('filename', 'upload.csv'), iter_request_chunks(request.stream, chunk_size)
+
+def stream_upload_csv():
+    """Enrich an upload without holding it in memory or writing it to disk."""
+    filename, chunks = upload_chunks()
+    if filename is None:
+        return jsonify({"error": "No file provided"}), 400
+    try:
+        if upload_formats(filename) != ('csv', 'csv'):
+            raise ValueError("streamed uploads are CSV in and out; upload without stream=1 for other formats")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid format: {e}"}), 400
+
+    out_name = f"updated_{secure_filename(filename) or 'upload.csv'}"
+    return Response(
+        stream_with_context(stream_enriched_csv(chunks, RequestSummary(logger, f"upload_csv stream {filename}"))),
+        mimetype='text/csv',
+        headers={"Content-Disposition": f"attachment; filename={out_name}"}
+    )
+
+# Jobs are shared by all workers through MICROMARKET_JOB_DB. At most
+# MICROMARKET_JOB_CONCURRENCY run at once across every worker, each in a child
+# process importing micromarket_lookup.run_upload_job, so interactive requests keep
+# their latency. Jobs running longer than MICROMARKET_JOB_TIMEOUT seconds are killed;
+# finished jobs and their files are deleted after MICROMARKET_JOB_RETENTION seconds.
+job_store = JobStore(os.environ.get('MICROMARKET_JOB_DB', os.path.join(JOB_FOLDER, 'jobs.db')))
+job_runner = JobRunner(
+    job_store, run_upload_job,
+    concurrency=int(os.environ.get('MICROMARKET_JOB_CONCURRENCY', 2)),
+    retention=float(os.environ.get('MICROMARKET_JOB_RETENTION', 24 * 3600)),
+    timeout=float(os.environ.get('MICROMARKET_JOB_TIMEOUT', 3600))
+)
+job_runner.start()
+
+def query_flag(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+def queue_upload_csv():
+    """Save an upload to disk and queue it as a background job."""
+    filename, chunks = upload_chunks()
+    if filename is None:
+        return jsonify({"error": "No file provided"}), 400
+    try:
+        input_format, output_format = upload_formats(filename)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid format: {e}"}), 400
+
+    job_id = uuid.uuid4().hex
+    input_path = os.path.join(JOB_FOLDER, f"{job_id}{FORMAT_EXTENSIONS[input_format]}")
+    with open(input_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    output_path = os.path.join(JOB_FOLDER, f"{job_id}.out{FORMAT_EXTENSIONS[output_format]}")
+    job_store.create(filename, input_path, output_path, job_id=job_id)
+    job_runner.notify()
+
+    status_url = url_for('job_status', job_id=job_id)
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": status_url,
+        "result_url": url_for('job_result', job_id=job_id)
+    }), 202, {"Location": status_url}
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    info = job_store.info(job_id)
+    if info is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if info['status'] == 'done':
+        info['result_url'] = url_for('job_result', job_id=job_id)
+    return jsonify(info)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job['status'] != 'done':
+        return jsonify({"error": f"Job is {job['status']}", "status_url": url_for('job_status', job_id=job_id)}), 409
+    input_format, output_format = format_for(job['filename']), format_for(job['output_path'])
+    return send_file(job['output_path'], mimetype=MIMETYPES[output_format], as_attachment=True,
+                     download_name=updated_name(job['filename'], input_format, output_format))
+
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
+    if query_flag('async'):
+        return queue_upload_csv()
+    if query_flag('stream'):
+        return stream_upload_csv()
+
     file = request.files.get('file')
     if not file or not file.filename:
         return jsonify({"error": "No file provided"}), 400
     filename = secure_filename(file.filename)
+    try:
+        input_format, output_format = upload_formats(filename)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid format: {e}"}), 400
     path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     file.save(path)
 
-    updated = []
-    with open(path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile)
-        header = next(reader, [])
-        updated.append(header + ["Micromarket", "Zone"])
-        for row in reader:
-            if len(row) < 3:
-                updated.append(row + ["Invalid Row", ""])
-                continue
-            try:
-                lat, lon = float(row[1]), float(row[2])
-                micromarket_name, zone_name = get_micromarket_info(lat, lon)
-            except ValueError:
-                micromarket_name, zone_name = "Invalid Coordinates", ""
-            updated.append(row + [micromarket_name, zone_name])
-
-    out_name = f"updated_{filename}"
+    out_name = updated_name(filename, input_format, output_format)
     out_path = os.path.join(app.config['UPLOAD_FOLDER'], out_name)
-    with open(out_path, 'w', newline='', encoding='utf-8') as out_csv:
-        csv.writer(out_csv).writerows(updated)
+    enrich_table(path, out_path, RequestSummary(logger, f"upload_csv {filename}"))
+    return send_file(out_path, mimetype=MIMETYPES[output_format], as_attachment=True)
+
+def request_inventory():
+    """Return the name and PropertyIndex of the inventory a reverse query asks for.
+
+    Raises FileNotFoundError for an unknown inventory and ValueError for one
+    without coordinates.
+    """
+    name = request.args.get('inventory')
+    if not name:
+        return os.path.basename(INVENTORY_PATH), inventories.get(INVENTORY_PATH)
+    filename = secure_filename(name)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not filename.lower().endswith('.csv') or not os.path.isfile(path):
+        raise FileNotFoundError(f"No uploaded inventory {name}")
+    return filename, inventories.get(path)
+
+def properties_response(inventory_name, inventory, positions, **query):
+    """Return the JSON listing of the properties at positions, paged by ?offset= and ?limit=."""
+    offset = max(int(request.args.get('offset', 0)), 0)
+    limit = request.args.get('limit')
+    page = positions[offset:offset + max(int(limit), 0) if limit else None]
+    return jsonify({
+        **query,
+        "inventory": inventory_name,
+        "count": len(positions),
+        "offset": offset,
+        "properties": inventory.records(page)
+    })
+
+def properties_in_features(name_property, value):
+    """List the inventory properties a forward lookup places in the features where name_property is value."""
+    try:
+        inventory_name, inventory = request_inventory()
+        index = boundaries.index
+        positions = index.feature_positions(name_property, value)
+        if not len(positions):
+            return jsonify({"error": f"Unknown {name_property.lower()} {value}"}), 404
+        return properties_response(inventory_name, inventory,
+                                   inventory.in_features(index, positions, NEAREST_MAX_DISTANCE),
+                                   **{name_property.lower(): value})
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    except Exception as e:
+        logger.exception("Reverse query failed")
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+
+@app.route('/micromarket/<name>/properties')
+def micromarket_properties(name):
+    return properties_in_features('Micromarket', name)
+
+@app.route('/zone/<name>/properties')
+def zone_properties(name):
+    return properties_in_features('Zone', name)
+
+@app.route('/properties/within', methods=['POST'])
+def properties_within():
+    """List the inventory properties inside a posted GeoJSON Polygon or MultiPolygon.
+
+    The body may be a geometry, a Feature or a FeatureCollection.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a GeoJSON geometry, Feature or FeatureCollection"}), 400
+    features = body.get('features') if body.get('type') == 'FeatureCollection' else [body]
+    geometries = [feature.get('geometry') if feature.get('type') == 'Feature' else feature
+                  for feature in features or [] if isinstance(feature, dict)]
+    issues = []
+    polygons = [polygon for geometry in geometries if isinstance(geometry, dict)
+                for polygon in feature_parts(geometry, issues)]
+    if not polygons:
+        detail = '; '.join(detail for _, detail in issues) or "no polygons"
+        return jsonify({"error": f"Invalid polygon: {detail}"}), 400
+    try:
+        inventory_name, inventory = request_inventory()
+        return properties_response(inventory_name, inventory, inventory.within(polygons))
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    except Exception as e:
+        logger.exception("Reverse query failed")
+        return jsonify({"error": f"An error occurred: {e}"}), 500
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Route metrics are declared in micromarket_lookup, for every process alike
+undeclared = set(app.view_functions) - set(ROUTES)
+if undeclared:
+    raise RuntimeError(f"Add the routes {', '.join(sorted(undeclared))} to micromarket_lookup.ROUTES")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.endpoint
+    started = g.get('request_started')
+    if route in app.view_functions and started is not None:
+        status = f"{response.status_code // 100}xx"
+
+        def record():
+            request_seconds.observe(time.perf_counter() - started, route)
+            responses.inc(route, status)
+        # Streamed responses are timed until their last byte is sent
+        response.call_on_close(record)
+    return response
+
+@app.before_request
+def start_profile():
+    if request.endpoint in PROFILED_ROUTES and (
+            (request.headers.get('X-Profile') == '1' and is_admin_request()) or profiler.enabled_until()):
+        g.profile = profiler.start(request.endpoint, request.full_path.rstrip('?'))
 
-    return send_file(out_path, as_attachment=True)
+@app.after_request
+def finish_profile(response):
+    profile = g.get('profile')
+    if profile is not None:
+        response.headers['X-Profile'] = profile.name
+        # Streamed uploads are profiled until their last row is written
+        response.call_on_close(lambda: profile.stop(response.status_code))
+    return response
 
 if __name__ == '__main__':
-    print(f"Starting Flask app with GeoJSON: {DATA_FILE_PATH}")
+    logger.info("Starting Flask app with GeoJSON: %s", DATA_FILE_PATH)
     app.run(host='0.0.0.0', port=5000, debug=True)
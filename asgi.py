@@ -0,0 +1,259 @@
+"""ASGI entry point serving lookups from a single process.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+This serves POST /find_micromarket and POST /find_micromarket/batch with the
+same requests and responses as the Flask app, along with GET /version and
+GET /metrics. One process holds one copy of the boundary index. Its event
+loop keeps any number of idle keep-alive connections open at no cost, and
+single lookups are answered on the loop itself, as they take microseconds
+once cached. The index is warmed at startup and before every reload is
+swapped in, so no lookup on the loop builds the nearest-boundary tree; with
+a shared SQLite cache (MICROMARKET_CACHE_DB), lookups missing the in-memory
+cache go to the thread pool rather than blocking the loop on the file.
+
+Batches are parsed and classified on a bounded thread pool
+(MICROMARKET_ASGI_THREADS). The vectorized shapely and numpy work behind a
+batch releases the GIL, so the threads share the one index instead of each
+worker process loading its own. When MICROMARKET_ASGI_MAX_PENDING batches
+are already queued or running, further batches get a 503 with Retry-After
+rather than piling up in memory.
+
+The Flask app keeps serving everything else, uploads included. This module
+imports the lookups from micromarket_lookup rather than app.py, so it starts
+no job runner. uvicorn is not in requirements.txt; install it where this
+mode is used.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from log_config import RequestSummary, configure_logging
+from micromarket_lookup import (MAX_BATCH_SIZE, RELOAD_INTERVAL, ROUTES, boundaries, classify_batch_points,
+                                finite_coordinates, get_micromarket_info, lookup_cache, match_results, metrics,
+                                request_seconds, responses, stage_seconds, validate_batch_points)
+
+configure_logging()
+logger = logging.getLogger(__name__)
+
+ASGI_THREADS = int(os.environ.get('MICROMARKET_ASGI_THREADS', min(4, os.cpu_count() or 1)))
+ASGI_MAX_PENDING = int(os.environ.get('MICROMARKET_ASGI_MAX_PENDING', 4 * ASGI_THREADS))
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = list(headers)
+
+
+def json_body(value):
+    """Encode a response body the way Flask's jsonify does."""
+    return (json.dumps(value, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def parse_batch_body(body, ndjson, max_size):
+    """Return the points of a batch body, as app.read_batch_points does for Flask.
+
+    Raises ValueError for a malformed body and OverflowError when the batch
+    is larger than max_size.
+    """
+    if ndjson:
+        points = []
+        for line in body.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            if len(points) >= max_size:
+                raise OverflowError(f"Batch exceeds the maximum of {max_size} points")
+            points.append(json.loads(line))
+        return points
+
+    try:
+        points = json.loads(body) if body else None
+    except ValueError:
+        points = None
+    if isinstance(points, dict):
+        points = points.get('points')
+    if not isinstance(points, list):
+        raise ValueError("Expected a JSON array of points")
+    if len(points) > max_size:
+        raise OverflowError(f"Batch exceeds the maximum of {max_size} points")
+    return points
+
+
+def run_batch(body, ndjson):
+    """Classify a batch body on a pool thread; returns (status, content type, body)."""
+    parse_started = time.perf_counter()
+    try:
+        points = parse_batch_body(body, ndjson, MAX_BATCH_SIZE)
+    except OverflowError as e:
+        return 413, 'application/json', json_body({"error": str(e)})
+    except ValueError as e:
+        return 400, 'application/json', json_body({"error": f"Invalid batch: {e}"})
+    results, valid, coordinates = validate_batch_points(points)
+    stage_seconds.observe(time.perf_counter() - parse_started, 'parse')
+
+    summary = RequestSummary(logger, "find_micromarket/batch")
+    try:
+        classify_batch_points(results, valid, coordinates, summary)
+    except Exception as e:
+        logger.exception("Batch lookup failed")
+        return 500, 'application/json', json_body({"error": f"An error occurred: {e}"})
+    summary.log()
+
+    if ndjson:
+        return 200, 'application/x-ndjson', ''.join(json.dumps(result) + '\n' for result in results).encode('utf-8')
+    return 200, 'application/json', json_body({"results": results})
+
+
+class LookupService:
+    """The ASGI application: lookups on the event loop, batches on a bounded pool."""
+
+    def __init__(self, threads=ASGI_THREADS, max_pending=ASGI_MAX_PENDING,
+                 max_body=1024 * MAX_BATCH_SIZE):
+        self.threads = threads
+        self.max_pending = max_pending
+        # Enough for a full batch of points with their ids
+        self.max_body = max_body
+        self.pending = 0
+        self._executor = None
+        # path -> (method, route name shared with the Flask app's metrics, handler)
+        self.routes = {
+            '/find_micromarket': ('POST', 'find_micromarket', self.find_micromarket),
+            '/find_micromarket/batch': ('POST', 'find_micromarket_batch', self.find_micromarket_batch),
+            '/version': ('GET', 'boundary_version', self.version),
+            '/metrics': ('GET', 'prometheus_metrics', self.prometheus_metrics),
+        }
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi-batch')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                boundaries.warm = True
+                await asyncio.get_running_loop().run_in_executor(self.executor, boundaries.index.warm)
+                boundaries.watch(RELOAD_INTERVAL)
+                logger.info("ASGI lookup service serving %d micromarkets with %d batch threads",
+                            len(boundaries.index), self.threads)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        started = time.perf_counter()
+        method, route, handler = self.routes.get(scope['path'], (None, None, None))
+        headers = []
+        try:
+            if handler is None:
+                raise HTTPError(404, "Not found")
+            if scope['method'] != method:
+                raise HTTPError(405, "Method not allowed", [(b'allow', method.encode())])
+            status, content_type, body = await handler(scope, receive)
+        except HTTPError as e:
+            status, content_type, body = e.status, 'application/json', json_body({"error": str(e)})
+            headers = e.headers
+        except Exception as e:
+            logger.exception("Request to %s failed", scope['path'])
+            status, content_type, body = 500, 'application/json', json_body({"error": f"An error occurred: {e}"})
+        headers += [
+            (b'content-type', content_type.encode()),
+            (b'content-length', str(len(body)).encode()),
+            (b'x-boundary-version', (boundaries.index.version or '').encode()),
+        ]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+        if route in ROUTES:
+            request_seconds.observe(time.perf_counter() - started, route)
+            responses.inc(route, f"{status // 100}xx")
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise HTTPError(400, "Client disconnected")
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body:
+                raise HTTPError(413, f"Request body exceeds {self.max_body} bytes")
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def find_micromarket(self, scope, receive):
+        body = await self.read_body(receive)
+        try:
+            with stage_seconds.time('parse'):
+                if media_type(scope) == 'application/json':
+                    fields = json.loads(body or b'{}')
+                    if not isinstance(fields, dict):
+                        raise ValueError("expected a JSON object")
+                else:
+                    fields = dict(parse_qsl(body.decode('utf-8')))
+                lat, lon = finite_coordinates(fields.get('latitude', ''), fields.get('longitude', ''))
+        except (ValueError, TypeError) as e:
+            return 400, 'application/json', json_body({"error": f"Invalid coordinates: {e}"})
+        result = lookup_cache.cached(lat, lon)
+        if result is None and lookup_cache.backend is not None:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, get_micromarket_info, lat, lon)
+        elif result is None:
+            result = get_micromarket_info(lat, lon)
+        micromarket_name, zone_name, match, distance = result
+        match_results.inc(match)
+        return 200, 'application/json', json_body({
+            "latitude": lat,
+            "longitude": lon,
+            "micromarket_name": micromarket_name,
+            "zone_name": zone_name,
+            "match": match,
+            "distance_m": distance
+        })
+
+    async def find_micromarket_batch(self, scope, receive):
+        body = await self.read_body(receive)
+        if self.pending >= self.max_pending:
+            raise HTTPError(503, "Too many batches in progress, retry later", [(b'retry-after', b'1')])
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, run_batch, body, media_type(scope) in NDJSON_TYPES)
+        finally:
+            self.pending -= 1
+
+    async def version(self, scope, receive):
+        return 200, 'application/json', json_body(boundaries.info())
+
+    async def prometheus_metrics(self, scope, receive):
+        text = await asyncio.get_running_loop().run_in_executor(self.executor, metrics.render)
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', text.encode('utf-8')
+
+
+def media_type(scope):
+    """Return the media type of a request, without parameters."""
+    for name, value in scope['headers']:
+        if name == b'content-type':
+            return value.decode('latin-1').split(';')[0].strip().lower()
+    return ''
+
+
+app = LookupService()
@@ -0,0 +1,381 @@
+"""Load test of the deployed app under a ramp of concurrent clients.
+
+Starts app:app under gunicorn with the worker count render.yaml uses (or
+targets a running server with --url) and replays a mix of requests built
+from the data.csv coordinates: single lookups, batch calls of a few sizes
+and CSV uploads of a few sizes. Concurrency is ramped through --concurrency,
+holding each level for --duration seconds:
+
+    python benchmarks/load_test.py --concurrency 1,4,16,32 --duration 30 --output load.json
+
+Each level reports throughput, p50/p95/p99 latency and the error rate per
+request kind, and the resident memory of every worker is sampled once a
+second throughout. With --slo-p99-ms or --max-error-rate the report says
+which levels met them and the exit status is 1 if any did not.
+
+The clients are threads of this process, each holding its own connection;
+on a small machine they compete with the server for CPU, so compare runs
+made on the same machine.
+"""
+import argparse
+import csv
+import http.client
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from enrichment import detect_layout, parse_coordinates
+from run_benchmarks import git_revision
+
+KINDS = ('single', 'batch', 'upload')
+DEFAULT_MIX = 'single=90,batch=8,upload=2'
+BATCH_SIZES = (10, 100, 1000)
+UPLOAD_ROWS = (100, 1000, 5000)
+
+
+def load_coordinates(path):
+    """Return the (lat, lon) of every row of an inventory CSV with usable coordinates."""
+    coordinates = []
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        layout = detect_layout(next(reader, []))
+        for row in reader:
+            try:
+                point = parse_coordinates(row, layout)
+            except (ValueError, IndexError):
+                continue
+            if point is not None and -90 <= point[0] <= 90 and -180 <= point[1] <= 180:
+                coordinates.append(point)
+    return coordinates
+
+
+def parse_mix(text):
+    """Return {kind: weight} from "single=90,batch=8,upload=2"."""
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind.strip() not in KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown request kind {kind.strip()!r}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def upload_body(coordinates, boundary):
+    """Return a multipart/form-data body uploading coordinates as a project CSV."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Project Name", "Latitude", "Longitude", "Google Maps URL"])
+    for i, (lat, lon) in enumerate(coordinates):
+        writer.writerow([f"Project {i}", f"{lat:.7f}", f"{lon:.7f}", f"https://maps.example.com/{i}"])
+    return (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"load_test.csv\"\r\n"
+            f"Content-Type: text/csv\r\n\r\n{buffer.getvalue()}\r\n--{boundary}--\r\n").encode('utf-8')
+
+
+class RequestMix:
+    """Builds (kind, method, path, body, headers) requests in the configured proportions."""
+
+    def __init__(self, coordinates, mix, seed):
+        self.coordinates = coordinates
+        self.kinds = list(mix)
+        self.weights = np.array(list(mix.values())) / sum(mix.values())
+        self.seed = seed
+        # Upload bodies are built once per size; building them per request would load the client
+        boundary = uuid.uuid4().hex
+        rng = random.Random(seed)
+        self.uploads = [(rows, upload_body(rng.choices(coordinates, k=rows), boundary)) for rows in UPLOAD_ROWS]
+        self.upload_type = f"multipart/form-data; boundary={boundary}"
+
+    def generator(self, client):
+        """Return a function producing the requests of one client, reproducibly."""
+        rng = random.Random(f"{self.seed}:{client}")
+        kinds = self.kinds
+        weights = self.weights.tolist()
+
+        def next_request():
+            kind = rng.choices(kinds, weights)[0]
+            if kind == 'single':
+                lat, lon = rng.choice(self.coordinates)
+                return (kind, 'POST', '/find_micromarket', urlencode({'latitude': lat, 'longitude': lon}).encode(),
+                        {'Content-Type': 'application/x-www-form-urlencoded'})
+            if kind == 'batch':
+                points = [{'id': i, 'latitude': lat, 'longitude': lon}
+                          for i, (lat, lon) in enumerate(rng.choices(self.coordinates, k=rng.choice(BATCH_SIZES)))]
+                return kind, 'POST', '/find_micromarket/batch', json.dumps(points).encode(), {
+                    'Content-Type': 'application/json'}
+            _, body = rng.choice(self.uploads)
+            return kind, 'POST', '/upload_csv?stream=1', body, {'Content-Type': self.upload_type}
+
+        return next_request
+
+
+def run_client(url, next_request, deadline, samples, timeout):
+    """Send requests on one connection until the deadline; appends (kind, start, seconds, status)."""
+    parts = urlsplit(url)
+    connection = None
+    while time.time() < deadline:
+        kind, method, path, body, headers = next_request()
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            status = 0
+            if connection is not None:
+                connection.close()
+            connection = None
+        samples.append((kind, time.time(), time.perf_counter() - started, status))
+    if connection is not None:
+        connection.close()
+
+
+def worker_pids(master_pid):
+    """Return the pids of the children of a gunicorn master, read from /proc (empty without it)."""
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', encoding='utf-8') as f:
+                # The parent pid follows the parenthesised command name
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def rss_mb(pid):
+    """Return the resident memory of a process in MB, or None where /proc is unavailable."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Records the RSS of every worker of a gunicorn master once per interval."""
+
+    def __init__(self, master_pid, interval=1.0):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.samples = []  # (time, {pid: MB})
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            rss = {pid: rss_mb(pid) for pid in worker_pids(self.master_pid)}
+            self.samples.append((time.time(), {pid: mb for pid, mb in rss.items() if mb is not None}))
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def start_server(workers, port, log_path):
+    """Start app:app under gunicorn and return the process once it answers."""
+    env = dict(os.environ)
+    env.setdefault('MICROMARKET_LOG_LEVEL', 'WARNING')
+    env.setdefault('MICROMARKET_METRICS_DIR', tempfile.mkdtemp(prefix='load_test_metrics_'))
+    log = open(log_path, 'wb')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', '--timeout', '120',
+         'app:app'], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {server.returncode}; see {log_path}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/version')
+            # Wait for every worker to have forked, where /proc can tell
+            if connection.getresponse().status == 200 and (
+                    len(worker_pids(server.pid)) >= workers or not os.path.isdir('/proc')):
+                return server, url
+        except OSError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"gunicorn did not answer within 120s; see {log_path}")
+
+
+def level_stats(samples, duration):
+    """Return per-kind and overall throughput, latency percentiles and error rate."""
+    stats = {}
+    for kind in (*KINDS, 'all'):
+        chosen = [sample for sample in samples if kind == 'all' or sample[0] == kind]
+        if not chosen:
+            continue
+        latencies = np.array([sample[2] for sample in chosen]) * 1000
+        errors = sum(1 for sample in chosen if not 200 <= sample[3] < 300)
+        stats[kind] = {
+            "requests": len(chosen),
+            "throughput_rps": len(chosen) / duration,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "error_rate": errors / len(chosen),
+        }
+    return stats
+
+
+def run_level(url, request_mix, concurrency, duration, timeout):
+    samples = []
+    deadline = time.time() + duration
+    clients = [threading.Thread(target=run_client, daemon=True,
+                                args=(url, request_mix.generator(i), deadline, samples, timeout))
+               for i in range(concurrency)]
+    started = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    # Requests still in flight at the deadline end after it
+    return samples, max(time.time() - started, duration)
+
+
+def check_slo(stats, args):
+    """Return the SLO verdict of one level, or None when no SLO was given."""
+    if args.slo_p99_ms is None and args.max_error_rate is None:
+        return None
+    failures = []
+    single = stats.get('single')
+    if args.slo_p99_ms is not None and single is not None and single['p99_ms'] > args.slo_p99_ms:
+        failures.append(f"single p99 {single['p99_ms']:.1f} ms > {args.slo_p99_ms:g} ms")
+    if args.max_error_rate is not None and stats['all']['error_rate'] > args.max_error_rate:
+        failures.append(f"error rate {stats['all']['error_rate']:.2%} > {args.max_error_rate:.2%}")
+    return {"passed": not failures, "failures": failures}
+
+
+def print_level(concurrency, stats, rss, slo):
+    print(f"concurrency {concurrency}:", file=sys.stderr)
+    for kind, kind_stats in stats.items():
+        print(f"  {kind:<7} {kind_stats['requests']:>7} req {kind_stats['throughput_rps']:>9.1f} req/s  "
+              f"p50 {kind_stats['p50_ms']:>8.1f}  p95 {kind_stats['p95_ms']:>8.1f}  p99 {kind_stats['p99_ms']:>8.1f} ms"
+              f"  errors {kind_stats['error_rate']:.2%}", file=sys.stderr)
+    if rss:
+        print(f"  worker RSS max {max(rss.values()):.0f} MB, total {sum(rss.values()):.0f} MB", file=sys.stderr)
+    if slo is not None:
+        print(f"  SLO {'met' if slo['passed'] else 'missed: ' + '; '.join(slo['failures'])}", file=sys.stderr)
+
+
+def run(args):
+    coordinates = load_coordinates(args.inventory)
+    request_mix = RequestMix(coordinates, args.mix, args.seed)
+    server = None
+    master_pid = args.pid
+    url = args.url
+    if url is None:
+        log_path = os.path.join(tempfile.gettempdir(), 'load_test_gunicorn.log')
+        server, url = start_server(args.workers, args.port, log_path)
+        master_pid = server.pid
+    sampler = MemorySampler(master_pid) if master_pid else None
+    if sampler is not None:
+        sampler.start()
+
+    levels = []
+    try:
+        for concurrency in args.concurrency:
+            level_started = time.time()
+            samples, elapsed = run_level(url, request_mix, concurrency, args.duration, args.timeout)
+            stats = level_stats(samples, elapsed)
+            rss = {}
+            if sampler is not None:
+                during = [sample for at, sample in sampler.samples if at >= level_started]
+                for sample in during:
+                    for pid, mb in sample.items():
+                        rss[pid] = max(rss.get(pid, 0), mb)
+            slo = check_slo(stats, args)
+            print_level(concurrency, stats, rss, slo)
+            levels.append({"concurrency": concurrency, "duration_s": elapsed, "stats": stats,
+                           "worker_rss_max_mb": {str(pid): mb for pid, mb in rss.items()}, "slo": slo})
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "url": url,
+            "workers": args.workers if server is not None else None,
+            "inventory": args.inventory,
+            "coordinates": len(coordinates),
+            "mix": args.mix,
+            "batch_sizes": BATCH_SIZES,
+            "upload_rows": UPLOAD_ROWS,
+            "seed": args.seed,
+            "duration_s": args.duration,
+            "slo_p99_ms": args.slo_p99_ms,
+            "max_error_rate": args.max_error_rate,
+        },
+        "levels": levels,
+        "worker_rss_mb": [{"time": at, "rss": {str(pid): mb for pid, mb in sample.items()}}
+                          for at, sample in (sampler.samples if sampler is not None else [])],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test app:app under ramped concurrency.")
+    parser.add_argument('--url', help="test a running server instead of starting gunicorn")
+    parser.add_argument('--pid', type=int, help="with --url, the gunicorn master whose workers' RSS to sample")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers to start")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', default=[1, 4, 16, 32],
+                        type=lambda text: [int(level) for level in text.split(',')],
+                        help="comma-separated concurrent clients per level")
+    parser.add_argument('--duration', type=float, default=20, help="seconds per level")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"request kinds and weights (default {DEFAULT_MIX})")
+    parser.add_argument('--inventory', default=os.path.join(ROOT, 'data.csv'), help="CSV to take coordinates from")
+    parser.add_argument('--seed', type=int, default=20241106)
+    parser.add_argument('--timeout', type=float, default=60, help="seconds before a request counts as an error")
+    parser.add_argument('--slo-p99-ms', type=float, help="p99 target for single lookups")
+    parser.add_argument('--max-error-rate', type=float, help="highest acceptable share of failed requests")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if any(level['slo'] is not None and not level['slo']['passed'] for level in report['levels']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
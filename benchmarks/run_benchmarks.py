@@ -0,0 +1,222 @@
+"""Benchmarks for the lookup, batch and upload paths.
+
+Generates reproducible point sets over the extent of Data/new.geojson:
+points inside micromarkets, points exactly on their boundaries and points
+outside every micromarket. Each path is timed against each set and the
+results are written as JSON for comparison across releases:
+
+    python benchmarks/run_benchmarks.py --output bench.json
+
+Single lookups report per-call p50/p90/p99 latency; batch, upload and
+process_csv runs report per-run latency and rows/sec.
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MICROMARKET_LOG_LEVEL', 'WARNING')
+os.environ.setdefault('MICROMARKET_RELOAD_INTERVAL', '0')
+
+import numpy as np
+import shapely
+
+POINT_SETS = ('inside', 'boundary', 'outside')
+
+
+def generate_points(index, kind, n, rng):
+    """Return (lats, lons) arrays of n points of one kind."""
+    parts = index.parts
+    if kind == 'boundary':
+        rings = shapely.get_exterior_ring(shapely.get_geometry(parts, 0))
+        chosen = rings[rng.integers(0, len(rings), n)]
+        points = shapely.line_interpolate_point(chosen, rng.random(n), normalized=True)
+        coords = shapely.get_coordinates(points)
+        return coords[:, 1], coords[:, 0]
+
+    min_x, min_y, max_x, max_y = shapely.total_bounds(parts)
+    lats = []
+    lons = []
+    while sum(len(chunk) for chunk in lats) < n:
+        xs = rng.uniform(min_x, max_x, n)
+        ys = rng.uniform(min_y, max_y, n)
+        inside = index.locate_many(ys, xs) >= 0
+        keep = inside if kind == 'inside' else ~inside
+        lats.append(ys[keep])
+        lons.append(xs[keep])
+    return np.concatenate(lats)[:n], np.concatenate(lons)[:n]
+
+
+def latency_stats(samples):
+    samples = np.asarray(samples, dtype=float)
+    return {
+        "calls": len(samples),
+        "mean_us": float(samples.mean() * 1e6),
+        "p50_us": float(np.percentile(samples, 50) * 1e6),
+        "p90_us": float(np.percentile(samples, 90) * 1e6),
+        "p99_us": float(np.percentile(samples, 99) * 1e6),
+    }
+
+
+def run_stats(durations, rows):
+    stats = latency_stats(durations)
+    stats["rows"] = rows
+    stats["rows_per_sec"] = float(rows / np.median(durations))
+    return stats
+
+
+def time_calls(fn, args):
+    samples = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(*arg)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_runs(fn, repeat):
+    fn()  # warm up
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def upload_csv_bytes(lats, lons):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Project Name", "Latitude", "Longitude", "Google Maps URL"])
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        writer.writerow([f"Project {i}", f"{lat:.7f}", f"{lon:.7f}", f"https://maps.example.com/{i}"])
+    return buffer.getvalue().encode('utf-8')
+
+
+def process_csv_text(lats, lons):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["propertyId", "coordinates"])
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        writer.writerow([f"P{i}", f"{lat}, {lon}"])
+    return buffer.getvalue()
+
+
+def load_update_mm():
+    spec = importlib.util.spec_from_file_location('update_mm', os.path.join(ROOT, 'update-mm.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    os.chdir(ROOT)
+    import app
+    from micromarket_lookup import (boundaries, get_micromarket_info, get_micromarket_info_batch, lookup_cache,
+                                    lookup_micromarket_info)
+    update_mm = load_update_mm()
+
+    index = boundaries.index
+    rng = np.random.default_rng(args.seed)
+    point_sets = {kind: generate_points(index, kind, args.points, rng) for kind in POINT_SETS}
+    client = app.app.test_client()
+    results = []
+
+    def record(name, kind, stats):
+        results.append({"benchmark": name, "points": kind, **stats})
+        print(f"{name:<28} {kind:<9} p50 {stats['p50_us']:>12.1f} us  p99 {stats['p99_us']:>12.1f} us",
+              file=sys.stderr)
+
+    for kind, (lats, lons) in point_sets.items():
+        coordinates = list(zip(lats.tolist(), lons.tolist()))[:args.single]
+
+        record("lookup_uncached", kind, latency_stats(time_calls(lookup_micromarket_info, coordinates)))
+        lookup_cache.clear()
+        record("get_micromarket_info_cold", kind, latency_stats(time_calls(get_micromarket_info, coordinates)))
+        record("get_micromarket_info_warm", kind, latency_stats(time_calls(get_micromarket_info, coordinates)))
+
+        durations = time_runs(lambda: get_micromarket_info_batch(lats, lons), args.repeat)
+        record("batch", kind, run_stats(durations, len(lats)))
+
+        upload = upload_csv_bytes(lats[:args.rows], lons[:args.rows])
+        rows = min(args.rows, len(lats))
+        for name, url in (("upload_csv", '/upload_csv'), ("upload_csv_stream", '/upload_csv?stream=1')):
+            def post():
+                response = client.post(url, data={'file': (io.BytesIO(upload), 'bench.csv')})
+                assert response.status_code == 200, response.status_code
+                response.get_data()
+            record(name, kind, run_stats(time_runs(post, args.repeat), rows))
+
+        text = process_csv_text(lats[:args.rows], lons[:args.rows])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.csv')
+
+            def process():
+                with open(path, 'w', encoding='utf-8', newline='') as f:
+                    f.write(text)
+                update_mm.process_csv(path)
+            record("process_csv", kind, run_stats(time_runs(process, args.repeat), rows))
+
+    # The buffered upload route keeps its input and output under uploads/
+    for filename in ('bench.csv', 'updated_bench.csv'):
+        path = os.path.join(app.app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "boundary_version": index.version,
+            "grid": index.grid is not None,
+            "python": platform.python_version(),
+            "shapely": shapely.__version__,
+            "numpy": np.__version__,
+            "seed": args.seed,
+            "points": args.points,
+            "single_calls": args.single,
+            "rows": args.rows,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark micromarket lookups and uploads.")
+    parser.add_argument('--seed', type=int, default=20241106)
+    parser.add_argument('--points', type=int, default=20000, help="points per set for batch runs")
+    parser.add_argument('--single', type=int, default=2000, help="single lookups timed per set")
+    parser.add_argument('--rows', type=int, default=5000, help="rows per upload/process_csv run")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per batch/upload benchmark")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Reclassify only the points affected by edits to the boundary file.
+
+Compares two versions of a GeoJSON boundary file and works out, for each
+changed micromarket, the region where a point can get a different label:
+
+    reshaped     symmetric difference of the old and new shape
+    added        the new shape
+    removed      the old shape
+    properties   the whole shape, when its Zone or other properties changed
+    reordered    the overlap of two micromarkets whose file order flipped,
+                 since the first one listed wins where they overlap
+
+Points outside every micromarket take the nearest one within
+NEAREST_MAX_DISTANCE meters, so each region is widened by that distance.
+
+Given a CSV enriched with the old version (see enrichment.py), only rows
+inside those regions are classified again; every other row keeps its labels
+and gets the new boundary tag. Rows that moved between micromarkets are
+written to a report:
+
+    python boundary_diff.py old.geojson Data/new.geojson --csv data.csv --report moved.csv
+"""
+import argparse
+import csv
+import logging
+import os
+from collections import Counter
+import numpy as np
+import shapely
+from csv_stream import iter_batches
+from log_config import configure_logging
+from micromarket_store import load_index
+import enrichment
+
+logger = logging.getLogger(__name__)
+
+NAME_PROPERTIES = ('Name', 'Micromarket')
+
+
+def feature_geometries(index, name_properties=NAME_PROPERTIES):
+    """Return {key: (position, properties, geometry)} for the features of an index.
+
+    Features are keyed by their name properties and, for repeated names, the
+    occurrence of that name in file order.
+    """
+    bounds = np.searchsorted(index.part_features, np.arange(len(index) + 1))
+    seen = Counter()
+    features = {}
+    for position, properties in enumerate(index.properties):
+        name = tuple(properties.get(name) for name in name_properties)
+        key = (name, seen[name])
+        seen[name] += 1
+        features[key] = (position, properties, shapely.union_all(index.parts[bounds[position]:bounds[position + 1]]))
+    return features
+
+
+def describe_key(key):
+    name, occurrence = key
+    label = ' / '.join(str(part) for part in name if part)
+    return f"{label} #{occurrence + 1}" if occurrence else label
+
+
+def changed_regions(old_index, new_index, name_properties=NAME_PROPERTIES, max_distance=0):
+    """Return a list of (key, change, region) for every change between two indexes.
+
+    With max_distance, in meters, regions also cover the points whose nearest
+    micromarket within that distance may have changed.
+    """
+    old = feature_geometries(old_index, name_properties)
+    new = feature_geometries(new_index, name_properties)
+    changes = []
+    for key, (_, _, geometry) in old.items():
+        if key not in new:
+            changes.append((key, 'removed', geometry))
+    for key, (_, properties, geometry) in new.items():
+        if key not in old:
+            changes.append((key, 'added', geometry))
+            continue
+        _, old_properties, old_geometry = old[key]
+        if properties != old_properties:
+            changes.append((key, 'properties', shapely.union(old_geometry, geometry)))
+        elif not shapely.equals(old_geometry, geometry):
+            changes.append((key, 'reshaped', shapely.symmetric_difference(old_geometry, geometry)))
+
+    # Where two micromarkets overlap the first in file order wins, so a flipped order matters too
+    keys = list(new)
+    left, right = new_index.tree.query(new_index.parts, predicate='intersects')
+    pairs = set(zip(new_index.part_features[left].tolist(), new_index.part_features[right].tolist()))
+    for a, b in sorted(pairs):
+        if a >= b or keys[a] not in old or keys[b] not in old:
+            continue
+        if old[keys[a]][0] > old[keys[b]][0]:
+            overlap = shapely.intersection(new[keys[a]][2], new[keys[b]][2])
+            if not overlap.is_empty:
+                changes.append((keys[a], 'reordered', overlap))
+
+    if max_distance > 0:
+        # A degree of longitude is the shorter one, so this widens by at least max_distance
+        degrees = max_distance / min(old_index.metric_scale()[0], new_index.metric_scale()[0])
+        changes = [(key, change, shapely.buffer(region, degrees)) for key, change, region in changes]
+    return changes
+
+
+def reclassify_csv(input_csv, output_csv, old_index, regions, report_csv=None):
+    """Re-run classification for the rows of an enriched CSV inside regions.
+
+    The current enrichment index must already be the new boundary version.
+    Rows tagged with neither the old nor the new boundaries are classified
+    again as well. Returns (rows, reclassified, moved).
+    """
+    region = shapely.union_all(regions) if regions else shapely.Polygon()
+    shapely.prepare(region)
+    old_tag = enrichment.boundary_tag(old_index) + ':'
+    new_tag = enrichment.boundary_tag() + ':'
+
+    with open(input_csv, mode='r', encoding='utf-8', newline='') as infile:
+        reader = csv.reader(infile)
+        header = next(reader, None)
+        layout = enrichment.detect_layout(header)
+        if layout is None:
+            raise ValueError("Invalid CSV format")
+        columns = enrichment.OutputColumns(header)
+        if 'Micromarket' not in columns.existing:
+            raise ValueError(f"{input_csv} has no Micromarket column; enrich it with update-mm.py first")
+        tagged = enrichment.TAG_COLUMN in columns.existing
+
+        report_file = open(report_csv, mode='w', encoding='utf-8', newline='') if report_csv else None
+        partial_csv = output_csv + '.partial'
+        rows_seen = reclassified = moved = 0
+        try:
+            with open(partial_csv, mode='w', encoding='utf-8', newline='') as outfile:
+                writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(columns.header)
+                report = csv.writer(report_file) if report_file else None
+                if report:
+                    report.writerow(['Row', header[0], 'Latitude', 'Longitude', 'Old Micromarket',
+                                     'New Micromarket', 'Old Area', 'New Area'])
+
+                first_row = 2  # Start at 2 since header is row 1
+                for rows in iter_batches(reader, enrichment.DEFAULT_CHUNK_ROWS):
+                    out_rows = [columns.arrange(row) for row in rows]
+                    stale = []
+                    points = []
+                    for i, (row, out) in enumerate(zip(rows, out_rows)):
+                        try:
+                            coordinates = enrichment.parse_coordinates(row, layout)
+                        except (ValueError, IndexError):
+                            continue
+                        if coordinates is None:
+                            continue
+                        tag = enrichment.coordinates_hash(row, layout)
+                        if tagged and out[columns.tag] not in (old_tag + tag, new_tag + tag):
+                            stale.append(i)
+                        else:
+                            points.append((i, *coordinates))
+
+                    affected = set(stale)
+                    if points:
+                        positions, lats, lons = (np.array(values) for values in zip(*points))
+                        inside = shapely.intersects_xy(region, lons, lats)
+                        affected.update(positions[inside].tolist())
+                        for i in positions[~inside].tolist():
+                            out_rows[i][columns.tag] = new_tag + enrichment.coordinates_hash(rows[i], layout)
+
+                    affected = sorted(affected)
+                    if affected:
+                        enriched = enrichment.enrich_chunk([rows[i] for i in affected], first_row + affected[0],
+                                                           columns, layout, incremental=False)[0]
+                        for i, new_row in zip(affected, enriched):
+                            old_row = out_rows[i]
+                            out_rows[i] = new_row
+                            changed = (old_row[columns.micromarket] != new_row[columns.micromarket]
+                                       or old_row[columns.area] != new_row[columns.area])
+                            if changed:
+                                moved += 1
+                                if report:
+                                    lat, lon = enrichment.parse_coordinates(rows[i], layout)
+                                    report.writerow([first_row + i, rows[i][0] if rows[i] else '', lat, lon,
+                                                     old_row[columns.micromarket], new_row[columns.micromarket],
+                                                     old_row[columns.area], new_row[columns.area]])
+
+                    writer.writerows(out_rows)
+                    rows_seen += len(rows)
+                    reclassified += len(affected)
+                    first_row += len(rows)
+        except BaseException:
+            os.remove(partial_csv)
+            raise
+        finally:
+            if report_file:
+                report_file.close()
+
+    os.replace(partial_csv, output_csv)
+    return rows_seen, reclassified, moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reclassify only the points affected by boundary edits.")
+    parser.add_argument('old', help="previous version of the GeoJSON boundary file")
+    parser.add_argument('new', nargs='?', default=enrichment.DATA_FILE_PATH, help="current GeoJSON boundary file")
+    parser.add_argument('--csv', help="CSV enriched with the old boundaries to update")
+    parser.add_argument('-o', '--output', help="file to write (default: replace the CSV)")
+    parser.add_argument('--report', help="write the rows that moved between micromarkets here")
+    args = parser.parse_args()
+
+    configure_logging()
+    old_index = load_index(args.old, NAME_PROPERTIES)
+    new_index = enrichment.load_boundaries(args.new)
+    changes = changed_regions(old_index, new_index, max_distance=enrichment.NEAREST_MAX_DISTANCE)
+    for key, change, region in changes:
+        print(f"{change:<11} {describe_key(key)}  ({region.area:.6f} sq deg)")
+    print(f"{len(changes)} changes between {len(old_index)} and {len(new_index)} micromarkets")
+
+    if args.csv:
+        output = args.output or args.csv
+        rows, reclassified, moved = reclassify_csv(args.csv, output, old_index,
+                                                   [region for _, _, region in changes], args.report)
+        print(f"Reclassified {reclassified} of {rows} rows, {moved} moved; wrote {output}")
+        if args.report:
+            print(f"Wrote {args.report}")
+
+
+if __name__ == '__main__':
+    main()
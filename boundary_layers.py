@@ -0,0 +1,234 @@
+"""Several boundary layers answered by one spatial query.
+
+A layer is a set of named areas from one boundary file: the micromarkets of
+Data/new.geojson, the zones they belong to, or another dataset such as
+Data/coordinate2.json. Each layer is compiled into its own store (see
+micromarket_store) the first time it is asked for and loaded from there
+afterwards. The layers asked for together share one STRtree, so a point is
+matched against all of them in a single query:
+
+    layers = BoundaryLayers(default_layers('Data'))
+    layers.lookup(12.97, 77.59)
+    # {'micromarket': {'Micromarket': 'Chickpet', 'Zone': 'Central'},
+    #  'zone': {'Zone': 'Central'}, 'coordinate2': {'Micromarket': 'Chickpet'}}
+
+Layers can instead be listed in a JSON file, with paths relative to it:
+
+    [{"name": "micromarket", "path": "Data/new.geojson", "property": "Micromarket"},
+     {"name": "zone", "path": "Data/new.geojson", "property": "Zone", "dissolve": true},
+     {"name": "sub_micromarket", "path": "Data/submicromarket.geojson", "property": "Name"}]
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import numpy as np
+import shapely
+from micromarket_grid import file_digest
+from micromarket_index import MicromarketIndex, geojson_feature_parts, polygonal_parts
+from micromarket_store import CompiledStore, compile_features, compile_geojson, current_store, store_path_for
+
+logger = logging.getLogger(__name__)
+
+
+def dissolve_features(feature_parts, name_property):
+    """Merge the polygons of features sharing a value of name_property.
+
+    Returns ({name_property: value}, polygons) pairs in the order each value
+    first appears; features without the property are left out.
+    """
+    groups = {}
+    for properties, polygons in feature_parts:
+        value = properties.get(name_property)
+        if value and polygons:
+            groups.setdefault(value, []).extend(polygons)
+    return [({name_property: value}, polygonal_parts(shapely.union_all(polygons)))
+            for value, polygons in groups.items()]
+
+
+class Layer:
+    """The features of one boundary file that have a name_property.
+
+    With dissolve, features sharing a value of name_property are merged
+    into one area per value, which derives zones from the micromarkets.
+    """
+
+    def __init__(self, name, path, name_property='Micromarket', dissolve=False):
+        self.name = name
+        self.path = path
+        self.name_property = name_property
+        self.dissolve = dissolve
+
+    @property
+    def store_path(self):
+        if self.dissolve:
+            return f"{os.path.splitext(self.path)[0]}.{self.name_property.lower()}.mmb"
+        return store_path_for(self.path)
+
+    def digest(self):
+        """Return the digest identifying the compiled form of this layer."""
+        digest = file_digest(self.path)
+        if self.dissolve:
+            digest = hashlib.sha256(digest + f"dissolve:{self.name_property}".encode('utf-8')).digest()
+        return digest
+
+    def signature(self):
+        """Return the (mtime, size) of the source file, or None if it is missing."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Return the index for this layer, compiling its store first if needed."""
+        digest = self.digest()
+        store = current_store(self.store_path, digest)
+        if store is None:
+            self.compile(digest)
+            store = CompiledStore(self.store_path)
+        index = MicromarketIndex.from_parts(store.feature_parts(), (self.name_property,), store.feature_tiers())
+        index.version = digest.hex()
+        return index
+
+    def compile(self, digest):
+        if self.dissolve:
+            with open(self.path, encoding='utf-8') as f:
+                feature_parts = geojson_feature_parts(json.load(f).get('features', []))
+            compile_features(dissolve_features(feature_parts, self.name_property), digest, self.store_path)
+        else:
+            compile_geojson(self.path, self.store_path)
+        logger.info("Compiled layer %s into %s", self.name, self.store_path)
+
+    def info(self):
+        return {"name": self.name, "path": self.path, "property": self.name_property, "dissolve": self.dissolve}
+
+
+def default_layers(data_dir):
+    """Return the micromarket, zone and coordinate2 layers of the bundled data."""
+    new_geojson = os.path.join(data_dir, 'new.geojson')
+    return [
+        Layer('micromarket', new_geojson, 'Micromarket'),
+        Layer('zone', new_geojson, 'Zone', dissolve=True),
+        Layer('coordinate2', os.path.join(data_dir, 'coordinate2.json'), 'Micromarket'),
+    ]
+
+
+def load_layer_config(path):
+    """Return the layers listed in a JSON config file."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    return [Layer(entry['name'], os.path.join(base_dir, entry['path']), entry.get('property', 'Micromarket'),
+                  bool(entry.get('dissolve', False))) for entry in entries]
+
+
+class LayeredIndex:
+    """One spatial index over the features of several layers."""
+
+    def __init__(self, names, indexes):
+        self.names = list(names)
+        self.indexes = list(indexes)
+        self.combined = MicromarketIndex.combine(self.indexes)
+        sizes = [len(index) for index in self.indexes]
+        self.offsets = np.cumsum([0] + sizes)
+        self.feature_layers = np.repeat(np.arange(len(sizes)), sizes)
+
+    def locate_many(self, lats, lons):
+        """Return {layer name: positions} of the feature of each layer containing each point.
+
+        Positions are -1 where no feature of the layer contains the point;
+        within a layer the feature listed first wins.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        missing = len(self.combined)
+        positions = np.full((len(self.names), len(lats)), missing, dtype=np.intp)
+        point_idx, features = self.combined.containing(lats, lons)
+        np.minimum.at(positions, (self.feature_layers[features], point_idx), features)
+        positions = np.where(positions < missing, positions - self.offsets[:-1, None], -1)
+        return dict(zip(self.names, positions))
+
+    def lookup(self, lat, lon):
+        """Return {layer name: properties, or None} for one point."""
+        located = self.locate_many([lat], [lon])
+        return {name: index.properties[located[name][0]] if located[name][0] >= 0 else None
+                for name, index in zip(self.names, self.indexes)}
+
+
+class BoundaryLayers:
+    """Layers loaded on first use and reloaded when their source file changes."""
+
+    def __init__(self, layers):
+        self.layers = {layer.name: layer for layer in layers}
+        self._loaded = {}  # name -> (signature, index or None, error)
+        self._layered = {}  # names -> LayeredIndex
+        self._lock = threading.Lock()
+
+    @property
+    def names(self):
+        return list(self.layers)
+
+    def index(self, name):
+        """Return the current index of a layer, or None if it cannot be loaded."""
+        layer = self.layers[name]
+        signature = layer.signature()
+        loaded = self._loaded.get(name)
+        if loaded is None or loaded[0] != signature:
+            with self._lock:
+                loaded = self._loaded.get(name)
+                if loaded is None or loaded[0] != signature:
+                    loaded = self._load(layer, signature, loaded)
+        return loaded[1]
+
+    def _load(self, layer, signature, previous):
+        try:
+            index = layer.load()
+            error = None
+            logger.info("Loaded layer %s: %d features (version %s)", layer.name, len(index), index.version[:12])
+        except Exception as e:
+            error = str(e)
+            logger.error("Could not load layer %s: %s", layer.name, e)
+            # Keep serving the last good version of the layer
+            index = previous[1] if previous is not None else None
+        self._loaded[layer.name] = loaded = (signature, index, error)
+        return loaded
+
+    def layered(self, names=None):
+        """Return a LayeredIndex over the named layers that could be loaded.
+
+        Raises KeyError for names that are not configured layers.
+        """
+        names = tuple(names or self.layers)
+        unknown = [name for name in names if name not in self.layers]
+        if unknown:
+            raise KeyError(f"Unknown layers: {', '.join(unknown)}")
+        available = [(name, index) for name, index in ((name, self.index(name)) for name in names)
+                     if index is not None]
+        layered = self._layered.get(names)
+        if layered is None or [(name, id(index)) for name, index in available] != [
+                (name, id(index)) for name, index in zip(layered.names, layered.indexes)]:
+            layered = LayeredIndex([name for name, _ in available], [index for _, index in available])
+            self._layered[names] = layered
+        return layered
+
+    def lookup(self, lat, lon, names=None):
+        """Return {layer name: properties, or None} for every named layer."""
+        names = tuple(names or self.layers)
+        found = self.layered(names).lookup(lat, lon)
+        return {name: found.get(name) for name in names}
+
+    def info(self):
+        """Describe every layer without loading the ones not yet used."""
+        layers = []
+        for name, layer in self.layers.items():
+            _, index, error = self._loaded.get(name, (None, None, None))
+            layers.append({
+                **layer.info(),
+                "loaded": index is not None,
+                "version": index.version if index is not None else None,
+                "features": len(index) if index is not None else None,
+                "error": error,
+            })
+        return layers
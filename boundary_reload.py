@@ -0,0 +1,121 @@
+"""Hot-reloading holder for the micromarket index.
+
+The current index is a single attribute that is replaced in one assignment,
+so a request that has already read it keeps using the old index until it
+finishes while new requests see the new one. Rebuilds run on a background
+thread; a failed rebuild leaves the current index in place.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from micromarket_grid import grid_path_for
+from micromarket_index import MicromarketIndex
+from micromarket_store import load_index, store_path_for
+
+logger = logging.getLogger(__name__)
+
+
+class ReloadableIndex:
+    """The index for one GeoJSON file, rebuilt when the file or its artifacts change."""
+
+    def __init__(self, geojson_path, name_properties=('Micromarket',), on_swap=None, warm=False):
+        self.geojson_path = geojson_path
+        self.name_properties = name_properties
+        self.on_swap = on_swap
+        # Warm indexes (MicromarketIndex.warm) before swapping them in, so
+        # no request pays for what the first lookups would build
+        self.warm = warm
+        self.index = None
+        self.loaded_at = None
+        self.last_error = None
+        self._signature = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self.reload()
+
+    def signature(self):
+        """Return the (mtime, size) of the GeoJSON and its compiled artifacts."""
+        paths = (self.geojson_path, store_path_for(self.geojson_path), grid_path_for(self.geojson_path))
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _load(self):
+        try:
+            return load_index(self.geojson_path, self.name_properties)
+        except FileNotFoundError:
+            self.last_error = f"GeoJSON file not found at {self.geojson_path}"
+        except json.JSONDecodeError as e:
+            self.last_error = f"Invalid JSON in GeoJSON file: {e}"
+        except Exception as e:
+            self.last_error = f"Unexpected error loading GeoJSON: {e}"
+        logger.error("%s", self.last_error)
+        return None
+
+    def reload(self, force=True):
+        """Rebuild the index and swap it in; returns True if it was replaced.
+
+        Without force the rebuild is skipped when nothing on disk changed.
+        """
+        with self._reload_lock:
+            signature = self.signature()
+            if not force and signature == self._signature:
+                return False
+            index = self._load()
+            self._signature = signature
+            if index is None:
+                if self.index is not None:
+                    logger.warning("Keeping the previously loaded boundaries")
+                    return False
+                index = MicromarketIndex([])
+            else:
+                self.last_error = None
+            if self.warm:
+                index.warm()
+
+            self.index = index
+            self.loaded_at = time.time()
+            logger.info("Indexed %d micromarkets (version %s)", len(index), (index.version or 'none')[:12])
+            if self.on_swap is not None:
+                self.on_swap(index)
+            return True
+
+    def reload_async(self, force=True):
+        """Rebuild the index on a background thread."""
+        thread = threading.Thread(target=self.reload, kwargs={'force': force}, daemon=True)
+        thread.start()
+        return thread
+
+    def watch(self, interval):
+        """Poll the boundary files every interval seconds and reload on change."""
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload(force=False)
+                except Exception as e:
+                    logger.error("Boundary reload failed: %s", e)
+
+        self._watcher = threading.Thread(target=run, name='boundary-watcher', daemon=True)
+        self._watcher.start()
+
+    def info(self):
+        index = self.index
+        return {
+            "version": index.version,
+            "features": len(index),
+            "grid": index.grid is not None,
+            "loaded_at": self.loaded_at,
+            "last_error": self.last_error,
+            "pid": os.getpid(),
+        }
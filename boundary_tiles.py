@@ -0,0 +1,166 @@
+"""Simplified, quantized boundary tiles for map clients.
+
+Tiles follow the usual XYZ web mercator scheme and hold the micromarkets
+clipped to the tile as a GeoJSON FeatureCollection. For each zoom level the
+polygons are simplified once, to half a pixel, and their coordinates are
+rounded to a quarter of a pixel, so a tile weighs a few kilobytes however
+detailed the source boundaries are. Tiles are rendered when first asked
+for, kept gzipped in memory and thrown away when the boundaries change:
+
+    tiles = BoundaryTiles()
+    tiles.bind(index)
+    tile = tiles.tile(12, 2930, 1890)  # tile.body, tile.gzipped, tile.etag
+"""
+import gzip
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+
+MIN_ZOOM = 8
+MAX_ZOOM = 16
+# Properties of a micromarket carried into its tile features
+TILE_PROPERTIES = ('Micromarket', 'Zone')
+# Simplification tolerance and coordinate precision, in pixels of a 256 px tile
+SIMPLIFY_PIXELS = 0.5
+QUANTIZE_PIXELS = 0.25
+# Polygons are clipped this many pixels beyond the tile so strokes do not show seams
+CLIP_BUFFER_PIXELS = 4
+TILE_SIZE = 256
+
+
+def tile_bounds(z, x, y):
+    """Return the (min_lon, min_lat, max_lon, max_lat) of an XYZ tile."""
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def degrees_per_pixel(z):
+    """Return the degrees of longitude spanned by a pixel at zoom z."""
+    return 360 / (TILE_SIZE * 2 ** z)
+
+
+class Tile:
+    """The encoded body of a tile, gzipped, with its ETag."""
+
+    __slots__ = ('body', 'gzipped', 'etag')
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip.compress(body, mtime=0)
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+class BoundaryTiles:
+    """Tiles of the boundaries of one index, rendered on demand and cached.
+
+    bind(index) switches to new boundaries and drops every cached tile.
+    version names the bound boundaries in tile URLs, so a cached tile is
+    never stale under its URL.
+    """
+
+    def __init__(self, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, max_cached=4096):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.max_cached = max_cached
+        self.version = None
+        self._index = None
+        self._layers = {}  # zoom -> (simplified parts, STRtree)
+        self._tiles = OrderedDict()  # (z, x, y) -> Tile
+        self._lock = threading.Lock()
+
+    def bind(self, index):
+        with self._lock:
+            version = (index.version or 'none')[:16]
+            self._index = index
+            if version != self.version or index.version is None:
+                self.version = version
+                self._layers = {}
+                self._tiles = OrderedDict()
+
+    def bounds(self):
+        """Return the (min_lon, min_lat, max_lon, max_lat) of all the boundaries, or None."""
+        if self._index is None or not len(self._index.parts):
+            return None
+        return tuple(float(value) for value in shapely.total_bounds(self._index.parts))
+
+    def _layer(self, z):
+        layer = self._layers.get(z)
+        if layer is None:
+            parts = shapely.simplify(self._index.parts, SIMPLIFY_PIXELS * degrees_per_pixel(z),
+                                     preserve_topology=True)
+            layer = self._layers[z] = (parts, STRtree(parts))
+        return layer
+
+    def tile(self, z, x, y, version=None):
+        """Return the Tile at z/x/y.
+
+        Raises ValueError outside the zoom range or the tile grid, and
+        KeyError when version is given and the bound boundaries are another.
+        """
+        if not self.min_zoom <= z <= self.max_zoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"No tile {z}/{x}/{y}")
+        with self._lock:
+            if version is not None and version != self.version:
+                raise KeyError(f"Boundaries {version} are not loaded")
+            tile = self._tiles.get((z, x, y))
+            if tile is None:
+                tile = self._tiles[z, x, y] = Tile(self._render(z, x, y))
+                while len(self._tiles) > self.max_cached:
+                    self._tiles.popitem(last=False)
+            else:
+                self._tiles.move_to_end((z, x, y))
+        return tile
+
+    def _render(self, z, x, y):
+        features = []
+        if self._index is not None:
+            parts, tree = self._layer(z)
+            margin = CLIP_BUFFER_PIXELS * degrees_per_pixel(z)
+            min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+            clip = (min_lon - margin, min_lat - margin, max_lon + margin, max_lat + margin)
+            hits = np.sort(tree.query(shapely.box(*clip)))
+            clipped = shapely.clip_by_rect(parts[hits], *clip)
+            decimals = max(0, math.ceil(-math.log10(QUANTIZE_PIXELS * degrees_per_pixel(z))))
+            polygons = {}
+            for feature, geometry in zip(self._index.part_features[hits].tolist(), clipped):
+                for polygon in shapely.get_parts(geometry):
+                    if polygon.geom_type == 'Polygon' and not polygon.is_empty:
+                        rings = _quantized_rings(polygon, decimals)
+                        if rings:
+                            polygons.setdefault(feature, []).append(rings)
+            for feature, feature_polygons in sorted(polygons.items()):
+                properties = self._index.properties[feature]
+                features.append({
+                    "type": "Feature",
+                    "id": feature,
+                    "properties": {name: properties[name] for name in TILE_PROPERTIES if name in properties},
+                    "geometry": {"type": "MultiPolygon", "coordinates": feature_polygons}
+                    if len(feature_polygons) > 1 else {"type": "Polygon", "coordinates": feature_polygons[0]},
+                })
+        return json.dumps({"type": "FeatureCollection", "features": features},
+                          separators=(',', ':')).encode('utf-8')
+
+
+def _quantized_rings(polygon, decimals):
+    rings = []
+    for ring in (polygon.exterior, *polygon.interiors):
+        coordinates = np.round(shapely.get_coordinates(ring), decimals)
+        # Rounding can put runs of close vertices onto the same point
+        keep = np.ones(len(coordinates), dtype=bool)
+        keep[1:] = np.any(coordinates[1:] != coordinates[:-1], axis=1)
+        coordinates = coordinates[keep]
+        if len(coordinates) < 4:
+            if not rings:
+                return []  # the exterior collapsed, and the holes with it
+            continue
+        rings.append(coordinates.tolist())
+    return rings
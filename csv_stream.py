@@ -0,0 +1,86 @@
+"""Helpers for processing CSV uploads as a stream of chunks.
+
+Nothing here reads a whole request body: multipart uploads are decoded
+incrementally, bytes are turned into text lines lazily, and rows are handed
+out in fixed-size batches.
+"""
+import io
+from itertools import islice
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
+
+
+class ChunkReader(io.RawIOBase):
+    """Expose an iterator of byte chunks as a readable binary stream."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def iter_text(chunks, encoding='utf-8'):
+    """Return a text stream over byte chunks that csv.reader can consume."""
+    return io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks)), encoding=encoding, newline='')
+
+
+def iter_request_chunks(stream, chunk_size):
+    """Yield a raw request body in chunks of at most chunk_size bytes."""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_multipart_file(stream, boundary, field_name, chunk_size, on_file=None):
+    """Yield the content of one file field of a multipart body as it arrives.
+
+    on_file is called with the uploaded filename once the part headers for
+    field_name have been read.
+    """
+    decoder = MultipartDecoder(boundary)
+    in_file = False
+    while True:
+        chunk = stream.read(chunk_size)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                in_file = event.name == field_name
+                if in_file and on_file is not None:
+                    on_file(event.filename)
+            elif isinstance(event, Field):
+                in_file = False
+            elif isinstance(event, Data):
+                if in_file and event.data:
+                    yield event.data
+                if in_file and not event.more_data:
+                    return
+            elif isinstance(event, Epilogue):
+                return
+            event = decoder.next_event()
+        if not chunk:
+            return
+
+
+def iter_batches(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
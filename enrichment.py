@@ -0,0 +1,429 @@
+"""Inventory enrichment behind update-mm.py.
+
+Rows are read in chunks and each chunk is classified in one batch. With more
+than one worker the chunks are spread over a process pool: every worker
+process loads the boundary index once, in its initializer, and finished
+chunks are written out in input order.
+
+Two coordinate layouts are recognised from the header:
+
+    coordinates          one "lat, lon" column, as in data.csv
+    Latitude/Longitude   separate columns, as in the uploads/ project files
+
+Either way the output has a Micromarket ("<area>; <micromarket>") and an
+Area ("<Zone> Bangalore") column, plus a Micromarket Tag column recording
+what each row was classified from: a hash of the boundary set and a hash of
+the row's coordinates. Output columns already in the input are updated in
+place, and re-running over an enriched file only reclassifies rows whose
+coordinates changed or that were tagged with other boundaries.
+
+Inventories may be CSV, NDJSON, Parquet or Arrow files, in and out; Parquet
+and Arrow output store Micromarket and Area as dictionary-encoded columns.
+"""
+import hashlib
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import numpy as np
+import table_formats
+from csv_stream import iter_batches
+from log_config import RequestSummary, configure_logging, debug_sampled
+from micromarket_index import MicromarketIndex, bounding_box_positions
+from micromarket_store import load_index
+
+logger = logging.getLogger(__name__)
+
+# GeoJSON File Path
+DATA_FILE_PATH = os.path.join('Data', 'new.geojson')
+
+DEFAULT_CHUNK_ROWS = 20000
+OUTPUT_COLUMNS = ['Micromarket', 'Area']
+TAG_COLUMN = 'Micromarket Tag'
+
+# Points outside every polygon take the nearest micromarket within
+# MICROMARKET_NEAREST_MAX_DISTANCE meters, then the known area boxes. Before
+# this fallback such points were "Unknown" unless a box held them; set it to 0
+# to get those answers back.
+NEAREST_MAX_DISTANCE = float(os.environ.get('MICROMARKET_NEAREST_MAX_DISTANCE', 500))
+
+# Define known areas with bounding boxes for fallback when polygon detection fails
+KNOWN_AREAS = {
+    "BTM Layout": [77.60, 12.90, 77.63, 12.94],
+    "Koramangala": [77.61, 12.93, 77.65, 12.98],
+    "Hebbal": [77.58, 13.04, 77.62, 13.06],
+    "Yelahanka": [77.57, 13.09, 77.62, 13.14],
+    # Add more areas as needed
+}
+
+# The index of this process, loaded on first use or by the pool initializer
+_index = None
+_index_path = None
+
+
+def load_boundaries(geojson_path=DATA_FILE_PATH):
+    """Load the index used by this process; an unreadable file gives an empty index."""
+    global _index, _index_path
+    try:
+        index = load_index(geojson_path, name_properties=('Name', 'Micromarket'))
+    except FileNotFoundError:
+        logger.error("GeoJSON file not found at %s", geojson_path)
+        index = MicromarketIndex([])
+    except json.JSONDecodeError as e:
+        logger.error("Invalid JSON in GeoJSON file: %s", e)
+        index = MicromarketIndex([])
+    except Exception as e:
+        logger.error("Unexpected error loading GeoJSON: %s", e)
+        index = MicromarketIndex([])
+    _index, _index_path = index, geojson_path
+    return index
+
+
+def get_index(geojson_path=None):
+    """Return the index of this process, loading it on first use.
+
+    With geojson_path the index is reloaded if it came from another file.
+    """
+    if _index is None or (geojson_path is not None and geojson_path != _index_path):
+        load_boundaries(geojson_path or DATA_FILE_PATH)
+    return _index
+
+
+def _init_worker(geojson_path):
+    configure_logging()
+    load_boundaries(geojson_path)
+
+
+def point_in_bounding_box(lon, lat, bbox):
+    """Check if a point is inside a bounding box."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+
+
+def describe_feature(properties):
+    """Return the area name, micromarket and area (Zone) of a matched feature."""
+    area_name = properties.get('Name', '')
+    micromarket_name = properties.get('Micromarket', '')
+    zone_name = properties.get('Zone', '')  # Extract Zone field
+    area = f"{zone_name} Bangalore" if zone_name else "Not Found"
+    return area_name, micromarket_name, area
+
+
+def get_micromarket_info(lat, lon):
+    """Determine the micromarket and area (Zone) for given coordinates."""
+    index = get_index()
+    # First try the GeoJSON polygon approach
+    properties = index.lookup(lat, lon)
+    if properties is not None:
+        return describe_feature(properties)
+
+    # Then the nearest micromarket within NEAREST_MAX_DISTANCE
+    position, _ = index.nearest(lat, lon, NEAREST_MAX_DISTANCE)
+    if position >= 0:
+        return describe_feature(index.properties[position])
+
+    # If polygon check fails, try the bounding box approach for known areas
+    for area_name, bbox in KNOWN_AREAS.items():
+        if point_in_bounding_box(lon, lat, bbox):
+            return area_name, area_name, f"{area_name} Bangalore"
+
+    return "Unknown", "Not Found", "Not Found"
+
+
+def get_micromarket_info_batch(lats, lons):
+    """Determine get_micromarket_info results for arrays of coordinates in one pass."""
+    index = get_index()
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    positions = index.locate_many(lats, lons)
+    unmatched = np.flatnonzero(positions < 0)
+    if len(unmatched):
+        positions[unmatched] = index.nearest_many(lats[unmatched], lons[unmatched], NEAREST_MAX_DISTANCE)[0]
+    boxes = bounding_box_positions(lats, lons, KNOWN_AREAS.values())
+    area_names = list(KNOWN_AREAS)
+    described = {}
+    results = []
+    for position, box in zip(positions, boxes):
+        if position >= 0:
+            if position not in described:
+                described[position] = describe_feature(index.properties[position])
+            results.append(described[position])
+        elif box >= 0:
+            area_name = area_names[box]
+            results.append((area_name, area_name, f"{area_name} Bangalore"))
+        else:
+            results.append(("Unknown", "Not Found", "Not Found"))
+    return results
+
+
+def detect_layout(header):
+    """Return the column indexes holding the coordinates of a CSV header.
+
+    (lat_index, lon_index) for separate Latitude and Longitude columns,
+    otherwise (index,) of a single "lat, lon" column: the one named
+    coordinates, or the second column. None if the header is unusable.
+    """
+    if not header or len(header) < 2:
+        return None
+    names = [name.strip().lower() for name in header]
+    if 'latitude' in names and 'longitude' in names:
+        return names.index('latitude'), names.index('longitude')
+    if 'coordinates' in names:
+        return (names.index('coordinates'),)
+    return (1,)
+
+
+def parse_coordinates(row, layout):
+    """Return (lat, lon) of a row, or None if its coordinates are empty.
+
+    Raises ValueError for coordinates that are not numbers.
+    """
+    if len(layout) == 1:
+        coordinates = row[layout[0]].strip()
+        if not coordinates:
+            return None
+        lat, lon = map(float, coordinates.split(','))
+        return lat, lon
+    lat, lon = row[layout[0]].strip(), row[layout[1]].strip()
+    if not lat and not lon:
+        return None
+    return float(lat), float(lon)
+
+
+def boundary_tag(index=None):
+    """Return a short hash of the boundaries and fallbacks rows are classified with.
+
+    Describes the index of this process unless another index is given.
+    """
+    if index is None:
+        index = get_index()
+    text = f"{index.version}|{NEAREST_MAX_DISTANCE:g}|{json.dumps(KNOWN_AREAS, sort_keys=True)}"
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def coordinates_hash(row, layout):
+    """Return a short hash of the coordinate cells of a row."""
+    text = '|'.join(row[i].strip() for i in layout)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class OutputColumns:
+    """Where the Micromarket, Area and tag columns go for an input header.
+
+    Columns of those names already in the header are reused in place instead
+    of being appended again, and repeated copies left by earlier runs are
+    dropped. Missing ones are appended. names replaces the default
+    (micromarket, area, tag) column names; without a third name tag is None.
+    """
+
+    def __init__(self, header, names=None):
+        names = list(names or OUTPUT_COLUMNS + [TAG_COLUMN])
+        first = {}
+        for i, name in enumerate(header):
+            if name in names:
+                first.setdefault(name, i)
+        self.existing = [name for name in names if name in first]
+        self.kept = [i for i, name in enumerate(header) if name not in names or first[name] == i]
+        self.header = [header[i] for i in self.kept] + [name for name in names if name not in first]
+        positions = [self.header.index(name) for name in names]
+        self.micromarket, self.area = positions[:2]
+        self.tag = positions[2] if len(positions) > 2 else None
+        self.input_width = len(header)
+
+    def arrange(self, row):
+        """Return a copy of an input row laid out for the output header.
+
+        Short rows are padded; cells beyond the input header are kept at the end.
+        """
+        arranged = [row[i] if i < len(row) else '' for i in self.kept]
+        arranged.extend([''] * (len(self.header) - len(arranged)))
+        arranged.extend(row[self.input_width:])
+        return arranged
+
+
+def enrich_chunk(rows, first_row, columns, layout, incremental=True):
+    """Fill in the Micromarket, Area and tag columns of a chunk of CSV rows.
+
+    first_row is the line number of the first row, for log messages, and
+    columns the OutputColumns of the header. In incremental mode rows whose
+    tag matches their coordinates and the current boundaries are kept as
+    they are. Returns (rows, matched, invalid, reused).
+    """
+    tag_prefix = boundary_tag() + ':'
+    enriched = []
+    pending = []
+    tags = []
+    coordinates_list = []
+    matched = 0
+    reused = 0
+    needed = max(layout) + 1
+    for row_num, row in enumerate(rows, start=first_row):
+        if debug_sampled(logger):
+            logger.debug("Processing row %d: %s", row_num, row)
+
+        out = columns.arrange(row)
+        enriched.append(out)
+        if len(row) < needed:
+            out[columns.micromarket] = out[columns.area] = 'Invalid Row'
+            out[columns.tag] = ''
+            continue
+
+        tag = tag_prefix + coordinates_hash(row, layout)
+        if incremental and out[columns.tag] == tag:
+            reused += 1
+            if out[columns.micromarket] != 'Not Found':
+                matched += 1
+            continue
+
+        try:
+            coordinates = parse_coordinates(row, layout)
+        except ValueError as ve:
+            logger.debug("ValueError in row %d: %s", row_num, ve)
+            out[columns.micromarket] = out[columns.area] = 'Invalid Coordinates'
+            out[columns.tag] = ''
+            continue
+
+        # Handle empty coordinates
+        if coordinates is None:
+            out[columns.micromarket] = out[columns.area] = 'No Coordinates'
+            out[columns.tag] = ''
+            continue
+
+        pending.append(len(enriched) - 1)
+        tags.append(tag)
+        coordinates_list.append(coordinates)
+
+    try:
+        lats = np.array([lat for lat, _ in coordinates_list], dtype=float)
+        lons = np.array([lon for _, lon in coordinates_list], dtype=float)
+        results = get_micromarket_info_batch(lats, lons)
+    except Exception as e:
+        logger.error("Error classifying rows %d-%d: %s", first_row, first_row + len(rows) - 1, e)
+        results = [None] * len(pending)
+
+    for i, tag, result in zip(pending, tags, results):
+        out = enriched[i]
+        if result is None:
+            out[columns.micromarket] = out[columns.area] = 'Processing Error'
+            out[columns.tag] = ''
+            continue
+        area_name, micromarket_name, area = result
+
+        # Create clean location name without commas that could break CSV
+        if area_name != "Unknown":
+            # Use semicolon or pipe instead of comma to avoid CSV parsing issues
+            location_name = f"{area_name}; {micromarket_name}"
+            matched += 1
+        else:
+            location_name = "Not Found"
+        out[columns.micromarket] = location_name
+        out[columns.area] = area
+        out[columns.tag] = tag
+
+    return enriched, matched, len(rows) - len(pending) - reused, reused
+
+
+def enrich_chunks(reader, columns, layout, workers=1, chunk_rows=DEFAULT_CHUNK_ROWS,
+                  geojson_path=DATA_FILE_PATH, incremental=True):
+    """Yield enrich_chunk results for the rows of reader, in input order.
+
+    Input that fits in a single chunk is classified in this process; larger
+    input goes to a pool of workers processes, with at most two chunks per
+    worker in flight so memory stays bounded by the chunk size.
+    """
+    chunks = iter_batches(reader, chunk_rows)
+    first = next(chunks, None)
+    if first is None:
+        return
+    second = next(chunks, None)
+    if second is None or workers <= 1:
+        get_index(geojson_path)
+        first_row = 2  # Start at 2 since header is row 1
+        for rows in chain([first], [second] if second else [], chunks):
+            yield enrich_chunk(rows, first_row, columns, layout, incremental)
+            first_row += len(rows)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(geojson_path,)) as pool:
+        in_flight = deque()
+        first_row = 2
+        for rows in chain([first, second], chunks):
+            in_flight.append(pool.submit(enrich_chunk, rows, first_row, columns, layout, incremental))
+            first_row += len(rows)
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def enrich_file(input_path, output_path=None, workers=1, chunk_rows=DEFAULT_CHUNK_ROWS,
+                geojson_path=DATA_FILE_PATH, incremental=True, input_format=None, output_format=None):
+    """Write input_path with Micromarket, Area and tag columns to output_path.
+
+    Files may be CSV, NDJSON, Parquet or Arrow, told apart by extension
+    unless input_format or output_format is given; see table_formats.py.
+    Rows are read, classified and written a chunk at a time, and the
+    original column types of NDJSON, Parquet and Arrow input are kept.
+    Without output_path the input is replaced, or, when output_format
+    differs from the input's, written next to it with that format's
+    extension. The output is written next to its destination first and
+    moved into place once complete. Unless incremental is False, rows
+    already tagged with their current coordinates and boundaries are copied
+    without being reclassified. Returns the RequestSummary of the run, or
+    None if the header is not usable.
+    """
+    input_format = input_format or table_formats.format_for(input_path)
+    output_format = output_format or (table_formats.format_for(output_path, input_format) if output_path
+                                      else input_format)
+    if output_path is None:
+        output_path = input_path
+        if output_format != input_format:
+            output_path = os.path.splitext(input_path)[0] + table_formats.FORMAT_EXTENSIONS[output_format]
+    table_formats.check_format(output_format)
+    summary = RequestSummary(logger, f"enrich {input_path} ({workers} workers)")
+
+    with table_formats.TableReader(input_path, input_format, batch_rows=chunk_rows) as reader:
+        header = reader.header
+        layout = detect_layout(header)
+        if layout is None:
+            logger.error("Invalid %s format", input_format.upper())
+            return None
+        logger.info("Reading coordinates from column(s) %s", ', '.join(header[i] for i in layout))
+        columns = OutputColumns(header)
+        if columns.existing:
+            logger.info("Updating existing column(s) %s", ', '.join(columns.existing))
+
+        partial_path = output_path + '.partial'
+        try:
+            with table_formats.TableWriter(partial_path, columns.header, output_format, reader.types) as writer:
+                reused = 0
+                for rows, matched, invalid, chunk_reused in enrich_chunks(
+                        reader.rows(), columns, layout, workers, chunk_rows, geojson_path, incremental):
+                    writer.write(rows)
+                    summary.add(rows=len(rows), matched=matched, invalid=invalid)
+                    reused += chunk_reused
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+    os.replace(partial_path, output_path)
+    summary.log()
+    if incremental:
+        logger.info("%d of %d rows were already tagged with the current boundaries", reused, summary.rows)
+    logger.info("Update completed and saved to %s", output_path)
+
+    # Verify the output
+    if logger.isEnabledFor(logging.DEBUG):
+        with table_formats.TableReader(output_path, output_format, batch_rows=5) as check:
+            for i, row in enumerate(next(check.batches(), [])):
+                logger.debug("Row %d: %s", i + 1, row)
+    return summary
+
+
+def enrich_csv(input_csv, output_csv=None, workers=1, chunk_rows=DEFAULT_CHUNK_ROWS,
+               geojson_path=DATA_FILE_PATH, incremental=True):
+    """Write input_csv with Micromarket, Area and tag columns to output_csv; see enrich_file."""
+    return enrich_file(input_csv, output_csv, workers, chunk_rows, geojson_path, incremental, 'csv', 'csv')
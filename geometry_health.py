@@ -0,0 +1,137 @@
+"""Load-time validation of the micromarket boundaries, with a report.
+
+Every feature is repaired once when the boundaries are compiled (see
+micromarket_index.build_polygons) and the repaired shapes are cached in the
+compiled store. This module reports what that repair had to do, along with
+the problems repair cannot fix:
+
+    repaired     an invalid polygon, such as a self-intersecting ring
+    dropped      a degenerate ring or unreadable polygon that was left out
+    unsupported  a geometry that is not a Polygon or MultiPolygon
+    empty        no usable polygons, so the feature never matches
+    unnamed      none of the name properties, so the feature is not indexed
+    overlap      two micromarkets sharing area; the one listed first in the
+                 file takes the overlap, so every lookup has a single answer
+
+The report is written next to the compiled store when it is built, or on
+its own with:
+
+    python geometry_health.py Data/new.geojson
+"""
+import argparse
+import csv
+import json
+import os
+from collections import Counter
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+from micromarket_index import METERS_PER_DEGREE, geojson_feature_parts
+
+REPORT_COLUMNS = ['Feature', 'Micromarket', 'Issue', 'Detail', 'Other Feature', 'Other Micromarket',
+                  'Area (sq m)']
+
+# Overlaps smaller than this are rounding along a shared edge
+MIN_OVERLAP_AREA = 1.0  # square meters
+
+
+def report_path_for(geojson_path):
+    """Return the default health report path for a GeoJSON file."""
+    return os.path.splitext(geojson_path)[0] + '.health.csv'
+
+
+def square_meters(geometries):
+    """Return the approximate area in square meters of lon/lat geometries."""
+    lats = shapely.get_y(shapely.centroid(geometries))
+    return shapely.area(geometries) * METERS_PER_DEGREE ** 2 * np.cos(np.radians(lats))
+
+
+def find_overlaps(feature_parts, min_area=MIN_OVERLAP_AREA):
+    """Return (first, second, area in sq m) for every pair of features sharing area.
+
+    Features are numbered from 1 in the order of feature_parts and first is
+    always the lower number, the feature that wins lookups in the overlap.
+    """
+    parts = []
+    part_features = []
+    for number, (_, polygons) in enumerate(feature_parts, start=1):
+        parts.extend(polygons)
+        part_features.extend([number] * len(polygons))
+    if not parts:
+        return []
+    parts = np.array(parts, dtype=object)
+    part_features = np.array(part_features)
+
+    left, right = STRtree(parts).query(parts, predicate='intersects')
+    pairs = part_features[left] < part_features[right]
+    left, right = left[pairs], right[pairs]
+    areas = square_meters(shapely.intersection(parts[left], parts[right]))
+    totals = Counter()
+    for first, second, area in zip(part_features[left].tolist(), part_features[right].tolist(), areas.tolist()):
+        totals[first, second] += area
+    return [(first, second, area) for (first, second), area in sorted(totals.items()) if area >= min_area]
+
+
+def check_features(features, name_properties=('Micromarket',)):
+    """Repair GeoJSON features and return (feature_parts, report rows).
+
+    feature_parts holds (properties, repaired polygons) for every feature, as
+    micromarket_index.geojson_feature_parts yields them; report rows follow
+    REPORT_COLUMNS.
+    """
+    issues = []
+    feature_parts = list(geojson_feature_parts(features, issues))
+
+    def label(number):
+        properties = feature_parts[number - 1][0]
+        return ' / '.join(str(properties[name]) for name in name_properties if properties.get(name))
+
+    for number, (properties, polygons) in enumerate(feature_parts, start=1):
+        if not any(properties.get(name) for name in name_properties):
+            issues.append((number, 'unnamed', f"no {' or '.join(name_properties)} property"))
+        elif not polygons:
+            issues.append((number, 'empty', "no usable polygons"))
+
+    # Only indexed features take part in lookups
+    indexed = [(properties, polygons if any(properties.get(name) for name in name_properties) else [])
+               for properties, polygons in feature_parts]
+    rows = [[number, label(number), issue, detail, '', '', ''] for number, issue, detail in issues]
+    for first, second, area in find_overlaps(indexed):
+        rows.append([second, label(second), 'overlap', f"feature {first} is listed first and takes the overlap",
+                     first, label(first), f"{area:.0f}"])
+    rows.sort(key=lambda row: row[0])
+    return feature_parts, rows
+
+
+def summarize(rows):
+    """Return a one-line count of report rows by issue."""
+    counts = Counter(row[2] for row in rows)
+    return ', '.join(f"{count} {issue}" for issue, count in sorted(counts.items())) or "no issues"
+
+
+def write_report(rows, path):
+    """Write report rows to a CSV file."""
+    partial_path = path + '.partial'
+    with open(partial_path, mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(rows)
+    os.replace(partial_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report invalid and overlapping micromarket boundaries.")
+    parser.add_argument('geojson', nargs='?', default=os.path.join('Data', 'new.geojson'))
+    parser.add_argument('-o', '--output', help="report to write (default: next to the GeoJSON)")
+    args = parser.parse_args()
+
+    with open(args.geojson, encoding='utf-8') as f:
+        features = json.load(f).get('features', [])
+    _, rows = check_features(features)
+    output = write_report(rows, args.output or report_path_for(args.geojson))
+    print(f"Checked {len(features)} features: {summarize(rows)}; wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Background jobs for large CSV uploads.
+
+Job state lives in a local SQLite file that every worker process shares, so
+no broker is needed. Each process runs one JobRunner thread that claims
+queued jobs from the file; a global concurrency limit applies across all
+of them. A claimed job runs in a fresh Python process at lower CPU
+priority, so the bulk work never holds the GIL of the process serving
+interactive requests:
+
+    python -m job_queue <job db> <module:handler> <job id>
+
+The child is started with subprocess rather than forked from the runner.
+A worker process already runs threads (the runner itself, the boundary
+watcher), and a forked copy of it can deadlock on a lock one of them held,
+such as SQLite's. The handler is imported by name in the child, so its
+module must not start threads or runners of its own. A job that runs
+longer than the runner's timeout is killed and marked failed.
+
+A job is queued -> running -> done or failed. Jobs whose runner process
+died are put back in the queue, and finished jobs are removed with their
+files after a retention period.
+"""
+import argparse
+import importlib
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from log_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+JOB_FIELDS = ('id', 'filename', 'status', 'input_path', 'output_path', 'created_at', 'started_at',
+              'finished_at', 'rows_done', 'matched', 'invalid', 'boundary_version', 'error', 'owner_pid')
+
+# Columns a running job may update
+PROGRESS_FIELDS = ('rows_done', 'matched', 'invalid', 'boundary_version')
+# Seconds a job may run before it is killed
+DEFAULT_TIMEOUT = 3600
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class JobStore:
+    """Job records in a local SQLite file shared across processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, filename TEXT, status TEXT, input_path TEXT, output_path TEXT,"
+                " created_at REAL, started_at REAL, finished_at REAL,"
+                " rows_done INTEGER DEFAULT 0, matched INTEGER DEFAULT 0, invalid INTEGER DEFAULT 0,"
+                " boundary_version TEXT, error TEXT, owner_pid INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def _connect(self):
+        # A connection inherited across fork must not be used by the child
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _update(self, job_id, **fields):
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def create(self, filename, input_path, output_path, job_id=None):
+        """Queue a job and return its id."""
+        job_id = job_id or uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, filename, status, input_path, output_path, created_at)"
+                " VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, filename, input_path, output_path, time.time()))
+        return job_id
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(JOB_FIELDS, row)) if row else None
+
+    def claim(self, concurrency):
+        """Mark the oldest queued job as running by this process and return it.
+
+        Returns None when nothing is queued or concurrency jobs already run.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+            row = None
+            if running < concurrency:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, owner_pid = ?,"
+                    " rows_done = 0, matched = 0, invalid = 0 WHERE id = ?",
+                    (time.time(), os.getpid(), row[0]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(row[0]) if row else None
+
+    def progress(self, job_id, **fields):
+        """Record progress of a running job; only PROGRESS_FIELDS may be set."""
+        unknown = set(fields) - set(PROGRESS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        self._update(job_id, **fields)
+
+    def finish(self, job_id, **fields):
+        self.progress(job_id, **fields)
+        self._update(job_id, status='done', finished_at=time.time())
+
+    def fail(self, job_id, error):
+        self._update(job_id, status='failed', finished_at=time.time(), error=error)
+
+    def requeue_orphans(self):
+        """Put running jobs whose owning process has exited back in the queue."""
+        rows = self._connect().execute("SELECT id, owner_pid FROM jobs WHERE status = 'running'").fetchall()
+        requeued = 0
+        for job_id, pid in rows:
+            if pid is not None and not _pid_alive(pid):
+                with self._connect() as conn:
+                    conn.execute("UPDATE jobs SET status = 'queued', owner_pid = NULL"
+                                 " WHERE id = ? AND status = 'running' AND owner_pid = ?", (job_id, pid))
+                logger.warning("Requeued job %s after its worker process %s exited", job_id, pid)
+                requeued += 1
+        return requeued
+
+    def expire(self, max_age):
+        """Delete jobs that finished more than max_age seconds ago; returns their records."""
+        cutoff = time.time() - max_age
+        conn = self._connect()
+        rows = conn.execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (cutoff,)).fetchall()
+        with conn:
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in rows])
+        return [dict(zip(JOB_FIELDS, row)) for row in rows]
+
+    def info(self, job_id):
+        """Return the public view of a job with its throughput, or None."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        started = job['started_at']
+        elapsed = (job['finished_at'] or time.time()) - started if started else 0.0
+        return {
+            "id": job['id'],
+            "filename": job['filename'],
+            "status": job['status'],
+            "created_at": job['created_at'],
+            "started_at": started,
+            "finished_at": job['finished_at'],
+            "rows_done": job['rows_done'],
+            "matched": job['matched'],
+            "invalid": job['invalid'],
+            "elapsed": elapsed,
+            "rows_per_sec": job['rows_done'] / elapsed if elapsed > 0 else 0.0,
+            "boundary_version": job['boundary_version'],
+            "error": job['error'],
+        }
+
+
+def _execute(store, handler, job, niceness):
+    """Run handler(job, progress) and record the outcome."""
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    # The job belongs to this process now, so it is only requeued if this process dies
+    store._update(job['id'], owner_pid=os.getpid())
+    try:
+        result = handler(job, lambda **fields: store.progress(job['id'], **fields))
+        store.finish(job['id'], **(result or {}))
+    except Exception as e:
+        logger.exception("Job %s failed", job['id'])
+        store.fail(job['id'], str(e))
+
+
+def handler_name(handler):
+    """Return the module:name a child process imports handler by."""
+    module = getattr(handler, '__module__', None)
+    if module in (None, '__main__') or '<' in handler.__qualname__:
+        raise ValueError(f"Job handler {handler!r} must be a module-level function of an importable module")
+    return f"{module}:{handler.__qualname__}"
+
+
+def load_handler(name):
+    module, _, qualname = name.partition(':')
+    handler = importlib.import_module(module)
+    for part in qualname.split('.'):
+        handler = getattr(handler, part)
+    return handler
+
+
+class JobRunner:
+    """Thread that claims jobs from a JobStore and runs them one at a time.
+
+    handler(job, progress) processes one job record, calling
+    progress(rows_done=...) as it goes, and returns the final progress
+    fields. It runs in a child process that imports it by name, so it must
+    be a module-level function. A job still running after timeout seconds
+    is killed and marked failed.
+    """
+
+    def __init__(self, store, handler, concurrency=1, poll_interval=1.0, niceness=10, retention=None,
+                 timeout=DEFAULT_TIMEOUT):
+        self.store = store
+        self.handler = handler
+        self.handler_name = handler_name(handler)
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.niceness = niceness
+        self.retention = retention
+        self.timeout = timeout
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.concurrency <= 0:
+            return
+        self._thread = threading.Thread(target=self._loop, name='job-runner', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """Look for queued work now rather than at the next poll."""
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self.store.requeue_orphans()
+                if self.retention:
+                    for job in self.store.expire(self.retention):
+                        for path in (job['input_path'], job['output_path']):
+                            if path and os.path.exists(path):
+                                os.remove(path)
+                job = self.store.claim(self.concurrency)
+            except Exception as e:
+                logger.error("Job queue unavailable: %s", e)
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self.run(job)
+
+    def command(self, job):
+        return [sys.executable, '-m', 'job_queue', self.store.path, self.handler_name, job['id'],
+                '--niceness', str(self.niceness)]
+
+    def environment(self):
+        """Return the child's environment, with the handler's and this module's directories importable."""
+        directories = {os.path.dirname(os.path.abspath(__file__))}
+        module = sys.modules.get(self.handler_name.partition(':')[0])
+        if getattr(module, '__file__', None):
+            directories.add(os.path.dirname(os.path.abspath(module.__file__)))
+        path = os.pathsep.join([*sorted(directories), os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+        return {**os.environ, 'PYTHONPATH': path}
+
+    def run(self, job):
+        """Run a claimed job in a child process and wait for it, for at most timeout seconds."""
+        logger.info("Starting job %s (%s)", job['id'], job['filename'])
+        process = subprocess.Popen(self.command(job), env=self.environment(), stdin=subprocess.DEVNULL)
+        try:
+            process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # Failed first, so no runner requeues it once the child is gone
+            self.store.fail(job['id'], f"Job timed out after {self.timeout:g}s")
+            process.kill()
+            process.wait()
+            logger.error("Killed job %s after %gs", job['id'], self.timeout)
+            return
+        if process.returncode != 0 and self.store.get(job['id'])['status'] == 'running':
+            self.store.fail(job['id'], f"Job process exited with code {process.returncode}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one claimed job; started by JobRunner.")
+    parser.add_argument('store', help="job database")
+    parser.add_argument('handler', help="module:function processing the job")
+    parser.add_argument('job_id')
+    parser.add_argument('--niceness', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    store = JobStore(args.store)
+    job = store.get(args.job_id)
+    if job is None or job['status'] != 'running':
+        logger.error("Job %s is not running", args.job_id)
+        return 1
+    try:
+        handler = load_handler(args.handler)
+    except Exception as e:
+        logger.exception("Could not load job handler %s", args.handler)
+        store.fail(job['id'], f"Could not load job handler {args.handler}: {e}")
+        return 1
+    _execute(store, handler, job, args.niceness)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Logging setup shared by the app and the command line tools.
+
+MICROMARKET_LOG_LEVEL sets the level (default INFO). Per-point debug
+messages are only produced at DEBUG, and MICROMARKET_DEBUG_SAMPLE keeps just
+that fraction of them (default 1.0, every point) so debug logging can stay
+on in production while chasing a misclassification.
+"""
+import logging
+import os
+import random
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+DEBUG_SAMPLE_RATE = float(os.environ.get('MICROMARKET_DEBUG_SAMPLE', 1.0))
+
+
+def configure_logging(level=None):
+    """Send log records to stderr at MICROMARKET_LOG_LEVEL unless already configured."""
+    level = (level or os.environ.get('MICROMARKET_LOG_LEVEL', 'INFO')).upper()
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format=LOG_FORMAT)
+    root.setLevel(level)
+
+
+def debug_sampled(logger):
+    """Return True when a per-point debug message should be emitted."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return DEBUG_SAMPLE_RATE >= 1 or random.random() < DEBUG_SAMPLE_RATE
+
+
+class RequestSummary:
+    """Counts rows through a request or batch job and logs one line at the end."""
+
+    def __init__(self, logger, name):
+        self.logger = logger
+        self.name = name
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.matched = 0
+        self.invalid = 0
+
+    def add(self, rows=0, matched=0, invalid=0):
+        self.rows += rows
+        self.matched += matched
+        self.invalid += invalid
+
+    def log(self):
+        elapsed = time.perf_counter() - self.started
+        match_rate = self.matched / self.rows if self.rows else 0.0
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        self.logger.info("%s: %d rows, %d matched (%.1f%%), %d invalid, %.3fs (%.0f rows/s)",
+                         self.name, self.rows, self.matched, match_rate * 100, self.invalid, elapsed, rate)
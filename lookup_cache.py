@@ -0,0 +1,173 @@
+"""Bounded LRU cache for coordinate lookups.
+
+Coordinates are rounded to a fixed number of decimals before they are used
+as a key, and the lookup itself runs on the rounded point so every key has a
+single well-defined answer. Entries belong to one boundary version and are
+dropped when the index is rebuilt from a different GeoJSON.
+
+An optional SQLite file shared by every worker process sits behind the
+in-memory LRU, so results computed by one gunicorn worker can be reused by
+the others.
+"""
+import logging
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCacheBackend:
+    """Lookup results stored in a local SQLite file shared across processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lookup_results ("
+                " version TEXT, lat REAL, lon REAL, micromarket TEXT, zone TEXT, match TEXT, distance REAL,"
+                " PRIMARY KEY (version, lat, lon))"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, version, key):
+        row = self._connect().execute(
+            "SELECT micromarket, zone, match, distance FROM lookup_results"
+            " WHERE version = ? AND lat = ? AND lon = ?",
+            (version, *key)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, version, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO lookup_results VALUES (?, ?, ?, ?, ?, ?, ?)", (version, *key, *value))
+
+    def prune(self, version):
+        """Delete entries computed for any other boundary version."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM lookup_results WHERE version != ?", (version,))
+
+
+class LookupCache:
+    """LRU cache of (micromarket, zone, match, distance) results keyed on rounded coordinates."""
+
+    def __init__(self, maxsize=100000, precision=6, backend=None, on_lookup=None):
+        self.maxsize = maxsize
+        self.precision = precision
+        self.backend = backend
+        # Called with "hit", "shared_hit" or "miss" for every cached lookup
+        self.on_lookup = on_lookup
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, lat, lon):
+        return round(lat, self.precision), round(lon, self.precision)
+
+    def bind(self, version):
+        """Serve results for a boundary version, clearing entries from any other."""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._entries.clear()
+        if self.backend is not None:
+            try:
+                self.backend.prune(version)
+            except sqlite3.Error as e:
+                logger.error("Could not prune shared lookup cache: %s", e)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def cached(self, lat, lon):
+        """Return the in-memory result for a point, or None; never computes or reads the backend."""
+        if self.maxsize <= 0 or not (math.isfinite(lat) and math.isfinite(lon)):
+            return None
+        key = self.key(lat, lon)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        if self.on_lookup is not None:
+            self.on_lookup('hit')
+        return value
+
+    def lookup(self, lat, lon, compute):
+        """Return the cached result for a point, calling compute(lat, lon) on a miss."""
+        if self.maxsize <= 0 or not (math.isfinite(lat) and math.isfinite(lon)):
+            return compute(lat, lon)
+
+        key = self.key(lat, lon)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            version = self.version
+        if value is not None:
+            if self.on_lookup is not None:
+                self.on_lookup('hit')
+            return value
+
+        value = None
+        if self.backend is not None:
+            try:
+                value = self.backend.get(version, key)
+            except sqlite3.Error as e:
+                logger.error("Shared lookup cache read failed: %s", e)
+        if value is not None:
+            with self._lock:
+                self.shared_hits += 1
+            outcome = 'shared_hit'
+        else:
+            value = compute(*key)
+            with self._lock:
+                self.misses += 1
+            outcome = 'miss'
+            if self.backend is not None:
+                try:
+                    self.backend.put(version, key, value)
+                except sqlite3.Error as e:
+                    logger.error("Shared lookup cache write failed: %s", e)
+        if self.on_lookup is not None:
+            self.on_lookup(outcome)
+
+        with self._lock:
+            # Results computed for a version that was replaced meanwhile are not kept
+            if version == self.version:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "precision": self.precision,
+                "version": self.version,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "shared_backend": self.backend.path if self.backend is not None else None,
+            }
@@ -0,0 +1,269 @@
+"""Prometheus metrics that add up across worker processes.
+
+Every process adds to its own memory-mapped file of float64 slots in a
+shared directory, and the /metrics text is rendered from the sum of all the
+files, so the totals do not depend on which gunicorn worker served a
+request or answered the scrape. Metrics and every label value they take are
+declared up front, which gives all processes the same slot layout. Files
+of processes that have exited are folded into an archive file, so counters
+never go backwards.
+"""
+import bisect
+import ctypes
+import glob
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process, nothing to coordinate with
+    fcntl = None
+
+FILE_MAGIC = b'MMMETR01'
+HEADER_SIZE = len(FILE_MAGIC) + 32  # magic, sha256 of the slot layout
+ARCHIVE_NAME = 'archive.metrics'
+
+# Seconds; requests and uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Seconds; the stages of a single lookup take microseconds
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """A monotonically increasing count per label set."""
+
+    kind = 'counter'
+    series_size = 1
+
+    def __init__(self, registry, name, documentation, labelnames, labelvalues):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {tuple(values): i for i, values in enumerate(labelvalues)}
+        self.offset = 0
+
+    @property
+    def size(self):
+        return len(self.series) * self.series_size
+
+    def layout(self):
+        return f"{self.kind} {self.name} {self.labelnames} {sorted(self.series, key=self.series.get)}"
+
+    def _slot(self, labels):
+        try:
+            return self.offset + self.series[labels] * self.series_size
+        except KeyError:
+            raise ValueError(f"{self.name} has no series {labels}") from None
+
+    def inc(self, *labels, amount=1):
+        self.registry.add(self._slot(labels), amount)
+
+    def render(self, values):
+        lines = []
+        for labels, i in self.series.items():
+            value = values[self.offset + i]
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Counter):
+    """Observations counted into cumulative buckets, with their sum and count."""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames, labelvalues, buckets):
+        super().__init__(registry, name, documentation, labelnames, labelvalues)
+        self.buckets = tuple(sorted(buckets))
+        # A slot per bucket and one above the last, then the sum and count
+        self.series_size = len(self.buckets) + 3
+
+    def layout(self):
+        return f"{super().layout()} {self.buckets}"
+
+    def observe(self, value, *labels):
+        slot = self._slot(labels)
+        n = len(self.buckets)
+        values, lock = self.registry.process_values()
+        with lock:
+            values[slot + bisect.bisect_left(self.buckets, value)] += 1
+            values[slot + n + 1] += value
+            values[slot + n + 2] += 1
+
+    def time(self, *labels):
+        """Return a context manager observing the seconds spent in its with block."""
+        return _Timer(self, labels)
+
+    def render(self, values):
+        lines = []
+        n = len(self.buckets)
+        for labels, i in self.series.items():
+            start = self.offset + i * self.series_size
+            cumulative = np.cumsum(values[start:start + n + 1])
+            for bound, count in zip((*self.buckets, '+Inf'), cumulative):
+                le = bound if bound == '+Inf' else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels((*self.labelnames, 'le'), (*labels, le))} "
+                             f"{_format_value(count)}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(values[start + n + 1])}")
+            lines.append(f"{self.name}_count{label_text} {_format_value(values[start + n + 2])}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class MetricsRegistry:
+    """Declared metrics and this process's file of their values."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.metrics = []
+        self.size = 0
+        self._values = None
+        self._digest = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _declare(self, metric):
+        if self._values is not None:
+            raise RuntimeError("Metrics must be declared before any is recorded")
+        metric.offset = self.size
+        self.size += metric.size
+        self.metrics.append(metric)
+        self._digest = None
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), labelvalues=((),)):
+        """Declare a counter; labelvalues lists every label tuple it is recorded with."""
+        return self._declare(Counter(self, name, documentation, labelnames, labelvalues))
+
+    def histogram(self, name, documentation, labelnames=(), labelvalues=((),), buckets=DEFAULT_BUCKETS):
+        """Declare a histogram; labelvalues lists every label tuple it is recorded with."""
+        return self._declare(Histogram(self, name, documentation, labelnames, labelvalues, buckets))
+
+    def layout_digest(self):
+        if self._digest is None:
+            layout = '\n'.join(metric.layout() for metric in self.metrics)
+            self._digest = hashlib.sha256(layout.encode('utf-8')).digest()
+        return self._digest
+
+    def _after_fork(self):
+        # A forked child must not write to its parent's file
+        self._values = None
+        self._lock = threading.Lock()
+
+    def process_values(self):
+        """Return (values, lock) of this process's file."""
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    values = self._open(os.path.join(self.directory, f"{os.getpid()}.metrics"))
+                    # Element updates through ctypes are several times faster than through numpy
+                    self._values = (ctypes.c_double * self.size).from_buffer(values)
+        return self._values, self._lock
+
+    def _open(self, path):
+        os.makedirs(self.directory, exist_ok=True)
+        header = FILE_MAGIC + self.layout_digest()
+        if not self._readable(path):
+            with open(path, 'wb') as f:
+                f.write(header)
+                f.write(np.zeros(self.size).tobytes())
+        return np.memmap(path, dtype='f8', mode='r+', offset=HEADER_SIZE, shape=(self.size,))
+
+    def _readable(self, path):
+        """Return whether path holds values in the current layout."""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(HEADER_SIZE)
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        return header == FILE_MAGIC + self.layout_digest() and size == HEADER_SIZE + self.size * 8
+
+    def add(self, slot, amount):
+        values, lock = self.process_values()
+        with lock:
+            values[slot] += amount
+
+    @contextmanager
+    def _directory_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def collect(self):
+        """Return the values summed over every process, folding in exited ones."""
+        total = np.zeros(self.size)
+        with self._directory_lock():
+            archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+            archive = None
+            for path in glob.glob(os.path.join(self.directory, '*.metrics')):
+                if path == archive_path or not self._readable(path):
+                    continue
+                values = np.fromfile(path, dtype='f8', offset=HEADER_SIZE, count=self.size)
+                pid = os.path.basename(path).split('.')[0]
+                if pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+                    if archive is None:
+                        archive = self._open(archive_path)
+                    archive += values
+                    archive.flush()
+                    os.remove(path)
+                else:
+                    total += values
+            if self._readable(archive_path):
+                total += np.fromfile(archive_path, dtype='f8', offset=HEADER_SIZE, count=self.size)
+        return total
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        values = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
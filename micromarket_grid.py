@@ -0,0 +1,174 @@
+"""Precomputed grid lookup table for micromarket classification.
+
+The boundary extent is rasterized into square cells. Each cell records the
+micromarket that owns every point in it, that no micromarket touches it, or
+that a boundary crosses it and the exact polygon test is needed. Most points
+are then answered with one array read.
+
+Build the table offline next to its GeoJSON:
+
+    python micromarket_grid.py Data/new.geojson
+
+The file is a fixed header followed by a uint16 cell array and is
+memory-mapped when loaded, so every worker shares the same pages.
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+import shapely
+from micromarket_index import MicromarketIndex
+
+# Version 02: polygons keep their holes
+GRID_MAGIC = b'MMGRID02'
+# magic, nx, ny, feature count, x0, y0, cell size, sha256 of the source GeoJSON
+GRID_HEADER = struct.Struct('<8sIIIddd32s')
+
+# Cell values: 0 means no micromarket, 1..65534 is feature position + 1
+OUTSIDE = 0
+BOUNDARY = 0xFFFF
+
+DEFAULT_RESOLUTION = 0.001  # degrees, roughly 110 m
+
+
+def grid_path_for(geojson_path):
+    """Return the default grid file path for a GeoJSON file."""
+    return os.path.splitext(geojson_path)[0] + '.grid'
+
+
+def file_digest(path):
+    """Return the sha256 digest of a file's bytes."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+class MicromarketGrid:
+    """A loaded grid lookup table."""
+
+    def __init__(self, cells, x0, y0, resolution, feature_count, digest):
+        self.cells = cells
+        self.x0 = x0
+        self.y0 = y0
+        self.resolution = resolution
+        self.feature_count = feature_count
+        self.digest = digest
+
+    def cell_values(self, lats, lons):
+        """Return the cell value for every point, BOUNDARY outside the grid."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        ny, nx = self.cells.shape
+        with np.errstate(invalid='ignore'):
+            cols = np.floor((lons - self.x0) / self.resolution)
+            rows = np.floor((lats - self.y0) / self.resolution)
+            inside = (cols >= 0) & (cols < nx) & (rows >= 0) & (rows < ny)
+        values = np.full(lats.shape, BOUNDARY, dtype=np.uint16)
+        values[inside] = self.cells[rows[inside].astype(np.intp), cols[inside].astype(np.intp)]
+        return values
+
+    def locate_many(self, lats, lons):
+        """Return (positions, undecided) for arrays of points.
+
+        positions holds the owning feature position or -1 for no
+        micromarket; undecided marks points that need the exact test.
+        """
+        values = self.cell_values(lats, lons)
+        return values.astype(np.intp) - 1, values == BOUNDARY
+
+    def locate(self, lat, lon):
+        """Return the owning feature position, -1 for none, or None if undecided."""
+        value = self.cell_value(lat, lon)
+        if value == BOUNDARY:
+            return None
+        return value - 1
+
+    def cell_value(self, lat, lon):
+        """Return the cell value for a single point, BOUNDARY outside the grid."""
+        col = (lon - self.x0) / self.resolution
+        row = (lat - self.y0) / self.resolution
+        ny, nx = self.cells.shape
+        if not (0 <= col < nx and 0 <= row < ny):
+            return BOUNDARY
+        return int(self.cells[int(row), int(col)])
+
+
+def build_grid(index, resolution=DEFAULT_RESOLUTION):
+    """Rasterize an index into cell values and return (cells, x0, y0)."""
+    if len(index) >= BOUNDARY:
+        raise ValueError(f"Too many features for a uint16 grid: {len(index)}")
+    min_x, min_y, max_x, max_y = shapely.total_bounds(index.parts)
+    x0 = min_x - resolution
+    y0 = min_y - resolution
+    nx = int(np.ceil((max_x - x0) / resolution)) + 1
+    ny = int(np.ceil((max_y - y0) / resolution)) + 1
+
+    # Cells are padded slightly so points rounding into a neighbouring cell
+    # are still covered by the cell they are looked up in
+    pad = resolution * 1e-6
+    cols, rows = np.meshgrid(np.arange(nx), np.arange(ny))
+    cols = cols.ravel()
+    rows = rows.ravel()
+    boxes = shapely.box(x0 + cols * resolution - pad, y0 + rows * resolution - pad,
+                        x0 + (cols + 1) * resolution + pad, y0 + (rows + 1) * resolution + pad)
+
+    cell_idx, part_idx = index.tree.query(boxes, predicate='intersects')
+    features = index.part_features[part_idx]
+
+    # The lowest feature touching a cell is the only one that can own all of it
+    owner = np.full(len(boxes), len(index), dtype=np.intp)
+    np.minimum.at(owner, cell_idx, features)
+    candidate = features == owner[cell_idx]
+    covered = np.zeros(len(boxes), dtype=bool)
+    covered[cell_idx[candidate]] = shapely.contains_properly(
+        index.parts[part_idx[candidate]], boxes[cell_idx[candidate]])
+
+    cells = np.full(len(boxes), BOUNDARY, dtype=np.uint16)
+    cells[owner == len(index)] = OUTSIDE
+    cells[covered] = owner[covered] + 1
+    return cells.reshape(ny, nx), x0, y0
+
+
+def save_grid(path, cells, x0, y0, resolution, feature_count, digest):
+    """Write a grid table to path."""
+    ny, nx = cells.shape
+    with open(path, 'wb') as f:
+        f.write(GRID_HEADER.pack(GRID_MAGIC, nx, ny, feature_count, x0, y0, resolution, digest))
+        f.write(np.ascontiguousarray(cells, dtype='<u2').tobytes())
+
+
+def load_grid(path):
+    """Memory-map a grid table written by save_grid."""
+    with open(path, 'rb') as f:
+        header = f.read(GRID_HEADER.size)
+    if len(header) < GRID_HEADER.size:
+        raise ValueError(f"Truncated grid file: {path}")
+    magic, nx, ny, feature_count, x0, y0, resolution, digest = GRID_HEADER.unpack(header)
+    if magic != GRID_MAGIC:
+        raise ValueError(f"Not a micromarket grid file, or an older format: {path}")
+    cells = np.memmap(path, dtype='<u2', mode='r', offset=GRID_HEADER.size, shape=(ny, nx))
+    return MicromarketGrid(cells, x0, y0, resolution, feature_count, digest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the micromarket grid lookup table.")
+    parser.add_argument('geojson', nargs='?', default=os.path.join('Data', 'new.geojson'))
+    parser.add_argument('-o', '--output', help="grid file to write (default: next to the GeoJSON)")
+    parser.add_argument('-r', '--resolution', type=float, default=DEFAULT_RESOLUTION,
+                        help="cell size in degrees")
+    args = parser.parse_args()
+
+    with open(args.geojson, encoding='utf-8') as f:
+        index = MicromarketIndex(json.load(f).get('features', []))
+    cells, x0, y0 = build_grid(index, args.resolution)
+    output = args.output or grid_path_for(args.geojson)
+    save_grid(output, cells, x0, y0, args.resolution, len(index), file_digest(args.geojson))
+
+    boundary = np.count_nonzero(cells == BOUNDARY)
+    print(f"Wrote {output}: {cells.shape[1]}x{cells.shape[0]} cells, "
+          f"{boundary / cells.size:.1%} need an exact test")
+
+
+if __name__ == '__main__':
+    main()
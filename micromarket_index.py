@@ -0,0 +1,420 @@
+"""Spatial index over the micromarket boundaries.
+
+Every feature is cleaned, repaired and prepared once when the index is built,
+so a lookup only runs the exact containment test against the few polygons
+whose bounding box holds the point. Holes are kept: a point inside one is
+not in that micromarket.
+
+Polygons with many vertices also get two simplified tiers: a hull that
+contains the polygon and a core that lies inside it, both kept clear of its
+boundary. A point outside the hull or inside the core is decided by the
+small shape, and only points in the thin band between them pay for the
+full-resolution test.
+"""
+import logging
+import math
+from contextlib import nullcontext
+from itertools import repeat
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
+
+logger = logging.getLogger(__name__)
+
+# Meters per degree of latitude, and of longitude at the equator
+METERS_PER_DEGREE = 111320.0
+
+# Polygons with fewer vertices are as cheap to test exactly as their tiers
+TIER_MIN_VERTICES = 256
+# Tier simplification tolerance in degrees, about 11 m
+TIER_TOLERANCE = 1e-4
+
+
+def clean_coordinates(coordinates):
+    """Clean coordinate data to handle 3D coordinates (with elevation)."""
+    if not coordinates:
+        return coordinates
+
+    # Handle different coordinate structures
+    if isinstance(coordinates, list) and len(coordinates) > 0:
+        if isinstance(coordinates[0], list):
+            # This is a ring of coordinates
+            if len(coordinates[0]) > 0 and isinstance(coordinates[0][0], list):
+                # This is a polygon with multiple rings
+                return [[(point[0], point[1]) for point in ring if len(point) >= 2] for ring in coordinates]
+            else:
+                # This is a single ring
+                return [(point[0], point[1]) for point in coordinates if len(point) >= 2]
+
+    return coordinates
+
+
+def polygonal_parts(geometry):
+    """Return the non-empty polygons in a geometry, flattening collections."""
+    polygons = []
+    for part in shapely.get_parts(geometry):
+        if part.geom_type == 'Polygon' and not part.is_empty:
+            polygons.append(part)
+        elif part.geom_type in ('MultiPolygon', 'GeometryCollection'):
+            polygons.extend(polygonal_parts(part))
+    return polygons
+
+
+def build_polygons(poly_coords, issues=None):
+    """Build the repaired polygons for GeoJSON polygon coordinates, holes included.
+
+    Rings with fewer than 3 distinct points are dropped. An invalid polygon
+    is repaired with make_valid, which keeps all of its area and may split
+    it into several polygons. Each problem found is appended to issues as
+    (issue, detail).
+    """
+    issues = [] if issues is None else issues
+    rings = clean_coordinates(poly_coords)
+    if not rings:
+        return []
+    if not isinstance(rings[0], list):
+        rings = [rings]
+
+    exterior, *interiors = rings
+    if len(set(exterior)) < 3:
+        issues.append(('dropped', f"exterior ring has {len(set(exterior))} distinct points"))
+        return []
+    holes = []
+    for ring in interiors:
+        if len(set(ring)) < 3:
+            issues.append(('dropped', f"hole has {len(set(ring))} distinct points"))
+        else:
+            holes.append(ring)
+
+    polygon = Polygon(exterior, holes)
+    if polygon.is_valid:
+        return [polygon]
+    issues.append(('repaired', shapely.is_valid_reason(polygon)))
+    return polygonal_parts(shapely.make_valid(polygon))
+
+
+def feature_parts(geometry, issues=None):
+    """Return the repaired polygons making up a GeoJSON geometry.
+
+    Problems with the geometry are appended to issues as (issue, detail).
+    """
+    issues = [] if issues is None else issues
+    if not geometry:
+        return []
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry.get('coordinates')]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry.get('coordinates') or []
+    else:
+        issues.append(('unsupported', f"geometry type {geometry.get('type')}"))
+        return []
+
+    parts = []
+    for poly_coords in polygons:
+        if not poly_coords:
+            continue
+        try:
+            parts.extend(build_polygons(poly_coords, issues))
+        except Exception as e:
+            logger.warning("Error with individual polygon: %s", e)
+            issues.append(('dropped', f"unreadable polygon: {e}"))
+    return parts
+
+
+def simplification_tiers(polygons, tolerance=TIER_TOLERANCE, min_vertices=TIER_MIN_VERTICES):
+    """Return (hulls, cores) of simplified shapes around and inside each polygon.
+
+    Buffering by 2 * tolerance with 45 degree arc segments keeps the offset
+    boundary at least 1.84 * tolerance away, and simplifying by tolerance
+    moves it by at most tolerance, so a hull strictly contains its polygon
+    and a core is strictly inside it. Both are None for polygons with fewer
+    than min_vertices vertices; a core is empty for polygons too thin to have one.
+    """
+    polygons = np.array(polygons, dtype=object)
+    hulls = np.full(len(polygons), None, dtype=object)
+    cores = np.full(len(polygons), None, dtype=object)
+    tiered = np.flatnonzero(shapely.get_num_coordinates(polygons) >= min_vertices) if len(polygons) else []
+    if len(tiered):
+        hulls[tiered] = shapely.simplify(shapely.buffer(polygons[tiered], 2 * tolerance, quad_segs=2), tolerance)
+        cores[tiered] = shapely.simplify(shapely.buffer(polygons[tiered], -2 * tolerance, quad_segs=2), tolerance)
+    return hulls, cores
+
+
+def untimed(stage):
+    """Default stage timer of an index: records nothing."""
+    return nullcontext()
+
+
+def geojson_feature_parts(features, issues=None):
+    """Yield (properties, repaired polygons) for every GeoJSON feature.
+
+    Problems are appended to issues as (feature number, issue, detail), with
+    features numbered from 1 in file order.
+    """
+    for i, feature in enumerate(features):
+        properties = feature.get('properties') or {}
+        feature_issues = []
+        try:
+            polygons = feature_parts(feature.get('geometry') or {}, feature_issues)
+        except Exception as e:
+            logger.warning("Error processing feature %d: %s", i + 1, e)
+            feature_issues.append(('dropped', f"unreadable geometry: {e}"))
+            polygons = []
+        if issues is not None:
+            issues.extend((i + 1, issue, detail) for issue, detail in feature_issues)
+        yield properties, polygons
+
+
+class MicromarketIndex:
+    """Prepared micromarket polygons behind an STRtree.
+
+    Each polygon of a feature is stored as its own tree entry tagged with the
+    position of the feature it came from. When several features contain a
+    point the one listed first in the source file wins, which is the order
+    the original linear scan used.
+    """
+
+    def __init__(self, features, name_properties=('Micromarket',)):
+        self._build(geojson_feature_parts(features), name_properties)
+
+    @classmethod
+    def from_parts(cls, feature_parts, name_properties=('Micromarket',), feature_tiers=None):
+        """Build an index from (properties, repaired polygons) pairs.
+
+        feature_tiers optionally gives the precomputed (hulls, cores) of each
+        feature's polygons, as simplification_tiers returns them.
+        """
+        index = cls.__new__(cls)
+        index._build(feature_parts, name_properties, feature_tiers)
+        return index
+
+    @classmethod
+    def combine(cls, indexes):
+        """Build one index over the features of several indexes, in order.
+
+        The positions of each index's features are offset by the number of
+        features in the indexes before it. Tiers are reused, grids are not.
+        """
+        index = cls.__new__(cls)
+        index.properties = [properties for source in indexes for properties in source.properties]
+        offsets = np.cumsum([0] + [len(source) for source in indexes])
+        index._set_parts(
+            [part for source in indexes for part in source.parts],
+            [feature + offset for source, offset in zip(indexes, offsets) for feature in source.part_features],
+            [hull for source in indexes for hull in source.hulls],
+            [core for source in indexes for core in source.cores])
+        return index
+
+    def _build(self, feature_parts, name_properties, feature_tiers=None):
+        self.properties = []
+        parts = []
+        part_features = []
+        hulls = []
+        cores = []
+        for (properties, polygons), tiers in zip(feature_parts, feature_tiers or repeat(None)):
+            if not any(properties.get(name) for name in name_properties):
+                continue
+            if not polygons:
+                continue
+            position = len(self.properties)
+            self.properties.append(properties)
+            parts.extend(polygons)
+            part_features.extend([position] * len(polygons))
+            feature_hulls, feature_cores = tiers if tiers is not None else simplification_tiers(polygons)
+            hulls.extend(feature_hulls)
+            cores.extend(feature_cores)
+
+        self._set_parts(parts, part_features, hulls, cores)
+
+    def _set_parts(self, parts, part_features, hulls, cores):
+        self.parts = np.array(parts, dtype=object)
+        self.part_features = np.array(part_features, dtype=np.intp)
+        self.hulls = np.array(hulls, dtype=object)
+        self.cores = np.array(cores, dtype=object)
+        self.tiered = np.not_equal(self.hulls, None)
+        shapely.prepare(self.parts)
+        shapely.prepare(self.hulls[self.tiered])
+        shapely.prepare(self.cores[self.tiered])
+        self.tree = STRtree(self.parts)
+        self.grid = None
+        # stage_timer(stage) returns a context manager timing the "grid",
+        # "candidates" and "exact" stages of lookups
+        self.stage_timer = untimed
+        # Identifies the boundary set the index was built from (see micromarket_store.load_index)
+        self.version = None
+        self._boundary_tree = None
+
+    def __len__(self):
+        return len(self.properties)
+
+    def feature_positions(self, name, value):
+        """Return the positions of the features whose property name equals value."""
+        return np.array([i for i, properties in enumerate(self.properties) if properties.get(name) == value],
+                        dtype=np.intp)
+
+    def attach_grid(self, grid):
+        """Answer lookups from a precomputed grid first (see micromarket_grid)."""
+        if grid.feature_count != len(self):
+            raise ValueError(f"Grid was built for {grid.feature_count} features, index has {len(self)}")
+        self.grid = grid
+
+    def locate(self, lat, lon):
+        """Return the position of the feature containing the point, or -1."""
+        if self.grid is not None:
+            with self.stage_timer('grid'):
+                position = self.grid.locate(lat, lon)
+            if position is not None:
+                return position
+        with self.stage_timer('candidates'):
+            candidates = self.tree.query(shapely.Point(lon, lat))
+        if len(candidates) == 0:
+            return -1
+        with self.stage_timer('exact'):
+            hits = candidates[self._contains(candidates, np.full(len(candidates), lon),
+                                             np.full(len(candidates), lat))]
+        if len(hits) == 0:
+            return -1
+        return int(self.part_features[hits].min())
+
+    def lookup(self, lat, lon):
+        """Return the properties of the feature containing the point, or None."""
+        position = self.locate(lat, lon)
+        if position < 0:
+            return None
+        return self.properties[position]
+
+    def locate_many(self, lats, lons):
+        """Return the containing feature position for every point, -1 where none.
+
+        All points are matched against the tree in one vectorized query and
+        the exact test runs on the prepared candidates only.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if self.grid is not None:
+            with self.stage_timer('grid'):
+                positions, undecided = self.grid.locate_many(lats, lons)
+            undecided = np.flatnonzero(undecided)
+            positions[undecided] = self._exact_positions(lats[undecided], lons[undecided])
+            return positions
+        return self._exact_positions(lats, lons)
+
+    def _exact_positions(self, lats, lons):
+        positions = np.full(len(lats), len(self.properties), dtype=np.intp)
+        point_idx, features = self.containing(lats, lons)
+        np.minimum.at(positions, point_idx, features)
+        positions[positions == len(self.properties)] = -1
+        return positions
+
+    def containing(self, lats, lons):
+        """Return (point indices, feature positions) for every feature containing each point.
+
+        Skips the grid; a feature with several parts containing a point may
+        appear more than once.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        if not len(lats) or not len(self.parts):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        with self.stage_timer('candidates'):
+            point_idx, part_idx = self.tree.query(shapely.points(lons, lats))
+        with self.stage_timer('exact'):
+            hits = self._contains(part_idx, lons[point_idx], lats[point_idx])
+        return point_idx[hits], self.part_features[part_idx[hits]]
+
+    def _contains(self, part_idx, lons, lats):
+        """Return whether each part in part_idx contains the matching point.
+
+        Tiered parts are decided by their hull and core where possible.
+        """
+        hits = np.zeros(len(part_idx), dtype=bool)
+        tiered = self.tiered[part_idx]
+        direct = np.flatnonzero(~tiered)
+        hits[direct] = shapely.contains_xy(self.parts[part_idx[direct]], lons[direct], lats[direct])
+
+        pending = np.flatnonzero(tiered)
+        pending = pending[shapely.contains_xy(self.hulls[part_idx[pending]], lons[pending], lats[pending])]
+        in_core = shapely.contains_xy(self.cores[part_idx[pending]], lons[pending], lats[pending])
+        hits[pending[in_core]] = True
+        band = pending[~in_core]
+        hits[band] = shapely.contains_xy(self.parts[part_idx[band]], lons[band], lats[band])
+        return hits
+
+    def metric_scale(self):
+        """Return the (x, y) meters per degree of the local frame used for distances.
+
+        The frame is equirectangular, centred on the latitude of the boundaries,
+        which is accurate to well under a percent across a city.
+        """
+        if len(self.parts):
+            _, min_lat, _, max_lat = shapely.total_bounds(self.parts)
+            lat0 = (min_lat + max_lat) / 2
+        else:
+            lat0 = 0.0
+        return np.array([METERS_PER_DEGREE * math.cos(math.radians(lat0)), METERS_PER_DEGREE])
+
+    def _boundary_segments(self):
+        """Return (tree, segment features, scale) over every boundary edge in meters.
+
+        Distances to single edges are far cheaper than to whole polygons, and
+        for a point outside a polygon the two are the same.
+        """
+        if self._boundary_tree is None:
+            # Built on first use; a race only builds the same tree twice
+            scale = self.metric_scale()
+            rings, ring_parts = shapely.get_rings(
+                shapely.transform(self.parts, lambda coords: coords * scale), return_index=True)
+            coords, coord_rings = shapely.get_coordinates(rings, return_index=True)
+            edge = coord_rings[1:] == coord_rings[:-1]
+            segments = shapely.linestrings(np.stack([coords[:-1][edge], coords[1:][edge]], axis=1))
+            segment_features = self.part_features[ring_parts[coord_rings[:-1][edge]]]
+            self._boundary_tree = (STRtree(segments), segment_features, scale)
+        return self._boundary_tree
+
+    def nearest_many(self, lats, lons, max_distance):
+        """Return (positions, distances) of the nearest feature within max_distance meters.
+
+        Meant for points that no feature contains: distances are measured to
+        feature boundaries. Positions are -1 and distances NaN where no
+        feature is that close, and equally near features go to the one
+        listed first in the source file.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        positions = np.full(len(lats), -1, dtype=np.intp)
+        distances = np.full(len(lats), np.nan)
+        if not len(lats) or not len(self.parts) or max_distance <= 0:
+            return positions, distances
+
+        tree, segment_features, scale = self._boundary_segments()
+        finite = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+        points = shapely.points(lons[finite] * scale[0], lats[finite] * scale[1])
+        (point_idx, segment_idx), found = tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=True)
+        nearest = np.full(len(finite), len(self.properties), dtype=np.intp)
+        np.minimum.at(nearest, point_idx, segment_features[segment_idx])
+        matched = nearest < len(self.properties)
+        positions[finite[matched]] = nearest[matched]
+        distances[finite[point_idx]] = found
+        return positions, distances
+
+    def warm(self):
+        """Build what lookups otherwise build on first use: the boundary segments behind nearest()."""
+        self._boundary_segments()
+
+    def nearest(self, lat, lon, max_distance):
+        """Return (position, distance in meters) of the nearest feature, or (-1, nan)."""
+        positions, distances = self.nearest_many([lat], [lon], max_distance)
+        return int(positions[0]), float(distances[0])
+
+
+def bounding_box_positions(lats, lons, bboxes):
+    """Return the position of the first bbox holding each point, -1 where none."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    positions = np.full(len(lats), -1, dtype=np.intp)
+    for i, (min_lon, min_lat, max_lon, max_lat) in enumerate(bboxes):
+        inside = (positions < 0) & (min_lon <= lons) & (lons <= max_lon) & (min_lat <= lats) & (lats <= max_lat)
+        positions[inside] = i
+    return positions
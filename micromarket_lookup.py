@@ -0,0 +1,362 @@
+"""Micromarket lookups shared by the Flask app, the ASGI service and upload jobs.
+
+Importing this module loads the boundary index and declares the metrics,
+and nothing more: it starts no threads or processes and creates no
+directories, so the ASGI service and the processes running background
+upload jobs can import it without app.py. The importer decides whether to
+watch the boundary files for changes (boundaries.watch).
+"""
+import logging
+import math
+import os
+import tempfile
+import numpy as np
+from boundary_reload import ReloadableIndex
+from enrichment import (KNOWN_AREAS, NEAREST_MAX_DISTANCE, OutputColumns, detect_layout, parse_coordinates,
+                        point_in_bounding_box)
+from log_config import RequestSummary, debug_sampled
+from lookup_cache import LookupCache, SQLiteCacheBackend
+from metrics import STAGE_BUCKETS, MetricsRegistry
+from micromarket_index import bounding_box_positions
+from table_formats import TableReader, TableWriter, format_for
+
+logger = logging.getLogger(__name__)
+
+# GeoJSON File Path
+DATA_FILE_PATH = os.path.join(os.path.dirname(__file__), 'Data', 'new.geojson')
+
+# Prometheus metrics served at /metrics. Every worker process records into its own
+# file in MICROMARKET_METRICS_DIR and a scrape answered by any worker sums them all.
+metrics = MetricsRegistry(os.environ.get('MICROMARKET_METRICS_DIR',
+                                         os.path.join(tempfile.gettempdir(), 'micromarket_metrics')))
+STAGES = ('parse', 'grid', 'candidates', 'exact', 'fallback', 'csv_read', 'csv_write')
+MATCHES = ('polygon', 'nearest', 'known_area', 'none')
+stage_seconds = metrics.histogram(
+    'micromarket_stage_duration_seconds', "Time spent in each stage of lookups and uploads.",
+    ('stage',), [(stage,) for stage in STAGES], buckets=STAGE_BUCKETS)
+cache_lookups = metrics.counter(
+    'micromarket_cache_lookups_total', "Single-point lookups by lookup cache outcome.",
+    ('result',), [('hit',), ('shared_hit',), ('miss',)])
+match_results = metrics.counter(
+    'micromarket_results_total', "Classified points by how they matched; none is an Unknown result.",
+    ('match',), [(match,) for match in MATCHES])
+rows_processed = metrics.counter(
+    'micromarket_rows_total', "Rows of batch requests and CSV uploads by outcome.",
+    ('source', 'outcome'), [(source, outcome) for source in ('batch', 'upload')
+                            for outcome in ('matched', 'unmatched', 'invalid')])
+
+# Every process writing to MICROMARKET_METRICS_DIR must declare the same metrics, so the
+# routes timed by the Flask app and the ASGI service are listed here; app.py checks the list
+ROUTES = ('admin_profile', 'admin_profiles', 'admin_profiling', 'admin_reload', 'boundary_tile',
+          'boundary_version', 'cache_stats', 'find_layers', 'find_micromarket', 'find_micromarket_batch', 'home',
+          'job_result', 'job_status', 'layers_info', 'micromarket_properties', 'prometheus_metrics',
+          'properties_within', 'static', 'tiles_info', 'upload_csv', 'zone_properties')
+request_seconds = metrics.histogram(
+    'micromarket_request_duration_seconds', "Time to handle a request, including streaming the response.",
+    ('route',), [(route,) for route in ROUTES])
+responses = metrics.counter(
+    'micromarket_responses_total', "Responses by route and status class.",
+    ('route', 'status'), [(route, f"{status}xx") for route in ROUTES for status in range(1, 6)])
+
+# Largest number of points accepted by /find_micromarket/batch
+MAX_BATCH_SIZE = int(os.environ.get('MICROMARKET_MAX_BATCH_SIZE', 10000))
+
+# Uploads are read, classified and written this many rows at a time
+UPLOAD_BATCH_ROWS = 5000
+# Columns added to uploads, or updated in place when a re-upload already has them
+UPLOAD_COLUMNS = ('Micromarket', 'Zone')
+# Where uploads without named coordinate columns keep latitude and longitude
+POSITIONAL_LAYOUT = (1, 2)
+
+# Cache single-point lookups on coordinates rounded to MICROMARKET_CACHE_PRECISION
+# decimals; MICROMARKET_CACHE_DB shares results between worker processes
+CACHE_DB_PATH = os.environ.get('MICROMARKET_CACHE_DB')
+lookup_cache = LookupCache(
+    maxsize=int(os.environ.get('MICROMARKET_CACHE_SIZE', 100000)),
+    precision=int(os.environ.get('MICROMARKET_CACHE_PRECISION', 6)),
+    backend=SQLiteCacheBackend(CACHE_DB_PATH) if CACHE_DB_PATH else None,
+    on_lookup=cache_lookups.inc
+)
+
+# Seconds between checks of the boundary files by boundaries.watch()
+RELOAD_INTERVAL = float(os.environ.get('MICROMARKET_RELOAD_INTERVAL', 30))
+
+
+def bind_index(index):
+    """Point the stage timers and the lookup cache at a newly loaded index."""
+    index.stage_timer = stage_seconds.time
+    lookup_cache.bind(f"{index.version}:nearest={NEAREST_MAX_DISTANCE:g}")
+
+
+# The micromarket index, from the compiled store and grid when they are current
+boundaries = ReloadableIndex(DATA_FILE_PATH, on_swap=bind_index)
+
+
+def finite_coordinates(latitude, longitude):
+    """Return (lat, lon) as floats; raises ValueError unless both are finite numbers."""
+    lat, lon = float(latitude), float(longitude)
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        raise ValueError("latitude and longitude must be finite")
+    return lat, lon
+
+
+def get_micromarket_info(lat, lon):
+    """Determine the micromarket and zone for given coordinates, using the cache.
+
+    Returns (micromarket, zone, match, distance); see lookup_micromarket_info.
+    """
+    return lookup_cache.lookup(lat, lon, lookup_micromarket_info)
+
+
+def lookup_micromarket_info(lat, lon):
+    """Determine the micromarket and zone for given coordinates.
+
+    Returns (micromarket, zone, match, distance) where match is "polygon",
+    "nearest", "known_area" or "none" and distance is the distance in meters
+    to the matched micromarket (0 inside it, None without one).
+    """
+    try:
+        debug = debug_sampled(logger)
+        index = boundaries.index
+        # First try the GeoJSON polygon approach
+        properties = index.lookup(lat, lon)
+        if properties is not None:
+            micromarket_name = properties.get('Micromarket', '')
+            zone_name = properties.get('Zone', '')
+            if debug:
+                logger.debug("Point (%s, %s): polygon match %s, zone %s", lat, lon, micromarket_name, zone_name)
+            return micromarket_name, zone_name, "polygon", 0.0
+        with stage_seconds.time('fallback'):
+            # Then the nearest micromarket within NEAREST_MAX_DISTANCE
+            position, distance = index.nearest(lat, lon, NEAREST_MAX_DISTANCE)
+            if position >= 0:
+                properties = index.properties[position]
+                micromarket_name = properties.get('Micromarket', '')
+                zone_name = properties.get('Zone', '')
+                if debug:
+                    logger.debug("Point (%s, %s): nearest %s at %.0fm", lat, lon, micromarket_name, distance)
+                return micromarket_name, zone_name, "nearest", distance
+            # If polygon check fails, try the bounding box approach for known areas
+            for area_name, bbox in KNOWN_AREAS.items():
+                if point_in_bounding_box(lon, lat, bbox):
+                    if debug:
+                        logger.debug("Point (%s, %s): bounding box match %s", lat, lon, area_name)
+                    return area_name, "", "known_area", None
+        if debug:
+            logger.debug("Point (%s, %s): no match in any polygon or bounding box", lat, lon)
+        return "Unknown", "", "none", None
+    except Exception as e:
+        logger.error("Error in get_micromarket_info for (%s, %s): %s", lat, lon, e)
+        return "Unknown", "", "none", None
+
+
+def get_micromarket_info_batch(lats, lons):
+    """Determine the micromarket and zone for arrays of coordinates in one pass.
+
+    Returns arrays of micromarkets, zones, matches and distances, as
+    lookup_micromarket_info does for one point (distances are NaN for None).
+    """
+    index = boundaries.index
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    positions = index.locate_many(lats, lons)
+    matches = np.where(positions >= 0, "polygon", "none").astype(object)
+    distances = np.where(positions >= 0, 0.0, np.nan)
+
+    # Points outside every polygon take the nearest one within NEAREST_MAX_DISTANCE
+    unmatched = np.flatnonzero(positions < 0)
+    if len(unmatched):
+        with stage_seconds.time('fallback'):
+            nearest, nearest_distances = index.nearest_many(lats[unmatched], lons[unmatched], NEAREST_MAX_DISTANCE)
+        found = nearest >= 0
+        positions[unmatched[found]] = nearest[found]
+        matches[unmatched[found]] = "nearest"
+        distances[unmatched[found]] = nearest_distances[found]
+
+    micromarket_names = np.full(len(positions), "Unknown", dtype=object)
+    zone_names = np.full(len(positions), "", dtype=object)
+    for position in np.unique(positions[positions >= 0]):
+        properties = index.properties[position]
+        matched = positions == position
+        micromarket_names[matched] = properties.get('Micromarket', '')
+        zone_names[matched] = properties.get('Zone', '')
+
+    # The rest fall back to the known area bounding boxes
+    unmatched = np.flatnonzero(positions < 0)
+    if len(unmatched):
+        area_names = list(KNOWN_AREAS)
+        with stage_seconds.time('fallback'):
+            boxes = bounding_box_positions(lats[unmatched], lons[unmatched], KNOWN_AREAS.values())
+        for i, box in zip(unmatched, boxes):
+            if box >= 0:
+                micromarket_names[i] = area_names[box]
+                matches[i] = "known_area"
+
+    for match, count in zip(*np.unique(matches, return_counts=True)):
+        match_results.inc(match, amount=int(count))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for lat, lon, micromarket_name, zone_name, match in zip(lats, lons, micromarket_names, zone_names, matches):
+            if debug_sampled(logger):
+                logger.debug("Point (%s, %s): %s, zone %s (%s)", lat, lon, micromarket_name, zone_name, match)
+    return micromarket_names, zone_names, matches, distances
+
+
+def upload_columns(header):
+    """Return the OutputColumns of an upload's header.
+
+    Micromarket and Zone columns already in the header, as in a re-uploaded
+    result, are reused.
+    """
+    return OutputColumns(header, UPLOAD_COLUMNS)
+
+
+def upload_layout(header, rows):
+    """Return the coordinate layout of an upload, given its header and first rows.
+
+    Latitude and Longitude or coordinates columns are found by name, as
+    enrichment.detect_layout finds them. Otherwise the second column holds
+    "lat, lon" if its first non-empty cell has a comma, and uploads keep
+    their positional layout, latitude and longitude in the second and third
+    columns, under any header names.
+    """
+    names = [name.strip().lower() for name in header]
+    if ('latitude' in names and 'longitude' in names) or 'coordinates' in names:
+        return detect_layout(header)
+    sample = next((row[1] for row in rows if len(row) > 1 and row[1].strip()), '')
+    return (1,) if ',' in sample else POSITIONAL_LAYOUT
+
+
+def enrich_rows(rows, columns, layout, summary=None):
+    """Fill in the micromarket and zone columns of uploaded CSV rows.
+
+    columns and layout are the upload_columns and upload_layout of the
+    upload. Row, match and invalid counts are added to summary when one is
+    given.
+    """
+    coordinates = []
+    valid = []
+    enriched = []
+    needed = max(layout) + 1
+    for row in rows:
+        out = columns.arrange(row)
+        enriched.append(out)
+        if len(row) < needed:
+            out[columns.micromarket], out[columns.area] = "Invalid Row", ""
+            continue
+        try:
+            point = parse_coordinates(row, layout)
+            if point is None:
+                raise ValueError("no coordinates")
+        except ValueError:
+            out[columns.micromarket], out[columns.area] = "Invalid Coordinates", ""
+            continue
+        valid.append(len(enriched) - 1)
+        coordinates.append(point)
+
+    if coordinates:
+        lats, lons = np.array(coordinates, dtype=float).T
+        micromarket_names, zone_names, _, _ = get_micromarket_info_batch(lats, lons)
+        for i, micromarket_name, zone_name in zip(valid, micromarket_names, zone_names):
+            enriched[i][columns.micromarket], enriched[i][columns.area] = micromarket_name, zone_name
+        matched = int(np.count_nonzero(micromarket_names != "Unknown"))
+    else:
+        matched = 0
+    record_rows('upload', len(enriched), matched, len(enriched) - len(valid))
+    if summary is not None:
+        summary.add(rows=len(enriched), matched=matched, invalid=len(enriched) - len(valid))
+    return enriched
+
+
+def record_rows(source, rows, matched, invalid):
+    rows_processed.inc(source, 'matched', amount=matched)
+    rows_processed.inc(source, 'unmatched', amount=rows - matched - invalid)
+    rows_processed.inc(source, 'invalid', amount=invalid)
+
+
+def validate_batch_points(points):
+    """Return (results, valid, coordinates) for the points of a batch.
+
+    results holds a dict per point, with an error for the invalid ones;
+    valid lists the positions in results of the valid points, whose
+    (lat, lon) are in coordinates.
+    """
+    results = []
+    valid = []
+    coordinates = []
+    for point in points:
+        if not isinstance(point, dict):
+            results.append({"id": None, "error": "Invalid coordinates: expected an object with latitude and longitude"})
+            continue
+        result = {"id": point.get('id')}
+        try:
+            lat, lon = finite_coordinates(point.get('latitude', ''), point.get('longitude', ''))
+        except (ValueError, TypeError) as e:
+            result["error"] = f"Invalid coordinates: {e}"
+        else:
+            result.update({"latitude": lat, "longitude": lon})
+            valid.append(len(results))
+            coordinates.append((lat, lon))
+        results.append(result)
+    return results, valid, coordinates
+
+
+def classify_batch_points(results, valid, coordinates, summary):
+    """Add the micromarket of every valid point to its result, in one vectorized pass."""
+    if coordinates:
+        lats, lons = np.array(coordinates, dtype=float).T
+        micromarket_names, zone_names, matches, distances = get_micromarket_info_batch(lats, lons)
+        for i, micromarket_name, zone_name, match, distance in zip(
+                valid, micromarket_names, zone_names, matches, distances):
+            results[i].update({
+                "micromarket_name": micromarket_name,
+                "zone_name": zone_name,
+                "match": match,
+                "distance_m": None if np.isnan(distance) else float(distance)
+            })
+        summary.add(matched=int(np.count_nonzero(micromarket_names != "Unknown")))
+    summary.add(rows=len(results), invalid=len(results) - len(valid))
+    record_rows('batch', summary.rows, summary.matched, summary.invalid)
+
+
+def enrich_table(input_path, output_path, summary, output_format=None, on_batch=None, batch_rows=UPLOAD_BATCH_ROWS):
+    """Write the enriched rows of an uploaded CSV, NDJSON, Parquet or Arrow file, one batch at a time.
+
+    Formats follow the file extensions unless output_format is given;
+    on_batch is called after each batch.
+    """
+    with TableReader(input_path, batch_rows=batch_rows) as reader:
+        header = reader.header or []
+        columns, layout = upload_columns(header), None
+        with TableWriter(output_path, columns.header, output_format, reader.types) as writer:
+            batches = reader.batches()
+            while True:
+                with stage_seconds.time('csv_read'):
+                    rows = next(batches, None)
+                if rows is None:
+                    break
+                if layout is None:
+                    layout = upload_layout(header, rows)
+                enriched = enrich_rows(rows, columns, layout, summary)
+                with stage_seconds.time('csv_write'):
+                    writer.write(enriched)
+                if on_batch is not None:
+                    on_batch()
+    summary.log()
+
+
+def run_upload_job(job, progress):
+    """Enrich the saved upload of a background job, reporting progress per batch."""
+    summary = RequestSummary(logger, f"upload_csv job {job['id']} {job['filename']}")
+    progress(boundary_version=boundaries.index.version)
+    partial_path = job['output_path'] + '.partial'
+    try:
+        enrich_table(job['input_path'], partial_path, summary, format_for(job['output_path']),
+                     on_batch=lambda: progress(rows_done=summary.rows, matched=summary.matched,
+                                               invalid=summary.invalid))
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, job['output_path'])
+    return {"rows_done": summary.rows, "matched": summary.matched, "invalid": summary.invalid}
@@ -0,0 +1,288 @@
+"""Compiled binary store for micromarket boundaries.
+
+Parsing and repairing the GeoJSON is the slowest part of worker startup.
+Compiling turns the repaired polygons into flat arrays that are memory-mapped
+on load, so workers skip the JSON parse and the repair pass:
+
+    python micromarket_store.py Data/new.geojson
+
+Layout, after a fixed header and with every array 8-byte aligned:
+
+    coords           float64 (n_coords, 2)   lon/lat of every ring vertex
+    ring_offsets     int64   (n_rings + 1)   coords of each ring
+    polygon_offsets  int64   (n_polygons + 1) rings of each polygon
+    part_offsets     int64   (n_parts + 1)   polygons of each repaired part
+    feature_offsets  int64   (n_features + 1) parts of each feature
+    bboxes           float64 (n_features, 4) min_lon, min_lat, max_lon, max_lat
+    tier_coords           float64 (n_tier_coords, 2)
+    tier_ring_offsets     int64   (n_tier_rings + 1)
+    tier_polygon_offsets  int64   (n_tier_polygons + 1)
+    tier_offsets          int64   (2 * n_parts + 1) the hull of every part,
+                                  then its core (see simplification_tiers);
+                                  empty for parts without tiers
+    attributes       utf-8 JSON list of feature properties
+
+The GeoJSON stays the source of truth: the header records its sha256 and a
+store that no longer matches is ignored.
+
+Only the file's pages are shared between workers. shapely.from_ragged_array
+copies the coordinates into GEOS geometries, so each worker still holds its
+own copy of the polygons and their search trees; the store saves startup
+time and the parse garbage, not the index itself.
+"""
+import argparse
+import json
+import logging
+import os
+import struct
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon
+from log_config import configure_logging
+from micromarket_grid import file_digest, grid_path_for, load_grid
+from geometry_health import check_features, report_path_for, summarize, write_report
+from micromarket_index import MicromarketIndex, simplification_tiers
+
+logger = logging.getLogger(__name__)
+
+# Version 3: repaired parts keep their holes
+STORE_MAGIC = b'MMSTORE3'
+# magic, n_coords, n_rings, n_polygons, n_parts, n_features, n_tier_coords, n_tier_rings,
+# n_tier_polygons, attributes length, sha256 of the source
+STORE_HEADER = struct.Struct('<8sQQQQQQQQQ32s')
+
+
+def store_path_for(geojson_path):
+    """Return the default compiled store path for a GeoJSON file."""
+    return os.path.splitext(geojson_path)[0] + '.mmb'
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+class CompiledStore:
+    """A memory-mapped compiled boundary file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(STORE_HEADER.size)
+        if len(header) < STORE_HEADER.size:
+            raise ValueError(f"Truncated store file: {path}")
+        (magic, n_coords, n_rings, n_polygons, n_parts, n_features, n_tier_coords, n_tier_rings,
+         n_tier_polygons, attributes_len, self.digest) = STORE_HEADER.unpack(header)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"Not a compiled micromarket store, or an older format: {path}")
+
+        offset = _aligned(STORE_HEADER.size)
+
+        def section(dtype, shape):
+            nonlocal offset
+            array = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+            offset += _aligned(array.nbytes)
+            return array
+
+        self.coords = section('<f8', (n_coords, 2))
+        self.ring_offsets = section('<i8', (n_rings + 1,))
+        self.polygon_offsets = section('<i8', (n_polygons + 1,))
+        self.part_offsets = section('<i8', (n_parts + 1,))
+        self.feature_offsets = section('<i8', (n_features + 1,))
+        self.bboxes = section('<f8', (n_features, 4))
+        self.tier_coords = section('<f8', (n_tier_coords, 2))
+        self.tier_ring_offsets = section('<i8', (n_tier_rings + 1,))
+        self.tier_polygon_offsets = section('<i8', (n_tier_polygons + 1,))
+        self.tier_offsets = section('<i8', (2 * n_parts + 1,))
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.properties = json.loads(f.read(attributes_len).decode('utf-8'))
+
+    def __len__(self):
+        return len(self.properties)
+
+    def parts(self):
+        """Return every repaired part as an array of shapely geometries."""
+        return _multipolygons(self.coords, self.ring_offsets, self.polygon_offsets, self.part_offsets)
+
+    def feature_parts(self):
+        """Yield (properties, repaired polygons) for every stored feature."""
+        parts = self.parts()
+        for i, properties in enumerate(self.properties):
+            start, end = self.feature_offsets[i], self.feature_offsets[i + 1]
+            yield properties, list(parts[start:end])
+
+    def feature_tiers(self):
+        """Yield the (hulls, cores) of every stored feature's parts."""
+        tiers = _multipolygons(self.tier_coords, self.tier_ring_offsets, self.tier_polygon_offsets,
+                               self.tier_offsets)
+        n_parts = len(self.part_offsets) - 1
+        hulls, cores = tiers[:n_parts], tiers[n_parts:]
+        # Parts without tiers are stored as empty hulls
+        untiered = shapely.is_empty(hulls)
+        hulls[untiered] = None
+        cores[untiered] = None
+        for i in range(len(self.properties)):
+            start, end = self.feature_offsets[i], self.feature_offsets[i + 1]
+            yield hulls[start:end], cores[start:end]
+
+
+def _multipolygons(coords, ring_offsets, polygon_offsets, geometry_offsets):
+    if len(geometry_offsets) <= 1:
+        return np.array([], dtype=object)
+    geometries = shapely.from_ragged_array(
+        shapely.GeometryType.MULTIPOLYGON, coords, (ring_offsets, polygon_offsets, geometry_offsets))
+    # Geometries are stored as multipolygons; unwrap the single-polygon ones
+    single = shapely.get_num_geometries(geometries) == 1
+    geometries[single] = shapely.get_geometry(geometries[single], 0)
+    return geometries
+
+
+def _ragged_multipolygons(geometries):
+    """Return (coords, ring_offsets, polygon_offsets, geometry_offsets) of polygons."""
+    if not geometries:
+        return np.empty((0, 2)), np.zeros(1), np.zeros(1), np.zeros(1)
+    multipolygons = [g if g.geom_type == 'MultiPolygon' else
+                     MultiPolygon([g]) if not g.is_empty else MultiPolygon() for g in geometries]
+    _, coords, offsets = shapely.to_ragged_array(np.array(multipolygons, dtype=object))
+    return (coords, *offsets)
+
+
+def compile_geojson(geojson_path, output_path=None, report_path=None):
+    """Compile a GeoJSON boundary file into the binary store format.
+
+    The geometry health report (see geometry_health) is written next to the
+    GeoJSON unless report_path is given.
+    """
+    with open(geojson_path, encoding='utf-8') as f:
+        features = json.load(f).get('features', [])
+
+    feature_parts, report = check_features(features)
+    report_path = write_report(report, report_path or report_path_for(geojson_path))
+    logger.info("Boundary geometry check: %s; see %s", summarize(report), report_path)
+    return compile_features(feature_parts, file_digest(geojson_path), output_path or store_path_for(geojson_path))
+
+
+def compile_features(feature_parts, digest, output_path):
+    """Write (properties, repaired polygons) pairs to a store file tagged with digest.
+
+    The file is replaced atomically, so concurrent readers see either the
+    old store or the complete new one.
+    """
+    properties = []
+    parts = []
+    feature_offsets = [0]
+    bboxes = []
+    for feature_properties, polygons in feature_parts:
+        properties.append(feature_properties)
+        parts.extend(polygons)
+        feature_offsets.append(len(parts))
+        if polygons:
+            bounds = shapely.bounds(np.array(polygons, dtype=object))
+            bboxes.append([*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0)])
+        else:
+            bboxes.append([np.nan] * 4)
+
+    coords, ring_offsets, polygon_offsets, part_offsets = _ragged_multipolygons(parts)
+    hulls, cores = simplification_tiers(parts)
+    # Parts without tiers get an empty hull and core
+    empty = [MultiPolygon()] * len(parts)
+    tier_coords, tier_ring_offsets, tier_polygon_offsets, tier_offsets = _ragged_multipolygons(
+        [*np.where(np.equal(hulls, None), empty, hulls), *np.where(np.equal(cores, None), empty, cores)])
+
+    attributes = json.dumps(properties, ensure_ascii=False).encode('utf-8')
+    header = STORE_HEADER.pack(
+        STORE_MAGIC, len(coords), len(ring_offsets) - 1, len(polygon_offsets) - 1,
+        len(part_offsets) - 1, len(properties), len(tier_coords), len(tier_ring_offsets) - 1,
+        len(tier_polygon_offsets) - 1, len(attributes), digest)
+    arrays = [
+        np.asarray(coords, dtype='<f8'),
+        np.asarray(ring_offsets, dtype='<i8'),
+        np.asarray(polygon_offsets, dtype='<i8'),
+        np.asarray(part_offsets, dtype='<i8'),
+        np.asarray(feature_offsets, dtype='<i8'),
+        np.asarray(bboxes, dtype='<f8').reshape(-1, 4),
+        np.asarray(tier_coords, dtype='<f8'),
+        np.asarray(tier_ring_offsets, dtype='<i8'),
+        np.asarray(tier_polygon_offsets, dtype='<i8'),
+        np.asarray(tier_offsets, dtype='<i8'),
+    ]
+
+    partial_path = f"{output_path}.{os.getpid()}.partial"
+    with open(partial_path, 'wb') as f:
+        for block in [header, *(a.tobytes() for a in arrays)]:
+            f.write(block)
+            f.write(b'\0' * (_aligned(len(block)) - len(block)))
+        f.write(attributes)
+    os.replace(partial_path, output_path)
+    return output_path
+
+
+def current_store(store_path, digest):
+    """Return the store at store_path if it was compiled from a source with digest, else None."""
+    if not os.path.exists(store_path):
+        return None
+    try:
+        store = CompiledStore(store_path)
+    except Exception as e:
+        logger.error("Could not load compiled store: %s", e)
+        return None
+    if store.digest != digest:
+        logger.warning("Ignoring stale store %s; recompile it with micromarket_store.py", store_path)
+        return None
+    return store
+
+
+def load_index(geojson_path, name_properties=('Micromarket',)):
+    """Build the lookup index for a GeoJSON file from its fastest valid source.
+
+    Uses the compiled store and grid table next to the GeoJSON when they were
+    built from the current file, otherwise parses the GeoJSON directly.
+    """
+    digest = file_digest(geojson_path)
+
+    index = None
+    store_path = store_path_for(geojson_path)
+    store = current_store(store_path, digest)
+    if store is not None:
+        index = MicromarketIndex.from_parts(store.feature_parts(), name_properties, store.feature_tiers())
+        logger.info("Loaded compiled boundaries from %s", store_path)
+    else:
+        with open(geojson_path, encoding='utf-8') as f:
+            feature_parts, report = check_features(json.load(f).get('features', []), name_properties)
+        index = MicromarketIndex.from_parts(feature_parts, name_properties)
+        logger.info("Successfully loaded GeoJSON from %s", geojson_path)
+        if report:
+            logger.warning("Boundary geometry check: %s; compile the boundaries with "
+                           "micromarket_store.py to write the report", summarize(report))
+
+    index.version = digest.hex()
+
+    grid_path = grid_path_for(geojson_path)
+    try:
+        grid = load_grid(grid_path)
+        if grid.digest != digest:
+            logger.warning("Ignoring stale grid %s; rebuild it with micromarket_grid.py", grid_path)
+        else:
+            index.attach_grid(grid)
+            logger.info("Loaded grid lookup table from %s", grid_path)
+    except FileNotFoundError:
+        logger.info("No grid lookup table at %s, using exact lookups only", grid_path)
+    except Exception as e:
+        logger.error("Could not load grid lookup table: %s", e)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a GeoJSON boundary file into the binary store.")
+    parser.add_argument('geojson', nargs='?', default=os.path.join('Data', 'new.geojson'))
+    parser.add_argument('-o', '--output', help="store file to write (default: next to the GeoJSON)")
+    parser.add_argument('--report', help="geometry health report to write (default: next to the GeoJSON)")
+    args = parser.parse_args()
+
+    configure_logging()
+    output = compile_geojson(args.geojson, args.output, args.report)
+    store = CompiledStore(output)
+    print(f"Wrote {output}: {len(store)} features, {len(store.coords)} vertices")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""On-demand sampling profiles of single requests.
+
+While a request is profiled, a background thread samples the stack of the
+thread serving it every interval and counts each distinct stack. When the
+response has been sent the counts are written in the collapsed-stack format
+that flamegraph.pl, speedscope and most flame graph viewers read, one line
+per stack:
+
+    app:upload_csv;app:enrich_rows;micromarket_index:MicromarketIndex.locate_many 42
+
+next to a .json file describing the request. Time spent inside C code
+(shapely, numpy, csv) shows up under the Python function that called it.
+
+Profiling is switched on for a time window with enable(seconds); the
+window is kept in a file in the profile directory so every worker process
+sees it. Only the newest max_profiles profiles are kept.
+"""
+import collections
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.001  # seconds
+DEFAULT_MAX_PROFILES = 500
+TOGGLE_NAME = 'enabled_until'
+# How long a worker trusts its reading of the toggle file
+TOGGLE_CHECK_INTERVAL = 1.0
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class Profile(threading.Thread):
+    """Samples the stack of one thread until stopped."""
+
+    def __init__(self, profiler, route, path, thread_id):
+        # The thread's name is also the profile's file name
+        super().__init__(name=f"{time.strftime('%Y%m%dT%H%M%S')}-{route}-{uuid.uuid4().hex[:8]}", daemon=True)
+        self.profiler = profiler
+        self.route = route
+        self.path = path
+        self.thread_id = thread_id
+        self.stacks = collections.Counter()
+        self.started = time.time()
+        self.duration = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        interval = self.profiler.interval
+        labels = {}  # code object -> label, computed once per function
+        while not self._stopped.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                label = labels.get(frame.f_code)
+                if label is None:
+                    label = labels[frame.f_code] = frame_label(frame).replace(';', ':')
+                stack.append(label)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            del frame
+
+    def stop(self, status=None):
+        """Stop sampling and write the profile, once; returns its path."""
+        if self._stopped.is_set():
+            return None
+        self.duration = time.time() - self.started
+        self._stopped.set()
+        self.join()
+        return self.profiler.save(self, status)
+
+
+class RequestProfiler:
+    """Starts profiles and keeps the newest ones in directory."""
+
+    def __init__(self, directory, interval=DEFAULT_INTERVAL, max_profiles=DEFAULT_MAX_PROFILES):
+        self.directory = directory
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self._toggle = (0.0, 0.0)  # (checked at, enabled until)
+        self._lock = threading.Lock()
+
+    def start(self, route, path):
+        """Start profiling the calling thread; call stop() on the result when the request is done."""
+        profile = Profile(self, route, path, threading.get_ident())
+        profile.start()
+        return profile
+
+    def save(self, profile, status=None):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{profile.name}.collapsed")
+        with open(path + '.partial', 'w', encoding='utf-8') as f:
+            for stack, count in profile.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(path + '.partial', path)
+        info = {
+            "name": profile.name,
+            "route": profile.route,
+            "path": profile.path,
+            "status": status,
+            "started": profile.started,
+            "duration_s": profile.duration,
+            "samples": sum(profile.stacks.values()),
+            "interval_s": self.interval,
+            "pid": os.getpid(),
+        }
+        with open(os.path.join(self.directory, f"{profile.name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        logger.info("Profiled %s in %.3fs: %d samples in %s", profile.path, profile.duration, info["samples"], path)
+        self._prune()
+        return path
+
+    def _prune(self):
+        profiles = sorted(glob.glob(os.path.join(self.directory, '*.collapsed')), key=os.path.getmtime)
+        for path in profiles[:max(len(profiles) - self.max_profiles, 0)]:
+            for stale in (path, path[:-len('.collapsed')] + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def list(self):
+        """Return the descriptions of the kept profiles, newest first."""
+        profiles = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(profiles, key=lambda info: info['started'], reverse=True)
+
+    def path_of(self, name):
+        """Return the collapsed-stack file of a kept profile, or None."""
+        path = os.path.join(self.directory, f"{os.path.basename(name)}.collapsed")
+        return path if os.path.isfile(path) else None
+
+    def enable(self, seconds):
+        """Profile every request of the profiled routes for the next seconds (0 turns it off)."""
+        os.makedirs(self.directory, exist_ok=True)
+        until = time.time() + seconds if seconds > 0 else 0.0
+        path = os.path.join(self.directory, TOGGLE_NAME)
+        with open(path + f'.{os.getpid()}.partial', 'w', encoding='utf-8') as f:
+            f.write(repr(until))
+        os.replace(path + f'.{os.getpid()}.partial', path)
+        with self._lock:
+            self._toggle = (time.monotonic(), until)
+        return until
+
+    def enabled_until(self):
+        """Return when the profiling window ends, 0 if it is closed; rereads the file at most once a second."""
+        checked, until = self._toggle
+        if time.monotonic() - checked > TOGGLE_CHECK_INTERVAL:
+            try:
+                with open(os.path.join(self.directory, TOGGLE_NAME), encoding='utf-8') as f:
+                    until = float(f.read())
+            except (OSError, ValueError):
+                until = 0.0
+            with self._lock:
+                self._toggle = (time.monotonic(), until)
+        return until if until > time.time() else 0.0
@@ -0,0 +1,211 @@
+"""Reverse lookups: the properties of an inventory that lie inside an area.
+
+An inventory is a CSV of properties with coordinates in either layout that
+enrichment reads (one "lat, lon" column as in data.csv, or Latitude and
+Longitude columns as in the uploads/ project files). Its points are sorted
+into a uniform grid of cells, so the points in a bounding box are a few
+contiguous slices of the sorted arrays, and only those candidates go
+through the vectorized containment test:
+
+    inventory = PropertyIndex.from_csv('data.csv')
+    positions = inventory.in_features(index, index.feature_positions('Micromarket', 'Whitefield'))
+    positions = inventory.within(polygons)
+
+A micromarket or zone query classifies the candidates with the index itself,
+so a property is listed under exactly the micromarket a forward lookup gives
+it, overlaps included. Given the lookup's max_distance, points outside every
+polygon go to the nearest micromarket within it as well; the known-area boxes
+a forward lookup falls back to last are not micromarkets and list nothing.
+"""
+import csv
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import shapely
+from enrichment import detect_layout, parse_coordinates
+
+logger = logging.getLogger(__name__)
+
+# Degrees, about 550 m; a micromarket spans tens of cells
+DEFAULT_CELL_SIZE = 0.005
+# Cells are made larger when the inventory would need more
+MAX_CELLS = 1 << 20
+# The grid covers this central share of the points; the stray rest fall in its edge cells
+GRID_COVERAGE = 0.99
+
+
+class PropertyIndex:
+    """Inventory rows bucketed by a uniform lat/lon grid.
+
+    Rows without usable coordinates are counted in skipped and never match.
+    Points outside the grid are clamped into its edge cells, which keeps a
+    few stray coordinates from stretching it over half the globe.
+    """
+
+    def __init__(self, header, rows, lats, lons, cell_size=DEFAULT_CELL_SIZE, skipped=0):
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        self.header = list(header)
+        self.skipped = skipped
+        self.version = None
+        if len(lats):
+            tail = (1 - GRID_COVERAGE) / 2 * 100
+            min_lat, max_lat = np.percentile(lats, [tail, 100 - tail])
+            min_lon, max_lon = np.percentile(lons, [tail, 100 - tail])
+            cell_size = max(cell_size, math.sqrt((max_lat - min_lat) * (max_lon - min_lon) / MAX_CELLS))
+            self.origin = (min_lon, min_lat)
+            self.shape = (int((max_lat - min_lat) // cell_size) + 1, int((max_lon - min_lon) // cell_size) + 1)
+        else:
+            self.origin = (0.0, 0.0)
+            self.shape = (1, 1)
+        self.cell_size = cell_size
+        cells = self._rows(lats) * self.shape[1] + self._columns(lons)
+        order = np.argsort(cells, kind='stable')
+        self.rows = [rows[i] for i in order]
+        self.file_order = order
+        self.lats = lats[order]
+        self.lons = lons[order]
+        # Points of cell c are [cell_starts[c], cell_starts[c + 1]) of the sorted arrays
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    @classmethod
+    def from_csv(cls, path, cell_size=DEFAULT_CELL_SIZE):
+        """Build the index of an inventory CSV file.
+
+        Raises ValueError when the header has no recognisable coordinates.
+        """
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            layout = detect_layout(header)
+            if layout is None:
+                raise ValueError(f"{path} has no coordinate columns")
+            rows = []
+            coordinates = []
+            skipped = 0
+            for row in reader:
+                try:
+                    point = parse_coordinates(row, layout)
+                except (ValueError, IndexError):
+                    point = None
+                if point is None or not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180):
+                    skipped += 1
+                    continue
+                rows.append(row)
+                coordinates.append(point)
+        lats, lons = np.array(coordinates, dtype=float).reshape(-1, 2).T
+        return cls(header, rows, lats, lons, cell_size, skipped)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _rows(self, lats):
+        return np.clip((lats - self.origin[1]) // self.cell_size, 0, self.shape[0] - 1).astype(np.intp)
+
+    def _columns(self, lons):
+        return np.clip((lons - self.origin[0]) // self.cell_size, 0, self.shape[1] - 1).astype(np.intp)
+
+    def in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the positions of the points inside a bounding box."""
+        if not len(self) or min_lon > max_lon or min_lat > max_lat:
+            return np.empty(0, dtype=np.intp)
+        first_row, last_row = self._rows(np.array([min_lat, max_lat]))
+        first_column, last_column = self._columns(np.array([min_lon, max_lon]))
+        # Within a row of cells the covered columns are one contiguous slice
+        row_starts = np.arange(first_row, last_row + 1) * self.shape[1]
+        starts = self.cell_starts[row_starts + first_column]
+        stops = self.cell_starts[row_starts + last_column + 1]
+        candidates = np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+        inside = ((self.lons[candidates] >= min_lon) & (self.lons[candidates] <= max_lon)
+                  & (self.lats[candidates] >= min_lat) & (self.lats[candidates] <= max_lat))
+        return candidates[inside]
+
+    def _in_file_order(self, positions):
+        return positions[np.argsort(self.file_order[positions])]
+
+    def within(self, polygons):
+        """Return the positions of the points inside any of the polygons, in file order."""
+        if not len(polygons):
+            return np.empty(0, dtype=np.intp)
+        area = shapely.union_all(polygons)
+        candidates = self.in_bbox(*shapely.bounds(area))
+        shapely.prepare(area)
+        return self._in_file_order(candidates[shapely.contains_xy(area, self.lons[candidates],
+                                                                  self.lats[candidates])])
+
+    def in_features(self, index, positions, max_distance=0):
+        """Return the positions of the points a MicromarketIndex places in any of the features, in file order.
+
+        Points outside every feature are placed in the nearest one within
+        max_distance meters, as forward lookups place them (0 disables).
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        parts = index.parts[np.isin(index.part_features, positions)]
+        if not len(parts):
+            return np.empty(0, dtype=np.intp)
+        bounds = shapely.bounds(parts)
+        min_lon, min_lat = bounds[:, :2].min(axis=0)
+        max_lon, max_lat = bounds[:, 2:].max(axis=0)
+        if max_distance > 0:
+            pad_lon, pad_lat = max_distance / index.metric_scale()
+            min_lon, max_lon = min_lon - pad_lon, max_lon + pad_lon
+            min_lat, max_lat = min_lat - pad_lat, max_lat + pad_lat
+        candidates = self.in_bbox(min_lon, min_lat, max_lon, max_lat)
+        lats, lons = self.lats[candidates], self.lons[candidates]
+        located = index.locate_many(lats, lons)
+        unmatched = np.flatnonzero(located < 0)
+        if max_distance > 0 and len(unmatched):
+            located[unmatched] = index.nearest_many(lats[unmatched], lons[unmatched], max_distance)[0]
+        return self._in_file_order(candidates[np.isin(located, positions)])
+
+    def records(self, positions):
+        """Return the rows at positions as dicts keyed by the header, with their coordinates."""
+        records = []
+        for i in positions:
+            record = dict(zip(self.header, self.rows[i]))
+            record.update({"latitude": float(self.lats[i]), "longitude": float(self.lons[i])})
+            records.append(record)
+        return records
+
+    def info(self):
+        return {"properties": len(self), "skipped": self.skipped, "columns": self.header,
+                "cells": self.shape[0] * self.shape[1]}
+
+
+class Inventories:
+    """Property indexes of inventory files, built on first use.
+
+    An index is rebuilt when its file changes; at most max_loaded are kept,
+    least recently used first out.
+    """
+
+    def __init__(self, max_loaded=4, cell_size=DEFAULT_CELL_SIZE):
+        self.max_loaded = max_loaded
+        self.cell_size = cell_size
+        self._loaded = OrderedDict()  # path -> (signature, PropertyIndex)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the PropertyIndex of an inventory file.
+
+        Raises FileNotFoundError if it does not exist and ValueError if it
+        has no coordinate columns.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = stat.st_mtime_ns, stat.st_size
+        with self._lock:
+            loaded = self._loaded.get(path)
+            if loaded is None or loaded[0] != signature:
+                inventory = PropertyIndex.from_csv(path, self.cell_size)
+                inventory.version = f"{signature[0]}-{signature[1]}"
+                logger.info("Indexed %d properties of %s (%d without coordinates)",
+                            len(inventory), path, inventory.skipped)
+                loaded = self._loaded[path] = (signature, inventory)
+            self._loaded.move_to_end(path)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+        return loaded[1]
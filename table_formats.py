@@ -0,0 +1,395 @@
+"""Reading and writing inventories as CSV, NDJSON, Parquet or Arrow.
+
+Enrichment works on rows of text cells, as csv.reader yields them. A
+TableReader hands out the rows of any supported file that way, a batch at a
+time, along with the type of each input column; a TableWriter turns
+batches of such rows back into a file, restoring those types. Cells that
+are not plain strings remember the value they were read from (see Cell),
+so columns enrichment does not replace are written back unchanged: nulls,
+nested lists and objects, and Parquet list columns included. Neither holds
+more than a batch in memory.
+
+    csv      text, one header row
+    ndjson   one JSON object per line; the header is every key of every record
+    parquet  a Parquet file
+    arrow    an Arrow IPC file (Feather v2), or an IPC stream when read
+
+In Parquet and Arrow output the Micromarket, Area and Zone columns are
+dictionary encoded: each distinct name is stored once and rows hold small
+integer codes, which analytics tools load as categoricals. Parquet and Arrow
+need pyarrow, which requirements.txt installs; where it is missing, CSV and
+NDJSON still work and the columnar formats are refused.
+"""
+import csv
+import datetime
+import json
+import logging
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only the columnar formats need it
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'ndjson', 'parquet', 'arrow')
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+    '.parquet': 'parquet', '.pq': 'parquet',
+    '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow', '.arrows': 'arrow',
+}
+FORMAT_EXTENSIONS = {'csv': '.csv', 'ndjson': '.ndjson', 'parquet': '.parquet', 'arrow': '.arrow'}
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+}
+# Output columns stored dictionary encoded in Parquet and Arrow
+CATEGORICAL_COLUMNS = ('Micromarket', 'Area', 'Zone')
+DEFAULT_BATCH_ROWS = 20000
+
+
+def format_for(path, default='csv'):
+    """Return the format of a file from its extension, or default."""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), default)
+
+
+def check_format(fmt):
+    """Raise ValueError unless fmt is a known format that can be used here."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}; expected one of {', '.join(FORMATS)}")
+    if fmt in COLUMNAR_FORMATS and pa is None:
+        raise ValueError(f"The {fmt} format needs pyarrow, which is not installed")
+
+
+class _Absent:
+    """The value of an NDJSON key missing from a record; written back as missing."""
+
+    def __repr__(self):
+        return 'ABSENT'
+
+    def __reduce__(self):
+        # Unpickled in worker processes as this same object
+        return 'ABSENT'
+
+
+ABSENT = _Absent()
+
+
+class Cell(str):
+    """A text cell that keeps the value it was read from.
+
+    Enrichment only sees the text. TableWriter writes the value back, so
+    the columns enrichment does not replace keep their nulls, numbers, lists
+    and objects exactly. Strings are read as plain str cells.
+    """
+
+    def __new__(cls, text, value):
+        cell = super().__new__(cls, text)
+        cell.value = value
+        return cell
+
+    def __reduce__(self):
+        return Cell, (str(self), self.value)
+
+
+def _text(value):
+    """Return a cell value as enrichment sees it."""
+    if value is None or value is ABSENT:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=_text)
+    return str(value)
+
+
+def _cell(value):
+    return value if isinstance(value, str) else Cell(_text(value), value)
+
+
+def _json_type(value):
+    """Return the type name of a JSON value, or None for null."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int64'
+    if isinstance(value, float):
+        return 'float64'
+    if isinstance(value, str):
+        return 'string'
+    return 'json'
+
+
+def _merge_types(seen, value):
+    """Return the type of an NDJSON key holding values of type seen and then value."""
+    found = _json_type(value)
+    if seen is None or found is None or seen == found:
+        return seen or found
+    if {seen, found} == {'int64', 'float64'}:
+        return 'float64'
+    return 'json'
+
+
+class TableReader:
+    """Rows of text cells from a file, in batches of at most batch_rows.
+
+    header lists the column names and types maps each to its type: an
+    Arrow type for Parquet and Arrow input, 'string' for CSV, and for NDJSON
+    'int64', 'float64', 'bool' or 'string' when every record agrees, or
+    'json' for nested or mixed values. Cells that are not strings, nulls
+    included, are Cells carrying the value read.
+
+    The NDJSON header is every key of every record, in the order first
+    seen; the file is read once up front to find them.
+    """
+
+    def __init__(self, path, fmt=None, batch_rows=DEFAULT_BATCH_ROWS):
+        self.path = path
+        self.format = fmt or format_for(path)
+        self.batch_rows = batch_rows
+        check_format(self.format)
+        self._file = None
+        self._source = None
+        getattr(self, f'_open_{self.format}')()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open_csv(self):
+        self._file = open(self.path, encoding='utf-8', newline='')
+        self._source = csv.reader(self._file)
+        self.header = next(self._source, None)
+        self.types = {name: 'string' for name in self.header or []}
+
+    def _open_ndjson(self):
+        self._file = open(self.path, encoding='utf-8')
+        types = {}
+        records = 0
+        for record in self._ndjson_records():
+            records += 1
+            for name, value in record.items():
+                types[name] = _merge_types(types.get(name), value)
+        self.header = list(types) if records else None
+        self.types = {name: value_type or 'string' for name, value_type in types.items()}
+
+    def _open_parquet(self):
+        self._source = pq.ParquetFile(self.path)
+        self._set_schema(self._source.schema_arrow)
+
+    def _open_arrow(self):
+        self._file = pa.memory_map(self.path)
+        try:
+            self._source = pa.ipc.open_file(self._file)
+        except pa.ArrowInvalid:
+            self._file.seek(0)
+            self._source = pa.ipc.open_stream(self._file)
+        self._set_schema(self._source.schema)
+
+    def _set_schema(self, schema):
+        self.header = list(schema.names)
+        self.types = {field.name: field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+                      for field in schema}
+
+    def batches(self):
+        """Yield lists of rows, each row a list of text cells (see Cell)."""
+        if self.header is None:
+            return
+        if self.format == 'csv':
+            batch = []
+            for row in self._source:
+                batch.append(row)
+                if len(batch) >= self.batch_rows:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        elif self.format == 'ndjson':
+            yield from self._ndjson_batches()
+        else:
+            if self.format == 'parquet':
+                record_batches = self._source.iter_batches(batch_size=self.batch_rows)
+            elif isinstance(self._source, pa.ipc.RecordBatchFileReader):
+                record_batches = (self._source.get_batch(i) for i in range(self._source.num_record_batches))
+            else:
+                record_batches = self._source
+            for record_batch in record_batches:
+                for start in range(0, record_batch.num_rows, self.batch_rows):
+                    part = record_batch.slice(start, self.batch_rows)
+                    columns = [[_cell(value) for value in column.to_pylist()] for column in part.columns]
+                    yield [list(row) for row in zip(*columns)]
+
+    def rows(self):
+        """Yield every row, one at a time."""
+        for batch in self.batches():
+            yield from batch
+
+    def _ndjson_records(self):
+        self._file.seek(0)
+        for line_number, line in enumerate(self._file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError(f"{self.path} line {line_number} is not a JSON object")
+            yield record
+
+    def _ndjson_batches(self):
+        header = self.header
+        batch = []
+        for record in self._ndjson_records():
+            batch.append([_cell(record.get(name, ABSENT)) for name in header])
+            if len(batch) >= self.batch_rows:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class _Categories:
+    """A dictionary that only grows, so each batch extends the last one's."""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, cells):
+        codes = []
+        for cell in cells:
+            code = self.codes.get(cell)
+            if code is None:
+                code = self.codes[cell] = len(self.values)
+                self.values.append(cell)
+            codes.append(code)
+        return pa.DictionaryArray.from_arrays(pa.array(codes, pa.int32()), pa.array(self.values, pa.string()))
+
+
+class TableWriter:
+    """Writes batches of text-cell rows to a file in one format.
+
+    types maps column names to the types to restore, as TableReader.types
+    gives them; other columns are written as text. Cells read by a
+    TableReader are written back as the values they were read from.
+    Micromarket, Area and Zone are dictionary encoded in Parquet and Arrow.
+    """
+
+    def __init__(self, path, header, fmt=None, types=None):
+        self.path = path
+        self.header = list(header)
+        self.format = fmt or format_for(path)
+        check_format(self.format)
+        types = types or {}
+        self.types = [types.get(name, 'string') for name in self.header]
+        self._writer = None
+        if self.format == 'csv':
+            self._file = open(path, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.header)
+        elif self.format == 'ndjson':
+            self._file = open(path, 'w', encoding='utf-8')
+        else:
+            self._file = None
+            self._categories = {i: _Categories() for i, name in enumerate(self.header) if name in CATEGORICAL_COLUMNS}
+            self._arrow_types = [pa.string() if i in self._categories or t in ('string', 'json') else
+                                 (pa.type_for_alias(t) if isinstance(t, str) else t) for i, t in enumerate(self.types)]
+            schema = pa.schema([pa.field(name, pa.dictionary(pa.int32(), pa.string()) if i in self._categories
+                                         else self._arrow_types[i]) for i, name in enumerate(self.header)])
+            self.schema = schema
+            if self.format == 'parquet':
+                self._writer = pq.ParquetWriter(path, schema)
+            else:
+                self._writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, rows):
+        """Write a batch of rows; cells beyond the header are dropped."""
+        if self.format == 'csv':
+            self._writer.writerows(rows)
+        elif self.format == 'ndjson':
+            names = self.header
+            converters = [_json_value(t) for t in self.types]
+            lines = []
+            for row in rows:
+                record = {}
+                for name, convert, cell in zip(names, converters, row):
+                    value = cell.value if isinstance(cell, Cell) else convert(cell)
+                    if value is not ABSENT:
+                        record[name] = value
+                lines.append(json.dumps(record, ensure_ascii=False, default=_text) + '\n')
+            self._file.write(''.join(lines))
+        elif rows:
+            width = len(self.header)
+            columns = [[row[i] if i < len(row) else '' for row in rows] for i in range(width)]
+            arrays = []
+            for i, cells in enumerate(columns):
+                if i in self._categories:
+                    arrays.append(self._categories[i].encode(cells))
+                    continue
+                arrow_type = self._arrow_types[i]
+                if arrow_type == pa.string():
+                    arrays.append(pa.array([None if isinstance(cell, Cell) and cell.value in (None, ABSENT) else
+                                            cell if cell != '' or self.types[i] == 'string' else None
+                                            for cell in cells], pa.string()))
+                elif all(isinstance(cell, Cell) or cell == '' for cell in cells):
+                    # Values read from a typed input go back as they were
+                    arrays.append(pa.array([cell.value if isinstance(cell, Cell) and cell.value is not ABSENT
+                                            else None for cell in cells], arrow_type))
+                else:
+                    arrays.append(pa.array([None if cell == '' else cell for cell in cells], pa.string())
+                                  .cast(arrow_type))
+            self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.format in COLUMNAR_FORMATS:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _json_value(type_name):
+    """Return a function turning a text cell back into a JSON value of the input type."""
+    name = type_name if isinstance(type_name, str) else str(type_name)
+    if name == 'bool':
+        parse = lambda cell: cell == 'true'  # noqa: E731
+    elif name.startswith(('int', 'uint')):
+        parse = int
+    elif name in ('float64', 'double', 'float', 'float32', 'halffloat'):
+        parse = float
+    else:
+        return lambda cell: cell
+
+    def convert(cell):
+        if cell == '':
+            return None
+        try:
+            return parse(cell)
+        except ValueError:
+            return cell
+    return convert
@@ -0,0 +1,128 @@
+"""The ASGI service answers like the Flask app, and sheds batches beyond its pool."""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import asgi
+import micromarket_lookup
+from app import app as flask_app
+from asgi import LookupService
+from lookup_cache import LookupCache, SQLiteCacheBackend
+
+
+def call(service, method, path, body=b'', content_type='application/json'):
+    """Run one request through the ASGI app; returns (status, headers, body)."""
+    messages = [{'type': 'http.request', 'body': body[:10], 'more_body': True},
+                {'type': 'http.request', 'body': body[10:], 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': [(b'content-type', content_type.encode())]}
+    asyncio.run(service(scope, receive, send))
+    start, body = sent
+    return start['status'], dict(start['headers']), body['body']
+
+
+def test_find_micromarket_matches_flask():
+    service = LookupService(threads=2)
+    form = {'latitude': '12.97', 'longitude': '77.59'}
+    status, headers, body = call(service, 'POST', '/find_micromarket', urlencode(form).encode(),
+                                 'application/x-www-form-urlencoded')
+    expected = flask_app.test_client().post('/find_micromarket', data=form)
+    assert status == 200
+    assert json.loads(body) == expected.json
+    assert headers[b'x-boundary-version'].decode() == expected.headers['X-Boundary-Version']
+
+    status, _, body = call(service, 'POST', '/find_micromarket', json.dumps({'latitude': 'x'}).encode())
+    assert status == 400 and 'Invalid coordinates' in json.loads(body)['error']
+
+
+def test_batch_matches_flask():
+    service = LookupService(threads=2)
+    points = [{'id': 1, 'latitude': 12.97, 'longitude': 77.59}, {'id': 2, 'latitude': 'x'}, 'bad',
+              {'id': 3, 'latitude': 13.2, 'longitude': 77.1}]
+    status, _, body = call(service, 'POST', '/find_micromarket/batch', json.dumps({'points': points}).encode())
+    assert status == 200
+    assert json.loads(body) == flask_app.test_client().post('/find_micromarket/batch', json=points).json
+
+    ndjson = ''.join(json.dumps(point) + '\n' for point in points).encode()
+    status, headers, body = call(service, 'POST', '/find_micromarket/batch', ndjson, 'application/x-ndjson')
+    assert headers[b'content-type'] == b'application/x-ndjson'
+    assert [json.loads(line)['id'] for line in body.splitlines()] == [1, 2, None, 3]
+
+
+def test_errors():
+    service = LookupService(threads=1, max_pending=0, max_body=100)
+    assert call(service, 'GET', '/find_micromarket')[0] == 405
+    assert call(service, 'GET', '/nowhere')[0] == 404
+    assert call(service, 'POST', '/find_micromarket/batch', b'[]' + b' ' * 200)[0] == 413
+    status, headers, _ = call(service, 'POST', '/find_micromarket/batch', b'[]')
+    assert status == 503 and headers[b'retry-after'] == b'1'
+
+
+def test_import_has_no_app_side_effects(tmp_path):
+    # The service must not start app.py's job runner or watcher, or create its folders
+    code = ("import sys, threading, asgi; "
+            "assert 'app' not in sys.modules, 'app imported'; "
+            "assert threading.active_count() == 1, threading.enumerate()")
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': ROOT, 'MICROMARKET_METRICS_DIR': str(tmp_path / 'metrics')})
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(tmp_path) == []
+
+
+def test_startup_warms_the_index():
+    service = LookupService(threads=1)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    boundaries = micromarket_lookup.boundaries
+    index = boundaries.index
+    index._boundary_tree = None
+    try:
+        asyncio.run(service({'type': 'lifespan'}, receive, send))
+        assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        assert index._boundary_tree is not None
+        # Reloaded indexes are warmed before they are swapped in
+        assert boundaries.warm
+    finally:
+        boundaries.warm = False
+
+
+def test_shared_cache_misses_run_off_the_loop(tmp_path, monkeypatch):
+    cache = LookupCache(backend=SQLiteCacheBackend(str(tmp_path / 'cache.db')))
+    cache.bind('v1')
+    threads = []
+
+    def get_micromarket_info(lat, lon):
+        threads.append(threading.current_thread().name)
+        return cache.lookup(lat, lon, micromarket_lookup.lookup_micromarket_info)
+
+    monkeypatch.setattr(asgi, 'lookup_cache', cache)
+    monkeypatch.setattr(asgi, 'get_micromarket_info', get_micromarket_info)
+    service = LookupService(threads=1)
+    body = json.dumps({'latitude': 12.97, 'longitude': 77.59}).encode()
+    first = call(service, 'POST', '/find_micromarket', body)
+    assert threads and threads[0].startswith('asgi-batch')
+    # In-memory hits are answered on the loop without the pool
+    assert call(service, 'POST', '/find_micromarket', body)[2] == first[2]
+    assert len(threads) == 1
+    assert cache.stats()['hits'] == 1
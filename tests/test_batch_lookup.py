@@ -0,0 +1,59 @@
+"""The batch route answers each point as the single-point route does, and reports bad points per row."""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app
+
+POINTS = [(12.97, 77.59), (13.0070447, 77.6900495), (12.9352, 77.6245), (13.2, 77.1), (0.0, 0.0)]
+
+
+def strict_json(body):
+    """Parse a response body, rejecting the NaN and Infinity tokens that are not JSON."""
+    def reject(token):
+        raise ValueError(f"non-standard JSON token {token}")
+    return json.loads(body, parse_constant=reject)
+
+
+def test_batch_matches_single_lookups():
+    client = app.test_client()
+    points = [{'id': i, 'latitude': lat, 'longitude': lon} for i, (lat, lon) in enumerate(POINTS)]
+    response = client.post('/find_micromarket/batch', json={'points': points})
+    assert response.status_code == 200
+    results = strict_json(response.data)['results']
+    assert [result['id'] for result in results] == list(range(len(POINTS)))
+    for result, (lat, lon) in zip(results, POINTS):
+        single = strict_json(client.post('/find_micromarket', data={'latitude': lat, 'longitude': lon}).data)
+        for key in ('latitude', 'longitude', 'micromarket_name', 'zone_name', 'match'):
+            assert result[key] == single[key]
+        if single['distance_m'] is None:
+            assert result['distance_m'] is None
+        else:
+            assert abs(result['distance_m'] - single['distance_m']) < 1e-6
+
+
+def test_invalid_and_non_finite_points_are_reported_per_row():
+    client = app.test_client()
+    points = [
+        {'id': 'ok', 'latitude': 12.97, 'longitude': 77.59},
+        {'id': 'text', 'latitude': 'north', 'longitude': 77.59},
+        {'id': 'missing', 'latitude': 12.97},
+        {'id': 'inf', 'latitude': float('inf'), 'longitude': float('nan')},
+        {'id': 'nan', 'latitude': 'NaN', 'longitude': 77.59},
+        'not a point',
+    ]
+    response = client.post('/find_micromarket/batch', data=json.dumps(points), content_type='application/json')
+    assert response.status_code == 200
+    results = strict_json(response.data)['results']
+    assert len(results) == len(points)
+    assert 'error' not in results[0] and results[0]['match'] == 'polygon'
+    for result in results[1:]:
+        assert result['error'].startswith('Invalid coordinates')
+        assert 'micromarket_name' not in result
+    assert [result['id'] for result in results] == ['ok', 'text', 'missing', 'inf', 'nan', None]
+
+    single = client.post('/find_micromarket', data={'latitude': 'inf', 'longitude': '77.59'})
+    assert single.status_code == 400
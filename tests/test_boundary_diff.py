@@ -0,0 +1,110 @@
+"""Only rows near edited micromarkets are reclassified, and the moves are reported."""
+import csv
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import enrichment
+from boundary_diff import NAME_PROPERTIES, changed_regions, describe_key, reclassify_csv
+from micromarket_store import load_index
+
+# Away from the known area boxes; squares are 0.01 degrees (about 1.1 km) and 5 km apart
+LAT = 12.30
+
+
+def square(name, micromarket, lon, width=0.01):
+    ring = [[lon, LAT], [lon + width, LAT], [lon + width, LAT + 0.01], [lon, LAT + 0.01], [lon, LAT]]
+    return {"type": "Feature", "properties": {"Name": name, "Micromarket": micromarket, "Zone": "South"},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+def write_boundaries(path, features):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    return str(path)
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+
+@pytest.fixture
+def edited(tmp_path, monkeypatch):
+    # Keep this module's boundaries out of the process-wide enrichment index
+    monkeypatch.setattr(enrichment, '_index', None)
+    monkeypatch.setattr(enrichment, '_index_path', None)
+    old_path = write_boundaries(tmp_path / 'old.geojson', [
+        square('Alpha', 'A', 77.30),
+        square('Bravo', 'B', 77.35),
+        square('Charlie', 'C', 77.40),
+        square('Delta', 'D', 77.45),
+    ])
+    new_path = write_boundaries(tmp_path / 'new.geojson', [
+        square('Alpha', 'A', 77.30),
+        # Bravo removed, Charlie cut to its western quarter, Delta renamed
+        square('Charlie', 'C', 77.40, width=0.0025),
+        square('Delta', 'D2', 77.45),
+    ])
+    points = [('alpha', 77.305), ('bravo', 77.355), ('charlie-east', 77.409), ('charlie-west', 77.401),
+              ('delta', 77.455)]
+    inventory = tmp_path / 'inventory.csv'
+    with open(inventory, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['propertyId', 'Latitude', 'Longitude'])
+        writer.writerows([name, f"{LAT + 0.005}", f"{lon}"] for name, lon in points)
+    enriched = str(tmp_path / 'enriched.csv')
+    enrichment.enrich_file(str(inventory), enriched, geojson_path=old_path)
+    return old_path, new_path, enriched
+
+
+def test_regions_of_each_change(edited):
+    old_path, new_path, _ = edited
+    old_index = load_index(old_path, NAME_PROPERTIES)
+    new_index = enrichment.load_boundaries(new_path)
+    changes = changed_regions(old_index, new_index, max_distance=enrichment.NEAREST_MAX_DISTANCE)
+    assert sorted((describe_key(key), change) for key, change, _ in changes) == [
+        ('Bravo / B', 'removed'), ('Charlie / C', 'reshaped'), ('Delta / D', 'removed'), ('Delta / D2', 'added')]
+
+
+def test_only_affected_rows_change(edited, tmp_path):
+    old_path, new_path, enriched = edited
+    before = read_rows(enriched)
+    header = before[0]
+    micromarket, area, tag = (header.index(name) for name in ['Micromarket', 'Area', enrichment.TAG_COLUMN])
+    assert [row[micromarket] for row in before[1:]] == [
+        'Alpha; A', 'Bravo; B', 'Charlie; C', 'Charlie; C', 'Delta; D']
+    # A label no classification would give: kept only if the row is left alone
+    before[1][micromarket] = 'Alpha; kept'
+    with open(enriched, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(before)
+
+    old_index = load_index(old_path, NAME_PROPERTIES)
+    new_index = enrichment.load_boundaries(new_path)
+    regions = [region for _, _, region in
+               changed_regions(old_index, new_index, max_distance=enrichment.NEAREST_MAX_DISTANCE)]
+    output, report = str(tmp_path / 'reclassified.csv'), str(tmp_path / 'moved.csv')
+    assert reclassify_csv(enriched, output, old_index, regions, report) == (5, 4, 3)
+
+    after = read_rows(output)
+    assert after[0] == header
+    assert [(row[micromarket], row[area]) for row in after[1:]] == [
+        ('Alpha; kept', 'South Bangalore'),
+        ('Not Found', 'Not Found'),
+        ('Not Found', 'Not Found'),
+        ('Charlie; C', 'South Bangalore'),
+        ('Delta; D2', 'South Bangalore'),
+    ]
+    new_tag = enrichment.boundary_tag(new_index) + ':'
+    assert all(row[tag].startswith(new_tag) for row in after[1:])
+    assert [row[:3] for row in after] == [row[:3] for row in before]
+
+    moved = read_rows(report)
+    assert [(row[1], row[4], row[5]) for row in moved[1:]] == [
+        ('bravo', 'Bravo; B', 'Not Found'), ('charlie-east', 'Charlie; C', 'Not Found'),
+        ('delta', 'Delta; D', 'Delta; D2')]
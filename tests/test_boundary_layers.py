@@ -0,0 +1,49 @@
+"""One query over several layers gives each layer's own answer."""
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from boundary_layers import BoundaryLayers, Layer, default_layers
+
+
+@pytest.fixture(scope='module')
+def layers(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('Data')
+    for name in ('new.geojson', 'coordinate2.json'):
+        shutil.copy(os.path.join(ROOT, 'Data', name), data_dir / name)
+    return BoundaryLayers(default_layers(str(data_dir)) + [Layer('missing', str(data_dir / 'missing.geojson'))])
+
+
+def test_layers_are_loaded_lazily_and_compiled(layers):
+    assert not any(layer['loaded'] for layer in layers.info())
+    layers.lookup(12.97, 77.59, ['zone'])
+    loaded = {layer['name']: layer['loaded'] for layer in layers.info()}
+    assert loaded == {'micromarket': False, 'zone': True, 'coordinate2': False, 'missing': False}
+    assert os.path.exists(layers.layers['zone'].store_path)
+
+
+def test_layered_query_matches_each_layer(layers):
+    rng = np.random.default_rng(18)
+    lats = rng.uniform(12.7, 13.3, 50000)
+    lons = rng.uniform(77.3, 77.9, 50000)
+    layered = layers.layered()
+    assert layered.names == ['micromarket', 'zone', 'coordinate2']
+    located = layered.locate_many(lats, lons)
+    for name in layered.names:
+        np.testing.assert_array_equal(located[name], layers.index(name).locate_many(lats, lons))
+
+
+def test_lookup(layers):
+    found = layers.lookup(12.97, 77.59)
+    assert found['micromarket']['Micromarket'] == 'Chickpet'
+    assert found['zone'] == {'Zone': found['micromarket']['Zone']}
+    assert found['missing'] is None
+    assert [layer['error'] is not None for layer in layers.info()] == [False, False, False, True]
+    with pytest.raises(KeyError):
+        layers.lookup(12.97, 77.59, ['nope'])
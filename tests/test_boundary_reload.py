@@ -0,0 +1,82 @@
+"""Edited boundaries are swapped in without a restart, and a broken file keeps the old ones."""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app
+from boundary_reload import ReloadableIndex
+
+
+def square(name, zone, lon, lat, size=0.01):
+    ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+    return {"type": "Feature", "properties": {"Micromarket": name, "Zone": zone},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+def write_boundaries(path, features, mtime):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def boundaries(tmp_path):
+    path = str(tmp_path / 'boundaries.geojson')
+    write_boundaries(path, [square('Alpha', 'East', 77.60, 12.90)], 1_000_000_000_000_000_000)
+    # The app's own swap hook, restored to the app's boundaries afterwards
+    reloadable = ReloadableIndex(path, on_swap=app.on_boundaries_swap)
+    yield path, reloadable
+    app.on_boundaries_swap(app.boundaries.index)
+
+
+def test_changed_file_swaps_in_a_new_index(boundaries):
+    path, reloadable = boundaries
+    old = reloadable.index
+    assert old.lookup(12.905, 77.605)['Micromarket'] == 'Alpha'
+    assert not reloadable.reload(force=False)
+
+    write_boundaries(path, [square('Alpha', 'East', 77.60, 12.90), square('Beta', 'West', 77.50, 12.90)],
+                     1_000_000_000_000_000_001)
+    assert reloadable.reload(force=False)
+    new = reloadable.index
+    assert new is not old and new.version != old.version
+    assert new.lookup(12.905, 77.505)['Micromarket'] == 'Beta'
+    # Requests holding the old index keep their answers
+    assert old.lookup(12.905, 77.505) is None
+
+
+def test_swap_rebinds_the_cache_and_tiles(boundaries):
+    path, reloadable = boundaries
+    version = reloadable.index.version
+    assert app.lookup_cache.version.startswith(f"{version}:")
+    assert app.boundary_tiles.version == version[:16]
+
+    write_boundaries(path, [square('Gamma', 'North', 77.60, 12.90)], 1_000_000_000_000_000_002)
+    reloadable.watch(0.02)
+    deadline = time.time() + 5
+    while reloadable.index.version == version and time.time() < deadline:
+        time.sleep(0.02)
+    new_version = reloadable.index.version
+    assert new_version != version
+    assert app.lookup_cache.version.startswith(f"{new_version}:")
+    assert app.boundary_tiles.version == new_version[:16]
+    assert app.lookup_cache.stats()['size'] == 0
+
+
+def test_invalid_geojson_keeps_the_old_index(boundaries):
+    path, reloadable = boundaries
+    index = reloadable.index
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+    os.utime(path, ns=(1_000_000_000_000_000_003,) * 2)
+
+    assert not reloadable.reload(force=False)
+    assert reloadable.index is index
+    assert reloadable.info()['last_error'].startswith('Invalid JSON')
+    assert app.boundary_tiles.version == index.version[:16]
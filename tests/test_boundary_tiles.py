@@ -0,0 +1,59 @@
+"""Boundary tiles are small, cover the micromarkets and change only with the boundaries."""
+import json
+import math
+import os
+import sys
+
+import pytest
+import shapely
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from boundary_tiles import BoundaryTiles, tile_bounds
+from micromarket_store import load_index
+
+
+def tile_at(lat, lon, z):
+    n = 2 ** z
+    return int((lon + 180) / 360 * n), int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+
+
+@pytest.fixture(scope='module')
+def index():
+    return load_index(os.path.join(ROOT, 'Data', 'new.geojson'))
+
+
+def test_tile_bounds():
+    assert tile_bounds(0, 0, 0) == pytest.approx((-180, -85.0511, 180, 85.0511), abs=1e-4)
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(12, *tile_at(12.97, 77.59, 12))
+    assert min_lon <= 77.59 <= max_lon and min_lat <= 12.97 <= max_lat
+
+
+def test_tiles_hold_the_micromarkets_they_cover(index):
+    tiles = BoundaryTiles()
+    tiles.bind(index)
+    z = 13
+    x, y = tile_at(12.97, 77.59, z)
+    tile = tiles.tile(z, x, y)
+    features = json.loads(tile.body)['features']
+    expected = set(index.part_features[index.tree.query(shapely.box(*tile_bounds(z, x, y)),
+                                                        predicate='intersects')].tolist())
+    assert expected <= {feature['id'] for feature in features}
+    chickpet = index.locate(12.97, 77.59)
+    shape = shapely.geometry.shape(next(f['geometry'] for f in features if f['id'] == chickpet))
+    assert shape.contains(shapely.Point(77.59, 12.97))
+    assert len(tile.gzipped) < 16 * 1024
+
+
+def test_tiles_are_kept_until_the_boundaries_change(index):
+    tiles = BoundaryTiles()
+    tiles.bind(index)
+    version = tiles.version
+    tile = tiles.tile(12, *tile_at(12.97, 77.59, 12), version)
+    tiles.bind(index)
+    assert tiles.tile(12, *tile_at(12.97, 77.59, 12)) is tile
+    with pytest.raises(KeyError):
+        tiles.tile(12, *tile_at(12.97, 77.59, 12), 'other')
+    with pytest.raises(ValueError):
+        tiles.tile(2, 0, 0)
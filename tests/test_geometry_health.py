@@ -0,0 +1,61 @@
+"""Boundary repair keeps holes and reports invalid and overlapping features."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from geometry_health import check_features
+from micromarket_index import MicromarketIndex
+
+
+def square(x0, y0, size):
+    return [[x0, y0], [x0 + size, y0], [x0 + size, y0 + size], [x0, y0 + size], [x0, y0]]
+
+
+def feature(name, *rings, kind='Polygon'):
+    coordinates = list(rings) if kind == 'Polygon' else [[ring] for ring in rings]
+    return {'type': 'Feature', 'properties': {'Micromarket': name} if name else {},
+            'geometry': {'type': kind, 'coordinates': coordinates}}
+
+
+@pytest.fixture
+def features():
+    return [
+        feature('Ring', square(0, 0, 0.01), square(0.004, 0.004, 0.002)),
+        # Self-intersecting: two triangles meeting at (0.025, 0.005)
+        feature('Bowtie', [[0.02, 0], [0.03, 0.01], [0.03, 0], [0.02, 0.01], [0.02, 0]]),
+        feature('Spur', square(0.04, 0, 0.01), [[0.045, 0.005], [0.046, 0.005], [0.045, 0.005]]),
+        feature('Later', square(0.005, 0, 0.01)),
+        feature(None, square(0.1, 0.1, 0.01)),
+        feature('Flat', [[0.2, 0.2], [0.21, 0.2], [0.2, 0.2]]),
+    ]
+
+
+def test_holes_are_kept(features):
+    index = MicromarketIndex(features)
+    assert index.lookup(0.001, 0.001)['Micromarket'] == 'Ring'
+    # The hole of Ring, where its east half is covered by Later
+    assert index.lookup(0.005, 0.0045) is None
+    assert index.lookup(0.005, 0.0055)['Micromarket'] == 'Later'
+
+
+def test_repair_keeps_both_lobes_of_a_bowtie(features):
+    index = MicromarketIndex(features)
+    assert index.lookup(0.005, 0.0205)['Micromarket'] == 'Bowtie'
+    assert index.lookup(0.005, 0.0295)['Micromarket'] == 'Bowtie'
+
+
+def test_report(features):
+    feature_parts, rows = check_features(features)
+    assert len(feature_parts) == len(features)
+    issues = {(row[0], row[2]) for row in rows}
+    assert issues == {(2, 'repaired'), (3, 'dropped'), (1 + 3, 'overlap'), (5, 'unnamed'), (6, 'dropped'),
+                      (6, 'empty')}
+
+    overlap, = [row for row in rows if row[2] == 'overlap']
+    assert overlap[4] == 1 and overlap[5] == 'Ring'
+    # 0.005 x 0.01 degrees, less the part of the hole it covers
+    assert 500000 < float(overlap[6]) < 620000
@@ -0,0 +1,122 @@
+"""Background jobs run in child processes, report failures and are killed when they overrun.
+
+The handlers below run in those children, which import this module by name,
+so it must not import app at module level.
+"""
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from job_queue import JobRunner, JobStore
+
+
+def upper_handler(job, progress):
+    with open(job['input_path'], encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    progress(rows_done=len(lines), boundary_version=str(os.getpid()))
+    with open(job['output_path'], 'w', encoding='utf-8') as f:
+        f.write('\n'.join(line.upper() for line in lines))
+    return {"rows_done": len(lines), "matched": len(lines)}
+
+
+def failing_handler(job, progress):
+    progress(rows_done=1)
+    raise ValueError("no coordinates column")
+
+
+def sleeping_handler(job, progress):
+    time.sleep(60)
+
+
+def run_one(tmp_path, handler, **options):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    input_path = tmp_path / 'input.txt'
+    input_path.write_text('a\nb\nc', encoding='utf-8')
+    job_id = store.create('input.txt', str(input_path), str(tmp_path / 'output.txt'))
+    runner = JobRunner(store, handler, niceness=0, **options)
+    runner.run(store.claim(1))
+    return store, store.info(job_id)
+
+
+def test_job_runs_in_a_child_process(tmp_path):
+    store, info = run_one(tmp_path, upper_handler)
+    assert info['status'] == 'done'
+    assert (info['rows_done'], info['matched']) == (3, 3)
+    assert info['boundary_version'] != str(os.getpid())
+    assert (tmp_path / 'output.txt').read_text(encoding='utf-8') == 'A\nB\nC'
+
+
+def test_failing_job_is_marked_failed(tmp_path):
+    store, info = run_one(tmp_path, failing_handler)
+    assert info['status'] == 'failed'
+    assert info['error'] == 'no coordinates column'
+    assert info['rows_done'] == 1
+
+
+def test_job_past_its_timeout_is_killed(tmp_path):
+    started = time.time()
+    store, info = run_one(tmp_path, sleeping_handler, timeout=1)
+    assert time.time() - started < 30
+    assert info['status'] == 'failed'
+    assert 'timed out' in info['error']
+
+
+def test_handler_must_be_importable():
+    try:
+        JobRunner(JobStore(':memory:'), lambda job, progress: None)
+    except ValueError as e:
+        assert 'module-level' in str(e)
+    else:
+        raise AssertionError("a lambda handler was accepted")
+
+
+def wait_for(client, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = client.get(f'/jobs/{job_id}').json
+        if info['status'] in ('done', 'failed'):
+            return info
+        time.sleep(0.2)
+    raise AssertionError(f"job {job_id} still {info['status']}")
+
+
+def test_async_upload_submit_poll_result():
+    from app import app, job_store
+    client = app.test_client()
+    rows = ['Project Name,Latitude,Longitude'] + [f"P{i},{12.9 + i * 0.003:.4f},{77.55 + i * 0.002:.4f}"
+                                                   for i in range(200)]
+    upload = ('\n'.join(rows + ['Broken,north,77.6']) + '\n').encode()
+    queued = client.post('/upload_csv?async=1', data={'file': (io.BytesIO(upload), 'jobtest.csv')})
+    assert queued.status_code == 202
+    job_id = queued.json['job_id']
+    assert client.get(queued.json['result_url']).status_code in (200, 409)
+
+    info = wait_for(client, job_id)
+    assert info['status'] == 'done', info
+    result = client.get(f'/jobs/{job_id}/result')
+    assert result.status_code == 200
+    assert result.headers['Content-Disposition'] == 'attachment; filename=updated_jobtest.csv'
+    buffered = client.post('/upload_csv', data={'file': (io.BytesIO(upload), 'jobtest.csv')})
+    assert result.data == buffered.data
+    assert info['rows_done'] == result.data.count(b'\n') - 1
+
+    job = job_store.get(job_id)
+    for path in (job['input_path'], job['output_path'], os.path.join(ROOT, 'uploads', 'jobtest.csv'),
+                 os.path.join(ROOT, 'uploads', 'updated_jobtest.csv')):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def test_async_upload_that_fails():
+    from app import app
+    client = app.test_client()
+    queued = client.post('/upload_csv?async=1', data={'file': (io.BytesIO(b'{"id": 1}\n{broken\n'), 'bad.ndjson')})
+    assert queued.status_code == 202
+    info = wait_for(client, queued.json['job_id'])
+    assert info['status'] == 'failed'
+    assert info['error']
+    assert client.get(f"/jobs/{info['id']}/result").status_code == 409
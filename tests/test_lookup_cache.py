@@ -0,0 +1,83 @@
+"""Cached lookups are keyed on rounded coordinates and never outlive their boundary version."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lookup_cache import LookupCache, SQLiteCacheBackend
+
+
+class Boundaries:
+    """Stands in for the index: answers with the version it was computed for."""
+
+    def __init__(self, version):
+        self.version = version
+        self.calls = []
+
+    def compute(self, lat, lon):
+        self.calls.append((lat, lon))
+        return f"mm-{self.version}", "East", "polygon", 0.0
+
+
+def test_rounded_keys_and_lru():
+    boundaries = Boundaries('v1')
+    outcomes = []
+    cache = LookupCache(maxsize=2, precision=3, on_lookup=outcomes.append)
+    cache.bind('v1')
+    assert cache.lookup(12.97041, 77.59061, boundaries.compute) == ('mm-v1', 'East', 'polygon', 0.0)
+    cache.lookup(12.97039, 77.59139, boundaries.compute)
+    # The lookup runs on the rounded point, so both hit one entry
+    assert boundaries.calls == [(12.97, 77.591)]
+    cache.lookup(13.0, 77.6, boundaries.compute)
+    cache.lookup(13.1, 77.7, boundaries.compute)
+    cache.lookup(12.97, 77.591, boundaries.compute)
+    assert outcomes == ['miss', 'hit', 'miss', 'miss', 'miss']
+    assert cache.stats()['evictions'] == 2
+
+
+def test_reload_discards_results_of_the_old_version():
+    old, new = Boundaries('v1'), Boundaries('v2')
+    cache = LookupCache(precision=4)
+    cache.bind('v1')
+    cache.lookup(12.97, 77.59, old.compute)
+    cache.bind('v1')  # rebinding the same version keeps the entries
+    assert cache.lookup(12.97, 77.59, new.compute)[0] == 'mm-v1'
+    cache.bind('v2')
+    assert cache.lookup(12.97, 77.59, new.compute)[0] == 'mm-v2'
+    assert new.calls == [(12.97, 77.59)]
+
+
+def test_result_computed_across_a_reload_is_not_kept():
+    cache = LookupCache(precision=4)
+    cache.bind('v1')
+
+    def compute_while_reloading(lat, lon):
+        cache.bind('v2')
+        return 'mm-v1', 'East', 'polygon', 0.0
+
+    cache.lookup(12.97, 77.59, compute_while_reloading)
+    assert cache.stats()['size'] == 0
+
+
+def test_sqlite_backend_is_shared_and_pruned(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    boundaries = Boundaries('v1')
+    first_outcomes, second_outcomes = [], []
+    first = LookupCache(precision=4, backend=SQLiteCacheBackend(path), on_lookup=first_outcomes.append)
+    second = LookupCache(precision=4, backend=SQLiteCacheBackend(path), on_lookup=second_outcomes.append)
+    first.bind('v1')
+    second.bind('v1')
+
+    first.lookup(12.97, 77.59, boundaries.compute)
+    assert second.lookup(12.97, 77.59, boundaries.compute) == ('mm-v1', 'East', 'polygon', 0.0)
+    assert (first_outcomes, second_outcomes) == (['miss'], ['shared_hit'])
+    assert len(boundaries.calls) == 1
+
+    # A worker that moves to new boundaries drops the old rows from the shared file
+    reloaded = Boundaries('v2')
+    second.bind('v2')
+    assert second.backend.get('v1', (12.97, 77.59)) is None
+    assert second.lookup(12.97, 77.59, reloaded.compute)[0] == 'mm-v2'
+    assert second_outcomes == ['shared_hit', 'miss']
+    assert first.backend.get('v2', (12.97, 77.59))[0] == 'mm-v2'
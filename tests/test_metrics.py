@@ -0,0 +1,50 @@
+"""Metrics recorded in several processes add up, including after they exit."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import ARCHIVE_NAME, MetricsRegistry
+
+
+def declare(directory):
+    registry = MetricsRegistry(str(directory))
+    lookups = registry.counter('lookups_total', "Lookups.", ('result',), [('hit',), ('miss',)])
+    seconds = registry.histogram('stage_seconds', "Stage time.", ('stage',), [('grid',)], buckets=(0.01, 0.1))
+    return registry, lookups, seconds
+
+
+def test_processes_add_up(tmp_path):
+    registry, lookups, seconds = declare(tmp_path)
+    lookups.inc('hit')
+    seconds.observe(0.05, 'grid')
+
+    pid = os.fork()
+    if pid == 0:
+        lookups.inc('hit', amount=2)
+        lookups.inc('miss')
+        seconds.observe(0.5, 'grid')
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    text = registry.render()
+    assert 'lookups_total{result="hit"} 3\n' in text
+    assert 'lookups_total{result="miss"} 1\n' in text
+    assert 'stage_seconds_bucket{stage="grid",le="0.01"} 0\n' in text
+    assert 'stage_seconds_bucket{stage="grid",le="0.1"} 1\n' in text
+    assert 'stage_seconds_bucket{stage="grid",le="+Inf"} 2\n' in text
+    assert 'stage_seconds_sum{stage="grid"} 0.55\n' in text
+    assert 'stage_seconds_count{stage="grid"} 2\n' in text
+    # The exited child's file was folded into the archive
+    assert not os.path.exists(tmp_path / f"{pid}.metrics")
+    assert os.path.exists(tmp_path / ARCHIVE_NAME)
+    assert registry.render() == text
+
+
+def test_files_of_another_layout_are_ignored(tmp_path):
+    registry, lookups, _ = declare(tmp_path)
+    lookups.inc('hit')
+    other = MetricsRegistry(str(tmp_path))
+    other.counter('lookups_total', "Lookups.", ('result',), [('hit',)])
+    assert 'lookups_total{result="hit"} 1\n' in registry.render()
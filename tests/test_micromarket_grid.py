@@ -0,0 +1,104 @@
+"""Lookups answered from the grid table must match the exact polygon test."""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import shapely
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from micromarket_grid import (BOUNDARY, OUTSIDE, MicromarketGrid, build_grid, file_digest, grid_path_for,
+                              load_grid, save_grid)
+from micromarket_index import MicromarketIndex
+from micromarket_store import load_index
+
+GEOJSON_PATH = os.path.join(ROOT, 'Data', 'new.geojson')
+# Coarser than the default so the table builds in well under a second
+RESOLUTION = 0.004
+
+
+@pytest.fixture(scope='module')
+def index():
+    with open(GEOJSON_PATH, encoding='utf-8') as f:
+        return MicromarketIndex(json.load(f)['features'])
+
+
+@pytest.fixture(scope='module')
+def grid(index):
+    cells, x0, y0 = build_grid(index, RESOLUTION)
+    return MicromarketGrid(cells, x0, y0, RESOLUTION, len(index), file_digest(GEOJSON_PATH))
+
+
+def sample_points(index, grid, n, seed):
+    """Random points over the extent, points around every boundary and on the cell edges."""
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(index.parts)
+    lons = [rng.uniform(min_lon - RESOLUTION, max_lon + RESOLUTION, n)]
+    lats = [rng.uniform(min_lat - RESOLUTION, max_lat + RESOLUTION, n)]
+
+    rings = shapely.get_rings(index.parts)
+    on_ring = shapely.line_interpolate_point(rings[rng.integers(0, len(rings), n)], rng.random(n), normalized=True)
+    coords = shapely.get_coordinates(on_ring)
+    for scale in (0.0, 1e-6, RESOLUTION / 10, RESOLUTION):
+        jitter = rng.uniform(-scale, scale, coords.shape)
+        lons.append(coords[:, 0] + jitter[:, 0])
+        lats.append(coords[:, 1] + jitter[:, 1])
+
+    # Corners and edges of the cells, where a point rounds into either neighbour
+    ny, nx = grid.cells.shape
+    cols, rows = rng.integers(0, nx + 1, n), rng.integers(0, ny + 1, n)
+    lons.append(grid.x0 + cols * RESOLUTION)
+    lats.append(grid.y0 + rows * RESOLUTION)
+    lons.append(grid.x0 + (cols + rng.random(n)) * RESOLUTION)
+    lats.append(grid.y0 + rows * RESOLUTION)
+    return np.concatenate(lats), np.concatenate(lons)
+
+
+def test_cells_cover_owned_decided_and_boundary_values(grid, index):
+    cells = np.asarray(grid.cells)
+    owned = cells[(cells != OUTSIDE) & (cells != BOUNDARY)]
+    assert len(owned) and (cells == OUTSIDE).any() and (cells == BOUNDARY).any()
+    assert owned.max() <= len(index)
+
+
+def test_grid_matches_exact_lookups(index, grid):
+    lats, lons = sample_points(index, grid, 20000, seed=4)
+    expected = index.locate_many(lats, lons)
+
+    positions, undecided = grid.locate_many(lats, lons)
+    # The grid answers most random points itself, and every answer it gives is exact
+    assert np.count_nonzero(~undecided[:20000]) > 10000
+    np.testing.assert_array_equal(positions[~undecided], expected[~undecided])
+
+    index.attach_grid(grid)
+    try:
+        np.testing.assert_array_equal(index.locate_many(lats, lons), expected)
+        sample = np.random.default_rng(0).choice(len(lats), 2000, replace=False)
+        assert [index.locate(lats[i], lons[i]) for i in sample] == expected[sample].tolist()
+    finally:
+        index.grid = None
+
+
+def test_saved_grid_is_attached_by_load_index(tmp_path, index, grid):
+    geojson_path = str(tmp_path / 'new.geojson')
+    shutil.copy(GEOJSON_PATH, geojson_path)
+    save_grid(grid_path_for(geojson_path), np.asarray(grid.cells), grid.x0, grid.y0, RESOLUTION, len(index),
+              file_digest(geojson_path))
+    loaded = load_grid(grid_path_for(geojson_path))
+    np.testing.assert_array_equal(loaded.cells, grid.cells)
+    assert load_index(geojson_path).grid is not None
+
+    # A grid built from other boundaries is ignored
+    with open(geojson_path, 'a', encoding='utf-8') as f:
+        f.write('\n')
+    assert load_index(geojson_path).grid is None
+
+
+def test_attach_grid_checks_the_feature_count(index, grid):
+    other = MicromarketGrid(grid.cells, grid.x0, grid.y0, RESOLUTION, len(index) + 1, grid.digest)
+    with pytest.raises(ValueError):
+        index.attach_grid(other)
@@ -0,0 +1,60 @@
+"""Points outside every polygon take the nearest micromarket within the distance limit."""
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import micromarket_lookup
+from micromarket_index import MicromarketIndex
+
+# Away from the known area boxes, so a miss is a plain miss
+LAT, LON = 12.50, 77.40
+METERS_PER_DEGREE_LON = 111320 * math.cos(math.radians(LAT + 0.005))
+
+
+@pytest.fixture
+def square(monkeypatch):
+    ring = [[LON, LAT], [LON + 0.01, LAT], [LON + 0.01, LAT + 0.01], [LON, LAT + 0.01], [LON, LAT]]
+    index = MicromarketIndex([{"type": "Feature", "properties": {"Micromarket": "Square", "Zone": "South"},
+                               "geometry": {"type": "Polygon", "coordinates": [ring]}}])
+    monkeypatch.setattr(micromarket_lookup.boundaries, 'index', index)
+    monkeypatch.setattr(micromarket_lookup, 'NEAREST_MAX_DISTANCE', 500)
+    return index
+
+
+def east_of_square(meters):
+    return LAT + 0.005, LON + 0.01 + meters / METERS_PER_DEGREE_LON
+
+
+def test_inside_the_polygon(square):
+    assert micromarket_lookup.lookup_micromarket_info(LAT + 0.005, LON + 0.005) == ("Square", "South", "polygon", 0.0)
+
+
+def test_just_outside_takes_the_nearest(square):
+    micromarket_name, zone_name, match, distance = micromarket_lookup.lookup_micromarket_info(*east_of_square(100))
+    assert (micromarket_name, zone_name, match) == ("Square", "South", "nearest")
+    assert distance == pytest.approx(100, abs=2)
+
+
+def test_beyond_the_limit_is_unknown(square):
+    assert micromarket_lookup.lookup_micromarket_info(*east_of_square(600)) == ("Unknown", "", "none", None)
+
+
+def test_zero_limit_disables_the_fallback(square, monkeypatch):
+    monkeypatch.setattr(micromarket_lookup, 'NEAREST_MAX_DISTANCE', 0)
+    assert micromarket_lookup.lookup_micromarket_info(*east_of_square(100))[2] == "none"
+
+
+def test_batch_agrees(square):
+    points = [(LAT + 0.005, LON + 0.005), east_of_square(100), east_of_square(600)]
+    lats, lons = np.array(points).T
+    micromarket_names, zone_names, matches, distances = micromarket_lookup.get_micromarket_info_batch(lats, lons)
+    singles = [micromarket_lookup.lookup_micromarket_info(lat, lon) for lat, lon in points]
+    assert list(matches) == ["polygon", "nearest", "none"]
+    assert list(micromarket_names) == [single[0] for single in singles]
+    assert distances[1] == pytest.approx(singles[1][3])
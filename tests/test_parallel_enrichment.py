@@ -0,0 +1,31 @@
+"""Enriching with a pool of workers writes exactly what a single process writes."""
+import csv
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from enrichment import enrich_csv
+
+GEOJSON = os.path.join(ROOT, 'Data', 'new.geojson')
+
+
+def test_parallel_output_is_byte_identical(tmp_path):
+    source = str(tmp_path / 'data.csv')
+    shutil.copy(os.path.join(ROOT, 'data.csv'), source)
+    serial, parallel = str(tmp_path / 'serial.csv'), str(tmp_path / 'parallel.csv')
+
+    enrich_csv(source, serial, workers=1, geojson_path=GEOJSON, incremental=False)
+    summary = enrich_csv(source, parallel, workers=3, chunk_rows=97, geojson_path=GEOJSON, incremental=False)
+
+    with open(serial, 'rb') as f:
+        expected = f.read()
+    with open(parallel, 'rb') as f:
+        assert f.read() == expected
+    with open(source, encoding='utf-8', newline='') as f:
+        ids = [row[0] for row in csv.reader(f)]
+    with open(parallel, encoding='utf-8', newline='') as f:
+        assert [row[0] for row in csv.reader(f)] == ids
+    assert summary.rows == len(ids) - 1
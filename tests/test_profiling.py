@@ -0,0 +1,47 @@
+"""Profiles record collapsed stacks of the profiled thread and keep only the newest."""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from profiling import RequestProfiler
+
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_profile_records_the_request_stack(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), max_profiles=2)
+    for _ in range(3):
+        profile = profiler.start('upload_csv', '/upload_csv')
+        busy(0.1)
+        path = profile.stop(200)
+        assert profile.stop(200) is None
+
+    lines = open(path, encoding='utf-8').read().splitlines()
+    stacks = {line.rsplit(' ', 1)[0]: int(line.rsplit(' ', 1)[1]) for line in lines}
+    assert sum(stacks.values()) > 5
+    in_busy = sum(count for stack, count in stacks.items() if stack.endswith('test_profiling:busy'))
+    assert in_busy >= 0.8 * sum(stacks.values())
+    profiles = profiler.list()
+    assert len(profiles) == 2
+    assert profiles[0]['name'] == os.path.basename(path)[:-len('.collapsed')]
+    assert profiles[0]['status'] == 200 and profiles[0]['samples'] == sum(stacks.values())
+
+
+def test_toggle_is_shared_through_the_directory(tmp_path):
+    profiler = RequestProfiler(str(tmp_path))
+    other = RequestProfiler(str(tmp_path))
+    assert not other.enabled_until()
+    profiler.enable(60)
+    # Workers reread the toggle at most once a second
+    other._toggle = (0.0, 0.0)
+    assert other.enabled_until() > time.time()
+    profiler.enable(0)
+    other._toggle = (0.0, 0.0)
+    assert not other.enabled_until()
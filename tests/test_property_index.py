@@ -0,0 +1,67 @@
+"""Reverse queries list exactly the properties a forward lookup places in an area."""
+import os
+import sys
+
+import numpy as np
+import pytest
+import shapely
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from micromarket_store import load_index
+from property_index import PropertyIndex
+
+
+@pytest.fixture(scope='module')
+def inventory():
+    rng = np.random.default_rng(20)
+    lats = np.append(rng.uniform(12.7, 13.3, 20000), [-33.9, 51.5])
+    lons = np.append(rng.uniform(77.3, 77.9, 20000), [151.2, -0.1])
+    return PropertyIndex(['id'], [[str(i)] for i in range(len(lats))], lats, lons)
+
+
+def in_file_order(inventory, mask):
+    return [row[0] for row in np.array(inventory.rows)[mask][np.argsort(inventory.file_order[mask])]]
+
+
+def test_bbox_matches_a_scan(inventory):
+    for bbox in [(77.5, 12.9, 77.6, 13.0), (77.0, 12.0, 78.0, 14.0), (150, -34, 152, -33), (0, 0, 1, 1)]:
+        found = inventory.in_bbox(*bbox)
+        expected = np.flatnonzero((inventory.lons >= bbox[0]) & (inventory.lons <= bbox[2])
+                                  & (inventory.lats >= bbox[1]) & (inventory.lats <= bbox[3]))
+        np.testing.assert_array_equal(np.sort(found), expected)
+
+
+def test_within_polygon(inventory):
+    triangle = shapely.Polygon([(77.55, 12.9), (77.65, 12.9), (77.6, 13.0)])
+    found = inventory.within([triangle])
+    mask = shapely.contains_xy(triangle, inventory.lons, inventory.lats)
+    assert [inventory.rows[i][0] for i in found] == in_file_order(inventory, mask)
+
+
+def test_in_features_agrees_with_lookup(inventory):
+    index = load_index(os.path.join(ROOT, 'Data', 'new.geojson'))
+    located = index.locate_many(inventory.lats, inventory.lons)
+    for name, value in [('Micromarket', 'Whitefield'), ('Zone', 'East')]:
+        positions = index.feature_positions(name, value)
+        found = inventory.in_features(index, positions)
+        assert len(found)
+        assert [inventory.rows[i][0] for i in found] == in_file_order(inventory, np.isin(located, positions))
+
+
+def test_in_features_applies_the_nearest_fallback(inventory):
+    index = load_index(os.path.join(ROOT, 'Data', 'new.geojson'))
+    located = index.locate_many(inventory.lats, inventory.lons)
+    outside = np.flatnonzero(located < 0)
+    nearest = located.copy()
+    nearest[outside] = index.nearest_many(inventory.lats[outside], inventory.lons[outside], 500)[0]
+    # A micromarket that a point outside every polygon falls back to
+    near = outside[nearest[outside] >= 0][0]
+    positions = index.feature_positions('Micromarket', index.properties[nearest[near]]['Micromarket'])
+
+    within = inventory.in_features(index, positions, max_distance=500)
+    assert [inventory.rows[i][0] for i in within] == in_file_order(inventory, np.isin(nearest, positions))
+    exact = inventory.in_features(index, positions)
+    assert near not in exact and near in within
+    assert set(exact) < set(within)
@@ -0,0 +1,89 @@
+"""Tiered containment must give exactly the answers of the full-resolution polygons."""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import shapely
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from micromarket_index import MicromarketIndex, geojson_feature_parts, simplification_tiers
+from micromarket_store import compile_geojson, load_index
+
+GEOJSON_PATH = os.path.join(ROOT, 'Data', 'new.geojson')
+
+
+@pytest.fixture(scope='module')
+def feature_parts():
+    with open(GEOJSON_PATH, encoding='utf-8') as f:
+        return list(geojson_feature_parts(json.load(f)['features']))
+
+
+def exact_positions(index, lats, lons):
+    """First feature whose full-resolution polygons contain each point, by brute force."""
+    positions = np.full(len(lats), -1, dtype=np.intp)
+    for part, feature in zip(index.parts, index.part_features):
+        inside = (positions < 0) | (positions > feature)
+        inside &= shapely.contains_xy(part, lons, lats)
+        positions[inside] = feature
+    return positions
+
+
+def sample_points(index, tolerance, n, seed):
+    """Random points over the extent plus points in the band around every boundary."""
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(index.parts)
+    lons = [rng.uniform(min_lon, max_lon, n)]
+    lats = [rng.uniform(min_lat, max_lat, n)]
+
+    rings = shapely.get_rings(index.parts)
+    on_ring = shapely.line_interpolate_point(rings[rng.integers(0, len(rings), n)], rng.random(n), normalized=True)
+    coords = shapely.get_coordinates(on_ring)
+    for scale in (0.0, tolerance, 3 * tolerance):
+        jitter = rng.uniform(-scale, scale, coords.shape)
+        lons.append(coords[:, 0] + jitter[:, 0])
+        lats.append(coords[:, 1] + jitter[:, 1])
+
+    # Vertices of the tiers themselves
+    tiered = index.tiered
+    vertices = shapely.get_coordinates(np.concatenate([index.hulls[tiered], index.cores[tiered]]))
+    lons.append(vertices[:, 0])
+    lats.append(vertices[:, 1])
+    return np.concatenate(lats), np.concatenate(lons)
+
+
+@pytest.mark.parametrize('tolerance', [1e-5, 1e-4, 1e-3])
+def test_tiers_match_exact_classification(feature_parts, tolerance):
+    tiers = [simplification_tiers(polygons, tolerance, min_vertices=0) for _, polygons in feature_parts]
+    index = MicromarketIndex.from_parts(feature_parts, feature_tiers=tiers)
+    assert index.tiered.all()
+
+    lats, lons = sample_points(index, tolerance, 20000, seed=16)
+    expected = exact_positions(index, lats, lons)
+    np.testing.assert_array_equal(index.locate_many(lats, lons), expected)
+
+    sample = np.random.default_rng(0).choice(len(lats), 2000, replace=False)
+    assert [index.locate(lats[i], lons[i]) for i in sample] == expected[sample].tolist()
+
+
+def test_tiers_contain_and_lie_inside_their_polygons(feature_parts):
+    polygons = [polygon for _, feature_polygons in feature_parts for polygon in feature_polygons]
+    hulls, cores = simplification_tiers(polygons, min_vertices=0)
+    for polygon, hull, core in zip(polygons, hulls, cores):
+        assert hull.contains(polygon)
+        assert core.is_empty or polygon.contains(core)
+
+
+def test_compiled_store_keeps_tiers(tmp_path):
+    geojson_path = tmp_path / 'new.geojson'
+    shutil.copy(GEOJSON_PATH, geojson_path)
+    compile_geojson(str(geojson_path))
+    index = load_index(str(geojson_path))
+    assert index.tiered.any()
+
+    lats, lons = sample_points(index, 1e-4, 20000, seed=5)
+    np.testing.assert_array_equal(index.locate_many(lats, lons), exact_positions(index, lats, lons))
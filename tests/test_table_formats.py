@@ -0,0 +1,162 @@
+"""Enrichment reads and writes every table format, keeping the input's column types."""
+import csv
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from enrichment import enrich_file
+from table_formats import TableReader, TableWriter
+
+HEADER = ['Project Name', 'Latitude', 'Longitude', 'Units']
+ROWS = [
+    ['Casagrand Galileo', '13.0070447', '77.6900495', '120'],
+    ['Ruchira Parkeast', '13.0312165', '77.7582359', ''],
+    ['Nowhere', 'north', '77.6', '3'],
+    ['Aryan Krishnaa Divine', '13.0987287', '77.5578259', '64'],
+]
+GEOJSON = os.path.join(ROOT, 'Data', 'new.geojson')
+
+
+@pytest.fixture
+def inventory_csv(tmp_path):
+    path = tmp_path / 'inventory.csv'
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows([HEADER] + ROWS)
+    return str(path)
+
+
+def read_all(path):
+    with TableReader(path, batch_rows=2) as reader:
+        return reader.header, reader.types, list(reader.rows())
+
+
+def test_ndjson_restores_json_types(tmp_path):
+    path = str(tmp_path / 'typed.ndjson')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"id": 1, "lat": 12.9, "ok": true, "name": "a"}\n\n{"id": 2, "lat": null, "ok": false, "name": "b"}\n')
+    header, types, rows = read_all(path)
+    assert rows == [['1', '12.9', 'true', 'a'], ['2', '', 'false', 'b']]
+    out = str(tmp_path / 'out.ndjson')
+    with TableWriter(out, header + ['Zone'], types=types) as writer:
+        writer.write([row + ['East'] for row in rows])
+    with open(out, encoding='utf-8') as f:
+        assert [json.loads(line) for line in f] == [
+            {"id": 1, "lat": 12.9, "ok": True, "name": "a", "Zone": "East"},
+            {"id": 2, "lat": None, "ok": False, "name": "b", "Zone": "East"},
+        ]
+
+
+def test_enrich_csv_to_ndjson_matches_csv(inventory_csv, tmp_path):
+    enrich_file(inventory_csv, str(tmp_path / 'enriched.csv'), geojson_path=GEOJSON)
+    summary = enrich_file(inventory_csv, output_format='ndjson', chunk_rows=2, geojson_path=GEOJSON)
+    assert (summary.rows, summary.invalid) == (4, 1)
+    assert read_all(str(tmp_path / 'inventory.ndjson'))[2] == read_all(str(tmp_path / 'enriched.csv'))[2]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_columnar_round_trip(inventory_csv, tmp_path, extension):
+    pa = pytest.importorskip('pyarrow')
+    columnar = str(tmp_path / f'enriched{extension}')
+    enrich_file(inventory_csv, columnar, chunk_rows=2, geojson_path=GEOJSON)
+    header, _, rows = read_all(columnar)
+    assert header == HEADER + ['Micromarket', 'Area', 'Micromarket Tag']
+    assert [row[:4] for row in rows] == ROWS
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(columnar)
+    else:
+        schema = pa.ipc.open_file(columnar).schema
+    assert pa.types.is_dictionary(schema.field('Micromarket').type)
+    assert pa.types.is_dictionary(schema.field('Area').type)
+
+    # Re-enriching keeps the columnar output's types and categoricals
+    again = str(tmp_path / f'again{extension}')
+    enrich_file(columnar, again, geojson_path=GEOJSON)
+    assert read_all(again)[2] == rows
+
+
+def write_ndjson(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records))
+    return str(path)
+
+
+def read_ndjson(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+RECORDS = [
+    {"id": 1, "Latitude": 13.0070447, "Longitude": 77.6900495, "tags": ["a", "b"], "owner": {"x": 1},
+     "units": None},
+    {"id": 2, "Latitude": 13.0312165, "Longitude": 77.7582359, "units": 3, "price": 1.5e7,
+     "notes": "corner plot"},
+    {"id": "P-3", "Latitude": None, "Longitude": None, "tags": [], "owner": None, "units": 4.5},
+]
+
+
+def test_ndjson_keeps_every_field_in_place(tmp_path):
+    path = write_ndjson(tmp_path / 'inventory.ndjson', RECORDS)
+    header, types, rows = read_all(path)
+    assert header == ['id', 'Latitude', 'Longitude', 'tags', 'owner', 'units', 'price', 'notes']
+    assert (types['id'], types['units'], types['tags'], types['price']) == ('json', 'float64', 'json', 'float64')
+    assert rows[0][3:5] == ['["a", "b"]', '{"x": 1}']
+
+    # Rewritten in place, over more than one worker process
+    summary = enrich_file(path, workers=2, chunk_rows=1, geojson_path=GEOJSON)
+    assert (summary.rows, summary.invalid) == (3, 1)
+    enriched = read_ndjson(path)
+    outputs = {'Micromarket', 'Area', 'Micromarket Tag'}
+    assert [{k: v for k, v in record.items() if k not in outputs} for record in enriched] == RECORDS
+    assert all(outputs <= set(record) for record in enriched)
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.arrow'])
+def test_columnar_keeps_nested_and_null_values(tmp_path, extension):
+    pa = pytest.importorskip('pyarrow')
+    table = pa.table({
+        'id': pa.array([1, 2, 3], pa.int64()),
+        'Latitude': pa.array([13.0070447, 13.0312165, None]),
+        'Longitude': pa.array([77.6900495, 77.7582359, None]),
+        'tags': pa.array([['a', 'b'], None, []], pa.list_(pa.string())),
+        'units': pa.array([None, 3, 4], pa.int32()),
+        'notes': pa.array([None, '', 'x'], pa.string()),
+    })
+    source = str(tmp_path / f'inventory{extension}')
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, source)
+        read = pq.read_table
+    else:
+        with pa.ipc.new_file(source, table.schema) as writer:
+            writer.write_table(table)
+        read = lambda path: pa.ipc.open_file(path).read_all()  # noqa: E731
+    output = str(tmp_path / f'enriched{extension}')
+    enrich_file(source, output, chunk_rows=2, geojson_path=GEOJSON)
+    enriched = read(output)
+    assert enriched.select(table.column_names).equals(table)
+
+    # Text formats get the nested values as JSON
+    ndjson = str(tmp_path / 'enriched.ndjson')
+    enrich_file(source, ndjson, geojson_path=GEOJSON)
+    assert [record['tags'] for record in read_ndjson(ndjson)] == [['a', 'b'], None, []]
+    csv_path = str(tmp_path / 'enriched.csv')
+    enrich_file(source, csv_path, geojson_path=GEOJSON)
+    assert [row[3] for row in read_all(csv_path)[2]] == ['["a", "b"]', '', '[]']
+
+
+def test_ndjson_to_parquet_keeps_mixed_values_as_text(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = write_ndjson(tmp_path / 'inventory.ndjson', RECORDS)
+    output = str(tmp_path / 'enriched.parquet')
+    enrich_file(path, output, geojson_path=GEOJSON)
+    table = pq.read_table(output)
+    assert table.column('units').to_pylist() == [None, 3.0, 4.5]
+    assert table.column('id').to_pylist() == ['1', '2', 'P-3']
+    assert table.column('tags').to_pylist() == ['["a", "b"]', None, '[]']
+    assert table.column('notes').to_pylist() == [None, 'corner plot', None]
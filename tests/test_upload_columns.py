@@ -0,0 +1,108 @@
+"""Re-uploading an enriched file updates its Micromarket and Zone columns instead of adding more."""
+import csv
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app, job_store
+
+UPLOAD = (
+    "Project Name,Latitude,Longitude\n"
+    "Koramangala Heights,12.9352,77.6245\n"
+    "Hebbal Lakeside,13.0358,77.5970\n"
+    "Broken,north,77.6\n"
+).encode()
+
+
+def upload(data, name, mode=''):
+    client = app.test_client()
+    response = client.post(f'/upload_csv{mode}', data={'file': (io.BytesIO(data), name)})
+    if mode != '?async=1':
+        assert response.status_code == 200
+        return response.data
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+    deadline = time.time() + 60
+    while client.get(f'/jobs/{job_id}').json['status'] not in ('done', 'failed') and time.time() < deadline:
+        time.sleep(0.2)
+    result = client.get(f'/jobs/{job_id}/result')
+    assert result.status_code == 200
+    job = job_store.get(job_id)
+    for path in (job['input_path'], job['output_path']):
+        os.remove(path)
+    return result.data
+
+
+def rows(data):
+    return list(csv.reader(io.StringIO(data.decode('utf-8'))))
+
+
+def test_reupload_reuses_the_output_columns():
+    try:
+        first = upload(UPLOAD, 'reupload.csv')
+        header = rows(first)[0]
+        assert header == ['Project Name', 'Latitude', 'Longitude', 'Micromarket', 'Zone']
+        assert rows(first)[3][3:] == ['Invalid Coordinates', '']
+
+        for mode in ('', '?stream=1', '?async=1'):
+            again = upload(first, 'updated_reupload.csv', mode)
+            assert again == first, mode
+
+        # Stale results in a re-upload are replaced, whatever the column order
+        stale = [['Zone', 'Project Name', 'Latitude', 'Longitude', 'Micromarket']]
+        stale += [[row[4], *row[:3], 'Old Name'] for row in rows(first)[1:3]]
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(stale)
+        updated = rows(upload(buffer.getvalue().encode(), 'stale.csv'))
+        assert updated[0] == stale[0]
+        assert [row[4] for row in updated[1:]] == [row[3] for row in rows(first)[1:3]]
+    finally:
+        for name in ('reupload.csv', 'updated_reupload.csv', 'updated_updated_reupload.csv', 'stale.csv',
+                     'updated_stale.csv'):
+            path = os.path.join(ROOT, 'uploads', name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_single_coordinates_column():
+    data = b"Name,coordinates\nA,\"12.9352, 77.6245\"\nB,\n"
+    try:
+        result = rows(upload(data, 'combined.csv', '?stream=1'))
+    finally:
+        for name in ('combined.csv', 'updated_combined.csv'):
+            path = os.path.join(ROOT, 'uploads', name)
+            if os.path.exists(path):
+                os.remove(path)
+    assert result[0] == ['Name', 'coordinates', 'Micromarket', 'Zone']
+    assert result[1][2] not in ('Unknown', 'Invalid Coordinates')
+    assert result[2][2:] == ['Invalid Coordinates', '']
+
+
+def test_other_coordinate_names_are_read_by_position():
+    data = b"Name,Lat,Lng\nX,12.97,77.59\n"
+    try:
+        for mode in ('', '?stream=1', '?async=1'):
+            result = rows(upload(data, 'positional.csv', mode))
+            assert result[0] == ['Name', 'Lat', 'Lng', 'Micromarket', 'Zone'], mode
+            assert result[1][3:] == ['Chickpet', 'Central'], mode
+    finally:
+        for name in ('positional.csv', 'updated_positional.csv'):
+            path = os.path.join(ROOT, 'uploads', name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_combined_coordinates_under_another_name():
+    data = b"Name,Location\nX,\"12.97, 77.59\"\n"
+    try:
+        result = rows(upload(data, 'combined.csv'))
+    finally:
+        for name in ('combined.csv', 'updated_combined.csv'):
+            path = os.path.join(ROOT, 'uploads', name)
+            if os.path.exists(path):
+                os.remove(path)
+    assert result[1][2:] == ['Chickpet', 'Central']